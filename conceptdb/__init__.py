@@ -1,14 +1,26 @@
 __import__('os').environ.setdefault('DJANGO_SETTINGS_MODULE', 'csc.django_settings')
-from log import Log
-import mongoengine as mon
-from mongoengine.queryset import DoesNotExist, QuerySet
-from pymongo.objectid import ObjectId
-import pymongo
-import db_config
+# Importing this package should stay cheap, because short scripts and worker
+# processes import it before doing anything else. So mongoengine, pymongo,
+# db_config and the NL tools are imported inside the functions that need
+# them, and test_startup.py checks that this stays true.
+from conceptdb.identity_map import Session, current_session
+from conceptdb import keycache
 import json
 
+def _settings(host, username, password):
+    """
+    Fill in the connection settings that weren't given with the ones in
+    db_config.py.
+    """
+    import db_config
+    return (host or db_config.MONGODB_HOST,
+            username or db_config.MONGODB_USER,
+            password or db_config.MONGODB_PASSWORD)
+
+_pending_connection = None
+
 def connect_to_mongodb(dbname='conceptdb', host=None,
-                       username=None, password=None):
+                       username=None, password=None, lazy=False):
     """
     Connect to the given MongoDB database. By default, it will connect to
     'conceptdb' with the settings given in db_config.py, but any of these
@@ -19,14 +31,33 @@ def connect_to_mongodb(dbname='conceptdb', host=None,
 
     The majority of the methods in csc.conceptdb will not work until
     after you have used connect_to_mongodb successfully.
+
+    With lazy=True, the connection is only remembered, and is made by the
+    first call to ensure_connection(). This lets modules that are imported
+    at startup say which database they want without paying for it.
     """
-    host = host or db_config.MONGODB_HOST
-    username = username or db_config.MONGODB_USER
-    password = password or db_config.MONGODB_PASSWORD
+    global _pending_connection
+    if lazy:
+        _pending_connection = (dbname, host, username, password)
+        return None
+    _pending_connection = None
+    import mongoengine as mon
+    host, username, password = _settings(host, username, password)
+    # Write out cached changes while they can still reach their database.
+    keycache.reset_all()
     _db = mon.connect(dbname, host=host, username=username, password=password)
+    register_connection(DEFAULT_ALIAS, dbname, host, username, password)
     return _db
 connect = connect_to_mongodb
 
+def ensure_connection():
+    """
+    Make the connection that connect_to_mongodb(..., lazy=True) put off, if
+    it hasn't been made yet.
+    """
+    if _pending_connection is not None:
+        return connect_to_mongodb(*_pending_connection)
+
 def create_mongodb(dbname, host=None,
                    username=None, password=None):
     """
@@ -41,9 +72,8 @@ def create_mongodb(dbname, host=None,
     unwieldy replacement for connect_to_mongodb, which may be useful in tests
     that frequently have to create databases.
     """
-    host = host or db_config.MONGODB_HOST
-    username = username or db_config.MONGODB_USER
-    password = password or db_config.MONGODB_PASSWORD
+    import pymongo
+    host, username, password = _settings(host, username, password)
     
     conn = pymongo.Connection(host=host)
     conn.admin.authenticate(username, password)
@@ -58,14 +88,83 @@ def drop_mongodb(dbname, host=None, username=None, password=None):
     """
     if dbname in IMPORTANT_DATABASES:
         raise ValueError("I'm sorry, Dave, I can't let you do that.")
-    host = host or db_config.MONGODB_HOST
-    username = username or db_config.MONGODB_USER
-    password = password or db_config.MONGODB_PASSWORD
+    import pymongo
+    host, username, password = _settings(host, username, password)
     
     conn = pymongo.Connection(host=host)
     conn.admin.authenticate(username, password)
     conn.drop_database(dbname)
 
+DEFAULT_ALIAS = 'default'
+_clients = {}    # (host, username) -> pymongo.Connection, shared by aliases
+_aliases = {}    # alias -> (dbname, host, username, password)
+_databases = {}  # alias -> pymongo Database, once connected
+
+def register_connection(alias, dbname=None, host=None,
+                        username=None, password=None):
+    """
+    Give a name to a database, so that documents can be read from and saved
+    to it with Document.using(alias) and doc.save_to(alias), while the global
+    mongoengine connection stays where it is.
+
+    `dbname` defaults to the alias itself, and the other settings default to
+    the ones in db_config.py. Aliases on the same host and account share one
+    pooled pymongo connection, which isn't opened until the alias is used.
+
+    The alias 'default' always refers to the database most recently connected
+    to with connect_to_mongodb.
+    """
+    dbname = dbname or alias
+    host, username, password = _settings(host, username, password)
+    settings = (dbname, host, username, password)
+    if _aliases.get(alias) != settings:
+        _aliases[alias] = settings
+        _databases.pop(alias, None)
+
+def get_database(alias=DEFAULT_ALIAS):
+    """
+    Get the pymongo Database registered under `alias`. An alias that hasn't
+    been registered is taken to be a database name with the default
+    settings.
+    """
+    if alias == DEFAULT_ALIAS:
+        ensure_connection()
+    db = _databases.get(alias)
+    if db is not None:
+        return db
+    import pymongo
+    if alias not in _aliases:
+        register_connection(alias)
+    dbname, host, username, password = _aliases[alias]
+    client = _clients.get((host, username))
+    if client is None:
+        client = pymongo.Connection(host=host)
+        _clients[(host, username)] = client
+    db = client[dbname]
+    if username:
+        db.authenticate(username, password)
+    _databases[alias] = db
+    return db
+
+def session(max_size=10000):
+    """
+    Start an identity-map session, to be used in a `with` statement. See
+    conceptdb.identity_map.Session.
+    """
+    return Session(max_size)
+
+# Whether ConceptDBDocument.save waits for MongoDB to acknowledge each write.
+# bulk_import_mode turns this off.
+SAFE_WRITES = True
+
+def bulk_import_mode(*args, **kwargs):
+    """
+    Make writes as fast as possible while loading a large amount of data, to
+    be used in a `with` statement. See conceptdb.bulk.BulkImportMode.
+    """
+    from conceptdb.bulk import BulkImportMode
+    return BulkImportMode(*args, **kwargs)
+
 class JSONScrubber(json.JSONEncoder):
     def _iterencode_dict(self, dct, markers=None):
         d2 = {}
@@ -75,6 +174,9 @@ class JSONScrubber(json.JSONEncoder):
         return json.JSONEncoder._iterencode_dict(self, d2, markers)
     
     def _iterencode_default(self, obj, markers):
+        import mongoengine as mon
+        from mongoengine.queryset import QuerySet
+        from pymongo.objectid import ObjectId
         if isinstance(obj, ObjectId):
             yield obj.binary.encode('hex')
             return
@@ -105,16 +207,98 @@ class ConceptDBDocument(object):
     """
     @classmethod
     def get(cls, key):
-        result = cls.objects.with_id(key)
+        from mongoengine.queryset import DoesNotExist
+        result = cls.lookup(key)
         if result is None: raise DoesNotExist
         return result
 
+    @classmethod
+    def lookup(cls, key):
+        """
+        Get the document with the given id, or None if there isn't one. Inside
+        a session, repeated lookups of the same id don't query the database.
+        """
+        session = current_session()
+        if session is not None:
+            result = session.get(cls, key)
+            if result is not None: return result
+        result = cls.objects.with_id(key)
+        if session is not None and result is not None:
+            session.put(result)
+        return result
+
+    def _forget(self):
+        # The database copy changed out from under this object, so the
+        # session shouldn't hand it out anymore.
+        session = current_session()
+        if session is not None and self.id:
+            session.discard(self.__class__, self.id)
+
+    @classmethod
+    def using(cls, alias):
+        """
+        Get a QuerySet of this class's documents in the database registered
+        as `alias` (see register_connection).
+        """
+        from mongoengine.queryset import QuerySet
+        collection = get_database(alias)[cls._meta['collection']]
+        return QuerySet(cls, collection)
+
+    def save_to(self, alias):
+        """
+        Save this document to the database registered as `alias`. This
+        doesn't write Log entries or touch the session, which both belong to
+        the default database.
+        """
+        self.check_consistency()
+        self.validate()
+        collection = self.using(alias)._collection
+        object_id = collection.save(self.to_mongo(), safe=True)
+        id_field = self._meta['id_field']
+        self[id_field] = self._fields[id_field].to_python(object_id)
+
     @classmethod
     def create(cls, **fields):
         object = cls(**fields)
         object.save()
         return object
 
+    @classmethod
+    def upsert(cls, spec, fields):
+        """
+        Get the document matching `spec`, or create it from `fields` if there
+        is none, in a single atomic round trip. Returns a tuple of
+        (document, created).
+
+        `spec` is a raw MongoDB query, which should be backed by a unique
+        index (such as _id) so that concurrent upserts can't make duplicates.
+        """
+        from conceptdb.log import Log
+        from pymongo.objectid import ObjectId
+        doc = cls(**fields)
+        doc.check_consistency()
+        doc.validate()
+        son = doc.to_mongo()
+        if son.get('_id') is None:
+            son['_id'] = ObjectId()
+        on_insert = dict((key, value) for key, value in son.items()
+                         if key not in spec)
+        collection = cls.objects._collection
+        previous = collection.find_and_modify(query=spec,
+                                              update={'$setOnInsert': on_insert},
+                                              upsert=True, new=False)
+        if previous is None:
+            doc = cls._from_son(son)
+            Log.record_new(doc)
+            created = True
+        else:
+            doc = cls._from_son(previous)
+            created = False
+        session = current_session()
+        if session is not None:
+            session.put(doc)
+        return doc, created
+
     def update(self, db_only=True, **fields):
         if db_only and self.id:
             query = self.__class__.objects(id=self.id)
@@ -122,6 +306,7 @@ class ConceptDBDocument(object):
             for key, value in fields.items():
                 update['set__'+key] = value
             result = query.update_one(**update)
+            self._forget()
             return result
 
     def append(self, fieldname, value, db_only=True):
@@ -132,19 +317,54 @@ class ConceptDBDocument(object):
                 'push__'+fieldname: value
             }
             result = query.update_one(**update)
+            self._forget()
             return result
         else:
             self[fieldname].append(value)
     
+    @classmethod
+    def _from_son(cls, son):
+        # Anything built from a MongoDB document is already in the database.
+        obj = super(ConceptDBDocument, cls)._from_son(son)
+        obj._persisted = True
+        return obj
+
     def save(self):
+        """
+        Save this document in one round trip, adding a 'create' entry to the
+        log if the document was not in the database before.
+
+        A document we loaded or saved already is simply saved. A document with
+        no _id yet must be new, so it is inserted. Otherwise, the document is
+        upserted by its _id, and the result of the upsert tells us whether it
+        was new.
+        """
+        import mongoengine as mon
+        from conceptdb.log import Log
         self.check_consistency()
-        prevstate = None
-        if getattr(self, '_id', None) is not None:
-            prevstate = self.__class__.objects.with_id(self._id)
-        
-        result = mon.Document.save(self)
-        if prevstate is None:
-            Log.record_new(self)
+        if getattr(self, '_persisted', False):
+            result = mon.Document.save(self, safe=SAFE_WRITES)
+        else:
+            son = self.to_mongo()
+            if son.get('_id') is None:
+                result = mon.Document.save(self, safe=SAFE_WRITES)
+                created = True
+            else:
+                self.validate()
+                collection = self.__class__.objects._collection
+                status = collection.update({'_id': son['_id']}, son,
+                                           upsert=True, safe=SAFE_WRITES)
+                # An unacknowledged write doesn't tell us whether it was new,
+                # so it doesn't get a log entry.
+                created = (status is not None
+                           and not status.get('updatedExisting', False))
+                result = None
+            self._persisted = True
+            if created:
+                Log.record_new(self)
+        session = current_session()
+        if session is not None:
+            session.put(self)
         return result
     
     def serialize(self):
@@ -5,16 +5,23 @@ from conceptdb.assertion import Assertion, Sentence, Expression
 from conceptdb.metadata import Dataset
 from conceptdb.justify import ReasonConjunction
 from conceptdb.freebase_imports import MQLQuery
-from conceptdb import ConceptDBDocument
 from conceptdb.db_merge import merge
 import conceptdb
+from conceptdb import raw, factor_index, justify
 from mongoengine.queryset import DoesNotExist
 from mongoengine.base import ValidationError
 from csc.conceptnet.models import User
+from django.conf import settings
 
 basic_auth = HttpBasicAuthentication()
 
-conceptdb.connect_to_mongodb('test') #NOTE: change when not testing
+# Connect when the first request comes in, not when Django loads this module.
+conceptdb.connect_to_mongodb('test', lazy=True) #NOTE: change when not testing
+
+# Bring the confidences around an assertion up to date as soon as someone
+# votes on it, if the settings ask for it.
+if getattr(settings, 'CONCEPTDB_PROPAGATE_VOTES', False):
+    justify.propagate_votes()
 
 class ConceptDBHandler(BaseHandler):
     """The ConceptDBHandler deals with all accesses to the conceptdb 
@@ -27,6 +34,7 @@ class ConceptDBHandler(BaseHandler):
 
     @throttle(600,60,'read')
     def read(self, request, obj_url):
+        conceptdb.ensure_connection()
         obj_url = '/'+obj_url
         if obj_url.startswith('/data'):#try to find matching dataset
             return self.datasetLookup(obj_url)
@@ -38,7 +46,7 @@ class ConceptDBHandler(BaseHandler):
             return self.assertionFind(request, obj_url)
         elif obj_url.startswith('/factorusedfor'):
             #returns all of the things that a reason has been used to justify
-            return self.factorUsedFor(obj_url)
+            return self.factorUsedFor(request, obj_url)
         elif obj_url.startswith('/reason'):
             #looks up a reason by its name
             return self.reasonLookup(obj_url)
@@ -60,6 +68,7 @@ class ConceptDBHandler(BaseHandler):
     @throttle(200,60,'update')
     def create(self, request, obj_url):
         ''
+        conceptdb.ensure_connection()
         #can start with /assertionmake, /assertionvote, /freebaseimport.  
         
         obj_url = '/' + obj_url
@@ -134,74 +143,46 @@ class ConceptDBHandler(BaseHandler):
             context = None
 
         try:
-            return Assertion.objects.get(
-                dataset = dataset,
-                relation = relation,
-                argstr = argstr,
-                polarity = polarity,
-                context = context).serialize()
+            return Assertion.find_by_key(Assertion.make_key(
+                dataset, relation, argstr, polarity, context)).serialize()
         except DoesNotExist:
             return rc.NOT_FOUND
 
 
-    def factorUsedFor(self, obj_url):
-        """Given a factor in a ReasonConjunction object, returns all of the things
-        that the reason has been used to justify. Currently returns a list of the things
-        that use it in form {assertions: [list of assertions], sentence: [list of sentences],
-        expression: [list of expressions]}.  If the reason has also been used to 
-        justify things that are not in the database (for instance Users), it will
-        inform you but not return the other items.  I might change this later.  
-        
-        URL must take the form /api/factorusedfor/{reason id}"""
+    def factorUsedFor(self, request, obj_url):
+        """Given a factor in a ReasonConjunction object, returns the things
+        that the reason has been used to justify. Returns a dictionary with
+        'counts', the number of assertions, expressions, sentences and other
+        items (such as Users) it justifies, and one page of each of them:
+        {'counts': {...}, 'page': 0, 'page_size': 1000, 'assertions': [ids],
+        'expressions': [ids], 'sentences': [ids], 'other': [names]}.
+
+        URL must take the form /api/factorusedfor/{reason id}?page={page},
+        where page is optional and defaults to 0."""
 
-        #must look for the reason being used in Assertion, Sentence, and Expression
-        #TODO: should there be a limit on the number of things returned,  maybe also
-        #sorted by confidence scores?  
-        
         factorName = obj_url.replace('/factorusedfor', '')
-        assertions = [] #list of assertion id's with obj_url as justification
-        expressions = [] #list of expressions with obj_url as justification
-        sentences = [] #list of sentences with obj_url as justification
-        other = False #
-        cursor = ReasonConjunction.objects._collection.find({'factors':factorName})
-        while(True):
-            try:
-                next_item = cursor.next()['target']
-                
-                #if target was the document itself, change to document name
-                if isinstance(next_item, ConceptDBDocument):
-                    next_item = next_item.name
-
-                if isinstance(next_item, basestring) == False:
-                    #not a ConceptDBDocument.
-                    other = True
-                    continue;
-
-                #go through and add assertion ids to assertion list,
-                #expression ids to expression list,
-                #sentence ids to sentence list.  
-                if next_item.startswith('/assertion'):
-                    assertions.append(next_item.replace('/assertion/', ''))
-                elif next_item.startswith('/expression'):
-                    expressions.append(next_item.replace('/expression/', ''))
-                elif next_item.startswith('/sentence/'):
-                    sentences.append(next_item.replace('/sentence/', ''))
-                else: #not a database item
-                    other = True
-            except StopIteration:
-                break
-
-
-        if (len(sentences) == len(assertions) == len(expressions) == 0) and (other == False):
+        try:
+            page = int(request.GET.get('page', '0'))
+        except ValueError:
+            return rc.BAD_REQUEST
+        if page < 0:
+            return rc.BAD_REQUEST
+        counts, targets = factor_index.used_for(factorName, page)
+        if not any(counts.values()):
             #not used to justify anything
             return rc.NOT_FOUND
 
-        ret = "{'assertions':" + str(assertions) + ", 'sentences':" + str(sentences) + ", 'expressions':" + str(expressions) + "}"
+        def ids(kind):
+            prefix = '/%s/' % kind
+            return [target[len(prefix):] for target in targets[kind]]
 
-        if other:
-            ret = ret + "\nThis reason is also used to justify non-database items."
-        
-        return ret 
+        return {'counts': counts,
+                'page': page,
+                'page_size': factor_index.PAGE_SIZE,
+                'assertions': ids('assertion'),
+                'expressions': ids('expression'),
+                'sentences': ids('sentence'),
+                'other': targets['other']}
 
     def reasonLookup(self, obj_url):
         """Method allows you to look up a ReasonConjunction by its id.  
@@ -230,15 +211,9 @@ class ConceptDBHandler(BaseHandler):
         limit = int(request.GET.get('limit', '10'))
         conceptName = obj_url.replace('/conceptfind', '')
         #NOTE: should return ranked by confidence score.  For now assume that they do.
-        cursor = Assertion.objects._collection.find({'arguments':conceptName})[start:start + limit]
-        assertions = []
-
-
-        while (True):
-            try:
-                assertions.append(str(cursor.next()['_id']))
-            except StopIteration:
-                break #no more assertions within the skip/limit boundaries
+        records = raw.assertions(fields=[], spec={'arguments':conceptName},
+                                 skip=start, limit=limit)
+        assertions = [str(record.id) for record in records]
 
         if len(assertions) == 0: #no assertions were found for the concept
             return rc.NOT_FOUND
@@ -282,14 +257,14 @@ class ConceptDBHandler(BaseHandler):
             return rc.FORBIDDEN
         
         try:
-            assertion = Assertion.objects.get(
-                dataset = dataset,
-                relation = relation,
-                argstr = argstr,
-                polarity = polarity,
-                context = context)
+            assertion = Assertion.find_by_key(Assertion.make_key(
+                dataset, relation, argstr, polarity, context))
             
-            assertion.add_support([dataset + '/contributor/' + user]) 
+            try:
+                assertion.add_support([dataset + '/contributor/' + user]) 
+            except ValueError:
+                #virtual generalizations can't be voted on
+                return rc.BAD_REQUEST
             return "The assertion you created already exists.  Your vote for this \
             assertion has been counted.\n" + str(assertion.serialize())
 
@@ -337,12 +312,8 @@ class ConceptDBHandler(BaseHandler):
 
             
             try:
-                 assertion = Assertion.objects.get(
-                     dataset = dataset,
-                     relation = relation,
-                     argstr = argstr,
-                     polarity = polarity,
-                     context = context)
+                 assertion = Assertion.find_by_key(Assertion.make_key(
+                     dataset, relation, argstr, polarity, context))
             except DoesNotExist:
                 return rc.NOT_FOUND
         else:
@@ -366,11 +337,15 @@ class ConceptDBHandler(BaseHandler):
             return rc.FORBIDDEN
          
         vote = request.POST['vote']
-        if vote == "1": #vote in favor
-            assertion.add_support([dataset + '/contributor/' + user]) 
-        elif vote == "-1": #vote against
-            assertion.add_oppose([dataset + '/contributor/' + user])
-        else: #invalid vote
+        try:
+            if vote == "1": #vote in favor
+                assertion.add_support([dataset + '/contributor/' + user]) 
+            elif vote == "-1": #vote against
+                assertion.add_oppose([dataset + '/contributor/' + user])
+            else: #invalid vote
+                return rc.BAD_REQUEST
+        except ValueError:
+            #virtual generalizations can't be voted on
             return rc.BAD_REQUEST
 
         return assertion.serialize()
@@ -394,13 +369,9 @@ class ConceptDBHandler(BaseHandler):
             assertion = Assertion.get(assertionID)
         except DoesNotExist:
             return rc.NOT_FOUND
-        cursor = Expression.objects(assertion = assertion)[start:start + limit]
-        expressions = []
-        while (True):
-            try:
-                expressions.append(str(cursor.next().id))
-            except StopIteration:
-                break #no more assertions within the skip/limit boundaries
+        records = raw.expressions(fields=[], assertion = assertion,
+                                  skip=start, limit=limit)
+        expressions = [str(record.id) for record in records]
 
         if len(expressions) == 0: #no assertions were found for the concept
             return rc.NOT_FOUND
@@ -71,6 +71,12 @@ TEMPLATE_DIRS = (
     # Don't forget to use absolute paths, not relative paths.
 )
 
+# Whether each vote through the API propagates to the confidences around it
+# before the request returns (see conceptdb.justify.propagate_votes). This
+# can take thousands of reads per vote, so it is off by default, and the
+# confidences are brought up to date by conceptdb.inference.corona.refresh.
+CONCEPTDB_PROPAGATE_VOTES = False
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
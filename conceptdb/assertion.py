@@ -2,10 +2,40 @@ import mongoengine as mon
 from mongoengine.queryset import DoesNotExist
 from conceptdb.justify import ConceptDBJustified
 from conceptdb.metadata import Dataset
-from conceptdb.util import outer_iter
 from conceptdb import ConceptDBDocument
+from conceptdb.keycache import NaturalKeyCache, encode_key
+from pymongo.objectid import ObjectId
+import hashlib
 
 BLANK = '*'
+
+# If this is true, new assertions get content-addressed ids (see
+# Assertion.content_id), and Assertion.make becomes a single upsert. Turn it
+# on with use_content_ids(), and run conceptdb.migrate_ids on databases that
+# were built without it.
+CONTENT_IDS = False
+
+def use_content_ids(enabled=True):
+    global CONTENT_IDS
+    CONTENT_IDS = enabled
+
+# If this is true, generalizations with wildcard arguments are not stored;
+# they are computed from the complete assertions when they are looked up.
+# See conceptdb.virtual.
+VIRTUAL_GENERALIZATIONS = False
+
+def use_virtual_generalizations(enabled=True):
+    global VIRTUAL_GENERALIZATIONS
+    VIRTUAL_GENERALIZATIONS = enabled
+
+# Arguments in positions below this are copied into indexed fields (arg0,
+# arg1, ...), so that Assertion.match can find them by position.
+POSITIONS = 3
+
+# Natural key -> id cache used to deduplicate assertions.
+ASSERTION_KEYS = NaturalKeyCache(
+    ['dataset', 'relation', 'polarity', 'argstr', 'context'])
+
 class Assertion(ConceptDBJustified, mon.Document):
     dataset = mon.StringField(required=True) # reference to Dataset
     relation = mon.StringField(required=True) # concept ID
@@ -15,10 +45,20 @@ class Assertion(ConceptDBJustified, mon.Document):
     context = mon.StringField() # concept ID
     polarity = mon.IntField() # 1, 0, or -1
     confidence = mon.FloatField(default=0.0)
+    # running sums over this object's reasons (see justify.count_reasons)
+    vote_sum = mon.FloatField(default=0.0)
+    weight_sum = mon.FloatField(default=0.0)
+    # copies of arguments[0], arguments[1], ... (see Assertion.positions)
+    arg0 = mon.StringField()
+    arg1 = mon.StringField()
+    arg2 = mon.StringField()
 
     meta = {'indexes': [('arguments', '-confidence'),
                         ('dataset', 'relation', 'polarity', 'argstr', 'context'),
                         'confidence',
+                        ('relation', 'arg0', 'complete', '-confidence'),
+                        ('relation', 'arg1', 'complete', '-confidence'),
+                        ('relation', 'arg2', 'complete', '-confidence'),
                        ]}
     
     @staticmethod
@@ -32,22 +72,105 @@ class Assertion(ConceptDBJustified, mon.Document):
         return '/assertion/%s' % self.id
 
     @staticmethod
-    def make(dataset, relation, arguments, polarity=1, context=None,
-             reasons=None, weight=1.0):
-        needs_save = False
+    def positions(arguments):
+        """
+        Get the values of the positional fields (arg0, arg1, ...) for a list
+        of arguments, as a dictionary. Every constructor of assertions should
+        pass these along with `arguments`.
+        """
+        return dict(('arg%d' % index, arguments[index])
+                    for index in xrange(min(len(arguments), POSITIONS)))
+
+    @staticmethod
+    def match(relation, pattern, complete=True, **query):
+        """
+        Find the assertions whose arguments match a pattern, best first. The
+        pattern is a list with an argument or BLANK in each position, so
+        Assertion.match('/rel/IsA', ['/concept/en/dog', BLANK]) finds what
+        dogs are. If `complete` is true, only assertions that are not
+        themselves generalizations are found. Any other keyword arguments
+        filter the results, as in Assertion.objects.
+
+        The query runs on the positional indexes, so only the first
+        POSITIONS arguments can be fixed.
+        """
+        if relation is not None:
+            query['relation'] = relation
+        if complete:
+            query['complete'] = 1
+        for index, arg in enumerate(pattern):
+            if arg == BLANK: continue
+            if index >= POSITIONS:
+                raise ValueError("Only the first %d arguments can be matched"
+                                 % POSITIONS)
+            query['arg%d' % index] = arg
+        return Assertion.objects(**query).order_by('-confidence')
+
+    @staticmethod
+    def fill_positions(batch_size=1000):
+        """
+        Set the positional fields of assertions that were stored before they
+        existed. Returns the number of assertions updated.
+        """
+        collection = Assertion.objects._collection
+        count = 0
+        cursor = collection.find({'arg0': {'$exists': False}},
+                                 fields=['arguments'])
+        for doc in cursor.batch_size(batch_size):
+            positions = Assertion.positions(doc.get('arguments') or [])
+            if positions:
+                collection.update({'_id': doc['_id']}, {'$set': positions})
+                count += 1
+        return count
+
+    @staticmethod
+    def make_key(dataset, relation, arguments, polarity=1, context=None):
+        """
+        Get the natural key that identifies an assertion: the tuple
+        (dataset, relation, polarity, argstr, context).
+        """
         if isinstance(arguments, basestring):
             argstr = arguments
         else:
             argstr = Assertion.make_arg_string(arguments)
         if isinstance(dataset, Dataset): dataset = dataset.name
-        try:
-            a = Assertion.objects.get(
+        return (dataset, relation, polarity, argstr, context)
+
+    @staticmethod
+    def make(dataset, relation, arguments, polarity=1, context=None,
+             reasons=None, weight=1.0):
+        needs_save = False
+        key = Assertion.make_key(dataset, relation, arguments, polarity,
+                                 context)
+        dataset, relation, polarity, argstr, context = key
+        if VIRTUAL_GENERALIZATIONS:
+            from conceptdb import virtual
+            if virtual.is_wildcard(key):
+                a = virtual.find(key)
+                if a is not None:
+                    if reasons is not None:
+                        a.add_reason(reasons, weight)
+                    return a
+        if CONTENT_IDS:
+            a, created = Assertion.upsert({'_id': Assertion.content_id(key)}, dict(
+                id=Assertion.content_id(key),
                 dataset=dataset,
                 relation=relation,
-                polarity=polarity,
+                arguments=arguments,
                 argstr=argstr,
+                complete=(BLANK not in arguments),
                 context=context,
-            )
+                polarity=polarity,
+                **Assertion.positions(arguments)
+            ))
+            ASSERTION_KEYS.add(key, a.id)
+            if created:
+                Assertion._made(key)
+            if reasons is not None:
+                a.add_reason(reasons, weight)
+            return a
+        try:
+            a = Assertion.find_by_key(key)
         except DoesNotExist:
             a = Assertion(
                 dataset=dataset,
@@ -57,45 +180,113 @@ class Assertion(ConceptDBJustified, mon.Document):
                 complete=(BLANK not in arguments),
                 context=context,
                 polarity=polarity,
+                **Assertion.positions(arguments)
             )
             needs_save = True
         if reasons is not None:
-            a.add_support(reasons, weight)
-        if needs_save: a.save()
+            a.add_reason(reasons, weight)
+        if needs_save:
+            a.save()
+            ASSERTION_KEYS.add(key, a.id)
+            Assertion._made(key)
+        return a
+
+    @staticmethod
+    def _made(key):
+        """
+        Called when a new assertion has been stored.
+        """
+        if VIRTUAL_GENERALIZATIONS:
+            from conceptdb import virtual
+            if not virtual.is_wildcard(key):
+                virtual.invalidate(key)
+
+    @staticmethod
+    def content_id(key):
+        """
+        Get the content-addressed id for an assertion with the given natural
+        key: an ObjectId made from the first 12 bytes of the key's SHA-1.
+        The same assertion gets the same id in every database.
+        """
+        return ObjectId(hashlib.sha1(encode_key(key)).digest()[:12])
+
+    @staticmethod
+    def find_by_key(key):
+        """
+        Get the assertion with the given natural key (as returned by
+        make_key), or raise DoesNotExist.
+
+        This checks ASSERTION_KEYS before querying the database, so keys it
+        has seen are looked up by id, and keys it knows to be missing are not
+        looked up at all. With virtual generalizations on, wildcard keys are
+        answered by conceptdb.virtual, falling back on stored assertions.
+        """
+        if VIRTUAL_GENERALIZATIONS:
+            from conceptdb import virtual
+            if virtual.is_wildcard(key):
+                a = virtual.find(key)
+                if a is not None: return a
+        id = ASSERTION_KEYS.get(key)
+        if id is None and CONTENT_IDS:
+            id = Assertion.content_id(key)
+        if id is not None:
+            a = Assertion.lookup(id)
+            if a is not None: return a
+            ASSERTION_KEYS.discard(key)
+        if ASSERTION_KEYS.known_missing(key):
+            raise DoesNotExist
+        dataset, relation, polarity, argstr, context = key
+        try:
+            a = Assertion.objects.get(
+                dataset=dataset,
+                relation=relation,
+                polarity=polarity,
+                argstr=argstr,
+                context=context,
+            )
+        except DoesNotExist:
+            ASSERTION_KEYS.record_miss(found=False)
+            raise
+        ASSERTION_KEYS.record_miss(found=True)
+        ASSERTION_KEYS.add(key, a.id)
         return a
 
+    @staticmethod
+    def preload_keys(**query):
+        """
+        Load the natural key of every assertion (or every one matching the
+        given query) into the Bloom filter of ASSERTION_KEYS, so that
+        Assertion.make can skip lookups for assertions that are certainly
+        new. Only do this when no other process is writing assertions.
+        """
+        spec = Assertion.objects(**query)._query
+        return ASSERTION_KEYS.preload(Assertion.objects._collection, spec)
+
+    def add_reason(self, factors, vote):
+        """
+        Add a reason for this assertion. A virtual generalization (see
+        conceptdb.virtual) isn't stored, so a reason for it would be lost,
+        and this raises a ValueError instead.
+        """
+        if getattr(self, '_virtual', False):
+            raise ValueError("%s is a virtual generalization, and can't be "
+                             "voted on" % self.argstr)
+        return ConceptDBJustified.add_reason(self, factors, vote)
+
     def make_generalizations(self, reason):
-        pattern_pieces = []
-        for arg in self.arguments:
-            if arg == BLANK:
-                pattern_pieces.append((False,))
-            else:
-                pattern_pieces.append((True, False))
-        for pattern in outer_iter(pattern_pieces):
-            if True in pattern:
-                gen = self.generalize(pattern, reason)
-                gen.save()
+        """
+        Make every generalization of this assertion and its expressions,
+        supported by `reason`. See conceptdb.generalize.
+        """
+        from conceptdb.generalize import generalize_all
+        return generalize_all([self], reason)
     
-    def generalize(self, pattern, reason):
-        args = []
-        for arg, drop in zip(self.arguments, pattern):
-            if drop: args.append(BLANK)
-            else: args.append(arg)
-        reasons = [reason, self]
-        newassertion = Assertion.make(self.dataset, self.relation,
-                                      args, self.polarity,
-                                      self.context, reasons, weight=1.0)
-        for expr in self.get_expressions():
-            newexpr = expr.generalize(pattern, newassertion, reason)
-            newexpr.save()
-        return newassertion
-
     def connect_to_sentence(self, dataset, text, reasons=None):
         sent = Sentence.make(dataset, text, reasons)
         sent.add_assertion(self)
 
     def get_dataset(self):
-        return Dataset.objects.with_id(self.dataset)
+        return Dataset.lookup(self.dataset)
     
     def get_expressions(self):
         return Expression.objects(assertion=self)
@@ -112,10 +303,21 @@ class Assertion(ConceptDBJustified, mon.Document):
         #correct number of concepts for a given relation.
 
     def make_expression(self, frame, arguments, language):
+        """
+        Get this assertion's expression with the given frame and arguments,
+        making it if necessary. This is one upsert on the unique index over
+        (assertion, language, frame, text), however many expressions the
+        assertion has.
+        """
         expr = Expression.make(self, frame, arguments, language)
-        for e in self.get_expressions():
-            if expr == e: return e
-        expr.save()
+        son = expr.to_mongo()
+        spec = dict((key, son[key])
+                    for key in ('assertion', 'language', 'frame', 'text'))
+        fields = dict((key, expr[key]) for key in
+                      ('assertion', 'text', 'frame', 'arguments', 'language'))
+        expr, _ = Expression.upsert(spec, fields)
+        # We already have the assertion, so don't look it up again.
+        expr.assertion = self
         return expr
 
     def __unicode__(self):
@@ -135,6 +337,9 @@ class Sentence(ConceptDBJustified, mon.Document):
     dataset = mon.StringField(required=True)
     derived_assertions = mon.ListField(mon.ReferenceField(Assertion))
     confidence = mon.FloatField(default=0.0)
+    # running sums over this object's reasons (see justify.count_reasons)
+    vote_sum = mon.FloatField(default=0.0)
+    weight_sum = mon.FloatField(default=0.0)
 
     meta = {'indexes': ['dataset', 'words', 'text',
                         'confidence'
@@ -173,7 +378,7 @@ class Sentence(ConceptDBJustified, mon.Document):
         self.get_dataset().check_consistency()
 
     def get_dataset(self):
-        return Dataset.objects.with_id(self.dataset)
+        return Dataset.lookup(self.dataset)
 
     def add_assertion(self, assertion):
         self.append('derived_assertions', assertion, db_only=False)
@@ -189,6 +394,9 @@ class Expression(ConceptDBJustified, mon.Document):
     language = mon.StringField(required=True)
     arguments = mon.ListField(mon.StringField())
     confidence = mon.FloatField(default=0.0)
+    # running sums over this object's reasons (see justify.count_reasons)
+    vote_sum = mon.FloatField(default=0.0)
+    weight_sum = mon.FloatField(default=0.0)
 
     meta = {'indexes': ['assertion',
                         'arguments',
@@ -223,15 +431,6 @@ class Expression(ConceptDBJustified, mon.Document):
     def name(self):
         return "/expression/%s" % self.id
 
-    def generalize(self, pattern, assertion, reason):
-        args = []
-        for arg, drop in zip(self.arguments, pattern):
-            if drop: args.append(BLANK)
-            else: args.append(arg)
-        e = assertion.make_expression(self.frame, args, self.language)
-        e.add_support([reason, self], 1.0)
-        return e
-        
     def __cmp__(self, other):
         if not isinstance(other, Expression): return -1
         return cmp((self.assertion, self.frame, self.text, self.language), (other.assertion, other.frame, other.text, other.language))
@@ -0,0 +1,485 @@
+"""
+Tools for writing many documents at once.
+
+Constructors such as Assertion.make look an object up and then save it, which
+costs at least two round trips to MongoDB per object. That's fine for the API,
+but an importer that makes millions of assertions spends nearly all of its
+time waiting on those round trips. The tools in this module buffer that work
+and send it to the database in batches.
+"""
+from pymongo.objectid import ObjectId
+import conceptdb
+from conceptdb.assertion import Assertion, Expression, Sentence, \
+  ASSERTION_KEYS, BLANK
+from conceptdb import assertion as assertion_module
+from conceptdb import justify
+from conceptdb.justify import ReasonConjunction, ConfidenceValue
+from conceptdb.metadata import Dataset
+from log import Log
+import time
+import logging
+log = logging.getLogger('conceptdb.bulk')
+
+def bulk_upsert(collection, operations):
+    """
+    Run a list of (spec, update) upserts on a collection, without caring
+    what order they run in.
+
+    Returns the set of indices into `operations` whose upsert inserted a
+    new document. If the server supports bulk operations, this takes one
+    round trip; otherwise it falls back on one acknowledged update per
+    operation.
+    """
+    inserted = set()
+    if not operations:
+        return inserted
+    if hasattr(collection, 'initialize_unordered_bulk_op'):
+        bulk = collection.initialize_unordered_bulk_op()
+        for spec, update in operations:
+            bulk.find(spec).upsert().update_one(update)
+        result = bulk.execute()
+        for upserted in result.get('upserted', []):
+            inserted.add(upserted['index'])
+    else:
+        for index, (spec, update) in enumerate(operations):
+            result = collection.update(spec, update, upsert=True, safe=True)
+            if result and not result.get('updatedExisting', True):
+                inserted.add(index)
+    return inserted
+
+def bulk_update(collection, operations):
+    """
+    Run a list of (spec, update) updates on a collection, each changing at
+    most one document, without caring what order they run in. Takes one
+    round trip if the server supports bulk operations.
+    """
+    if not operations:
+        return
+    if hasattr(collection, 'initialize_unordered_bulk_op'):
+        bulk = collection.initialize_unordered_bulk_op()
+        for spec, update in operations:
+            bulk.find(spec).update_one(update)
+        bulk.execute()
+    else:
+        for spec, update in operations:
+            collection.update(spec, update, safe=conceptdb.SAFE_WRITES)
+
+class PendingExpression(object):
+    """
+    Stands in for the result of make_expression on a PendingAssertion.
+
+    Voting on it and saving it are queued until the writer flushes, and
+    anything else makes the writer flush first.
+    """
+    DEFERRED_METHODS = ('add_reason', 'add_support', 'add_oppose', 'save')
+
+    def __init__(self, assertion):
+        self._assertion = assertion
+        self._calls = []
+        self._document = None
+
+    def resolve(self):
+        """
+        Get the real Expression, flushing the writer if necessary.
+        """
+        if self._document is None:
+            self._assertion._writer.flush()
+        return self._document
+
+    def _defer(self, method):
+        def deferred(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+        return deferred
+
+    def _replay(self, document):
+        self._document = document
+        calls, self._calls = self._calls, []
+        for method, args, kwargs in calls:
+            getattr(document, method)(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr in PendingExpression.DEFERRED_METHODS \
+           and self._document is None:
+            return self._defer(attr)
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        if self._document is not None:
+            return repr(self._document)
+        return '<PendingExpression of %r>' % (self._assertion,)
+
+class PendingAssertion(object):
+    """
+    Stands in for an Assertion that an AssertionWriter hasn't written yet.
+
+    Methods that don't return anything useful, such as add_support or
+    make_generalizations, are queued and run in order when the writer
+    flushes. So is make_expression, which returns a PendingExpression.
+    Anything else makes the writer flush first, and is then passed through
+    to the real Assertion.
+    """
+    DEFERRED_METHODS = ('add_reason', 'add_support', 'add_oppose',
+                        'connect_to_sentence', 'make_generalizations',
+                        'make_expression')
+
+    def __init__(self, writer, key, arguments):
+        self._writer = writer
+        self._key = key
+        self._arguments = arguments
+        self._calls = []
+        self._document = None
+
+    @property
+    def resolved(self):
+        return self._document is not None
+
+    def resolve(self):
+        """
+        Get the real Assertion, flushing the writer if necessary.
+        """
+        if self._document is None:
+            self._writer.flush()
+        return self._document
+
+    def save(self):
+        # New assertions are written when the writer flushes.
+        if self._document is not None:
+            return self._document.save()
+
+    def _defer(self, method):
+        def deferred(*args, **kwargs):
+            result = None
+            if method == 'make_expression':
+                result = PendingExpression(self)
+            self._calls.append((method, args, kwargs, result))
+            return result
+        return deferred
+
+    def _replay(self, generalizations):
+        calls, self._calls = self._calls, []
+        for method, args, kwargs, result in calls:
+            if method == 'make_generalizations':
+                # The writer makes these for the whole batch at once.
+                reason, = args or (kwargs['reason'],)
+                generalizations.setdefault(reason, []).append(self._document)
+            elif method == 'make_expression':
+                result._replay(self._document.make_expression(*args,
+                                                              **kwargs))
+            else:
+                getattr(self._document, method)(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr in PendingAssertion.DEFERRED_METHODS and self._document is None:
+            return self._defer(attr)
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        if self._document is not None:
+            return repr(self._document)
+        return '<PendingAssertion %r>' % (self._key,)
+
+class AssertionWriter(object):
+    """
+    Buffers calls to Assertion.make, and resolves them in batches.
+
+    Use it as a context manager, calling `writer.make(...)` wherever you would
+    have called `Assertion.make(...)`:
+
+        with AssertionWriter() as writer:
+            for ...:
+                a = writer.make(dataset, relation, arguments)
+                a.add_support([contributor])
+
+    Each flush finds the assertions that already exist with a single `$in`
+    query, and creates the rest with one batch of unordered upserts. Then it
+    runs the queued method calls on each assertion, except that queued
+    make_generalizations calls are done together by generalize_all. A flush happens whenever
+    `batch_size` assertions are pending, whenever a pending assertion is used
+    in a way that needs the real object, and when the `with` block ends.
+
+    If the `with` block ends with an exception, the pending batch may be
+    half-built, so it is discarded rather than written, and a warning says
+    how many assertions, expressions and queued calls were lost.
+    """
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.pending = []
+        self._by_key = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    def discard(self):
+        """
+        Drop the pending batch without writing it, logging how much was in
+        it. Returns the number of assertions dropped.
+        """
+        batch, self.pending, self._by_key = self.pending, [], {}
+        if not batch:
+            return 0
+        expressions = calls = 0
+        for pending in batch:
+            for method, args, kwargs, result in pending._calls:
+                calls += 1
+                if result is not None:
+                    expressions += 1
+                    calls += len(result._calls)
+        log.warning("Discarded %d pending assertions, %d pending expressions "
+                    "and %d queued calls after an error"
+                    % (len(batch), expressions, calls))
+        return len(batch)
+
+    def make(self, dataset, relation, arguments, polarity=1, context=None,
+             reasons=None, weight=1.0):
+        """
+        Queue an assertion to be made. Takes the same arguments as
+        Assertion.make, and returns a PendingAssertion.
+        """
+        key = Assertion.make_key(dataset, relation, arguments, polarity,
+                                 context)
+        pending = self._by_key.get(key)
+        if pending is None:
+            pending = PendingAssertion(self, key, arguments)
+            self._by_key[key] = pending
+            self.pending.append(pending)
+        if reasons is not None:
+            pending.add_reason(reasons, weight)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return pending
+
+    def flush(self):
+        """
+        Write all pending assertions, and return the resolved Assertions in
+        the order they were first made.
+        """
+        batch, self.pending, self._by_key = self.pending, [], {}
+        if not batch:
+            return []
+        if assertion_module.CONTENT_IDS:
+            # Every assertion's id is known, so we can go straight to the
+            # upserts.
+            found = {}
+        else:
+            found = self._find_existing([p._key for p in batch])
+        self._create_missing([p for p in batch if p._key not in found], found)
+        for pending in batch:
+            pending._document = found[pending._key]
+        generalizations = {}
+        for pending in batch:
+            pending._replay(generalizations)
+        if generalizations:
+            from conceptdb.generalize import generalize_all
+            for reason, assertions in generalizations.items():
+                generalize_all(assertions, reason, self.batch_size)
+        return [pending._document for pending in batch]
+
+    def _find_existing(self, keys):
+        """
+        Look up a batch of natural keys with one query, returning a dictionary
+        from each key that exists to its Assertion.
+        """
+        wanted = set(key for key in keys
+                     if not ASSERTION_KEYS.known_missing(key))
+        if not wanted:
+            return {}
+        datasets, relations, polarities, argstrs, _ = \
+          [list(set(values)) for values in zip(*wanted)]
+        query = Assertion.objects(dataset__in=datasets,
+                                  relation__in=relations,
+                                  polarity__in=polarities,
+                                  argstr__in=argstrs)
+        found = {}
+        for assertion in query:
+            key = (assertion.dataset, assertion.relation, assertion.polarity,
+                   assertion.argstr, assertion.context)
+            if key in wanted:
+                found[key] = assertion
+                ASSERTION_KEYS.add(key, assertion.id)
+        return found
+
+    def _create_missing(self, batch, found):
+        collection = Assertion.objects._collection
+        operations = []
+        created = []
+        for pending in batch:
+            dataset, relation, polarity, argstr, context = pending._key
+            if assertion_module.CONTENT_IDS:
+                id = Assertion.content_id(pending._key)
+            else:
+                id = ObjectId()
+            assertion = Assertion(
+                id=id,
+                dataset=dataset,
+                relation=relation,
+                arguments=pending._arguments,
+                argstr=argstr,
+                complete=(BLANK not in pending._arguments),
+                context=context,
+                polarity=polarity,
+                **Assertion.positions(pending._arguments)
+            )
+            assertion.check_consistency()
+            assertion.validate()
+            son = assertion.to_mongo()
+            if assertion_module.CONTENT_IDS:
+                spec = {'_id': son.pop('_id')}
+            else:
+                spec = dict(dataset=dataset, relation=relation,
+                            polarity=polarity, argstr=argstr, context=context)
+            operations.append((spec, {'$setOnInsert': son}))
+            created.append(assertion)
+
+        inserted = bulk_upsert(collection, operations)
+        raced = []
+        for index, assertion in enumerate(created):
+            if index in inserted:
+                found[batch[index]._key] = assertion
+                assertion._persisted = True
+                ASSERTION_KEYS.add(batch[index]._key, assertion.id)
+                Assertion._made(batch[index]._key)
+                Log.record_new(assertion)
+            else:
+                # Someone else made this assertion since we looked (or, with
+                # content ids, at any time before).
+                raced.append(batch[index]._key)
+        found.update(self._find_existing(raced))
+
+class BulkImportMode(object):
+    """
+    Sets ConceptDB up to load a large amount of data, and puts things back
+    the way they were afterward. Use it through conceptdb.bulk_import_mode:
+
+        with conceptdb.bulk_import_mode():
+            import_assertions('en')
+
+    While it is on:
+
+    - ConceptDBDocument.save doesn't wait for each write to be acknowledged.
+      AssertionWriter still waits once per batch, because it needs to know
+      which of its upserts inserted something.
+    - Log entries are not written.
+    - Votes are not propagated as they are made (see
+      justify.propagate_votes); run conceptdb.inference.corona.refresh
+      afterward instead.
+    - The non-unique secondary indexes of `documents` are dropped, and they
+      are rebuilt when the `with` block ends. Unique indexes stay, because
+      they are what keeps the import from making duplicates, and so do the
+      indexes in LOOKUP_INDEXES, because importers find existing documents
+      through them.
+
+    At the end, it logs how many new documents of each kind were written
+    per second; the numbers are kept in `counts` and `elapsed`.
+
+    Nothing else should use the database in the meantime. Its queries would
+    be slow without the indexes, and it wouldn't see write errors.
+    """
+    # The indexes, by their fields, that an import looks documents up by:
+    # natural keys in AssertionWriter and Assertion.find_by_key, Sentence.make,
+    # Assertion.make_expression, and the upserts in count_reasons.
+    LOOKUP_INDEXES = {
+        Assertion: [('dataset', 'relation', 'polarity', 'argstr', 'context')],
+        Sentence: [('dataset',), ('text',)],
+        Expression: [('assertion',)],
+        ReasonConjunction: [('target',)],
+        ConfidenceValue: [('object_id',)],
+    }
+
+    def __init__(self, documents=None, safe=False, drop_indexes=True):
+        if documents is None:
+            documents = [Dataset, Assertion, Expression, Sentence,
+                         ReasonConjunction, ConfidenceValue]
+        self.documents = documents
+        self.safe = safe
+        self.drop_indexes = drop_indexes
+        self.dropped = {}
+        self.counts = {}
+        self.elapsed = None
+        self.index_time = None
+        self._meta_indexes = {}
+        self._start_counts = {}
+
+    def __enter__(self):
+        self._saved_safe = conceptdb.SAFE_WRITES
+        conceptdb.SAFE_WRITES = self.safe
+        self._saved_propagate = justify.PROPAGATE_VOTES
+        justify.propagate_votes(False)
+        Log.suspend()
+        for document in self.documents:
+            collection = document.objects._collection
+            self._start_counts[document] = collection.count()
+            if self.drop_indexes:
+                self._drop_indexes(document, collection)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = time.time() - self._start
+        if not self.safe:
+            # Unacknowledged writes report their errors here, if anywhere.
+            # getLastError is per connection, so ask the connection that
+            # the documents were written through.
+            databases = {}
+            for document in self.documents:
+                database = document.objects._collection.database
+                databases[database.name] = database
+            for database in databases.values():
+                error = database.error()
+                if error is not None:
+                    log.warning("Write failed during bulk import: %s"
+                                % error)
+        conceptdb.SAFE_WRITES = self._saved_safe
+        justify.propagate_votes(self._saved_propagate)
+        Log.resume()
+        start = time.time()
+        for document in self.documents:
+            self._restore_indexes(document)
+        self.index_time = time.time() - start
+        for document in self.documents:
+            self.counts[document.__name__] = \
+              document.objects._collection.count() \
+              - self._start_counts[document]
+        log.info(self.report())
+        return False
+
+    def _drop_indexes(self, document, collection):
+        # Stop mongoengine from making the indexes again the next time the
+        # collection is used.
+        self._meta_indexes[document] = document._meta['indexes']
+        document._meta['indexes'] = []
+        dropped = []
+        lookups = BulkImportMode.LOOKUP_INDEXES.get(document, [])
+        for name, info in collection.index_information().items():
+            if name == '_id_' or info.get('unique'):
+                continue
+            if tuple(field for field, _ in info['key']) in lookups:
+                continue
+            collection.drop_index(name)
+            dropped.append((name, info['key']))
+        self.dropped[document] = dropped
+
+    def _restore_indexes(self, document):
+        if document in self._meta_indexes:
+            document._meta['indexes'] = self._meta_indexes.pop(document)
+        collection = document.objects._collection
+        for name, key in self.dropped.pop(document, []):
+            collection.ensure_index(key, name=name)
+
+    def report(self):
+        """
+        Describe how fast the import went.
+        """
+        elapsed = max(self.elapsed, 1e-6)
+        lines = ['Bulk import took %.1fs, and rebuilding indexes took %.1fs.'
+                 % (self.elapsed, self.index_time or 0.0)]
+        for name, count in sorted(self.counts.items()):
+            lines.append('  %s: %d new, %.1f per second'
+                         % (name, count, count / elapsed))
+        return '\n'.join(lines)
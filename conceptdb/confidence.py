@@ -0,0 +1,223 @@
+"""
+A cache of confidence values, so that inference and the API don't ask
+MongoDB for a confidence they have already seen.
+
+ConfidenceValue.get and ReasonConjunction.update_node read through the
+process-wide cache CONFIDENCES. Confidences that are looked up together, such
+as the factors of a reason, are loaded with one query per collection.
+Confidences changed with `set` are only marked dirty, and are written back in
+batches by `flush`.
+
+Worker processes can share what they know through a SharedConfidences: a
+memory-mapped float array with one slot per name, for a list of names fixed
+when it is created.
+
+    shared = SharedConfidences.create('/tmp/confidences', names)
+    # in each worker:
+    CONFIDENCES.share(SharedConfidences.open('/tmp/confidences'))
+"""
+import codecs
+import numpy as np
+from conceptdb import keycache
+
+class SharedConfidences(object):
+    """
+    Confidences for a fixed list of names, in a file that several processes
+    can map at once. Slot i of the array holds the confidence of names[i],
+    or NaN if it isn't known yet. The names are kept next to the array, in
+    `path` + '.names'.
+    """
+    def __init__(self, path, names, array):
+        self.path = path
+        self.names = names
+        self.slots = dict((name, slot) for slot, name in enumerate(names))
+        self.array = array
+
+    @staticmethod
+    def create(path, names):
+        names = list(names)
+        out = codecs.open(path + '.names', 'w', encoding='utf-8')
+        for name in names:
+            out.write(name + u'\n')
+        out.close()
+        array = np.memmap(path, dtype=np.float64, mode='w+',
+                          shape=(max(len(names), 1),))
+        array[:] = np.nan
+        array.flush()
+        return SharedConfidences(path, names, array)
+
+    @staticmethod
+    def open(path):
+        names = [line.rstrip(u'\n') for line in
+                 codecs.open(path + '.names', encoding='utf-8')]
+        array = np.memmap(path, dtype=np.float64, mode='r+')
+        return SharedConfidences(path, names, array)
+
+    def slot(self, name):
+        return self.slots.get(name)
+
+    def flush(self):
+        self.array.flush()
+
+class ConfidenceCache(object):
+    """
+    Maps the names of reason targets to their confidence. Names that a
+    shared array has a slot for are kept there; the rest are kept in a dict
+    of at most `max_size` entries.
+
+    Entries changed with `set` are dirty until `flush` writes them to
+    MongoDB, which happens by itself once `batch_size` of them build up.
+    Call `invalidate` when confidences change behind the cache's back.
+    """
+    def __init__(self, shared=None, max_size=1000000, batch_size=1000):
+        self.shared = shared
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.values = {}
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        keycache.register(self)
+
+    def share(self, shared):
+        """
+        Start keeping confidences in a SharedConfidences.
+        """
+        self.flush()
+        self.shared = shared
+
+    def _lookup(self, name):
+        if self.shared is not None:
+            slot = self.shared.slot(name)
+            if slot is not None:
+                value = self.shared.array[slot]
+                if not np.isnan(value):
+                    return float(value)
+        return self.values.get(name)
+
+    def _store(self, name, confidence):
+        if self.shared is not None:
+            slot = self.shared.slot(name)
+            if slot is not None:
+                self.shared.array[slot] = confidence
+                return
+        self.values[name] = confidence
+
+    def get(self, name):
+        return self.get_many([name])[0]
+
+    def get_many(self, names):
+        """
+        Get the confidences of a list of names, in order, loading the ones
+        that aren't cached with one query per collection.
+        """
+        results = [self._lookup(name) for name in names]
+        missing = [name for name, value in zip(names, results)
+                   if value is None]
+        self.hits += len(names) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            loaded = self._load(missing)
+            results = [loaded[name] if value is None else value
+                       for name, value in zip(names, results)]
+        return results
+
+    def _load(self, names):
+        from conceptdb.justify import ConfidenceValue, counter_location
+        found = dict((name, ConfidenceValue.DEFAULT_CONFIDENCE)
+                     for name in names)
+        groups = {}
+        for name in set(names):
+            location = counter_location(name)
+            if location is None: continue
+            collection, field, key, _ = location
+            group = groups.setdefault(collection.name,
+                                      (collection, field, {}))
+            group[2][key] = name
+        for collection, field, keys in groups.values():
+            cursor = collection.find({field: {'$in': keys.keys()}},
+                                     fields=[field, 'confidence'])
+            for doc in cursor:
+                if doc.get('confidence') is not None:
+                    found[keys[doc[field]]] = doc['confidence']
+        self._shrink()
+        for name, confidence in found.items():
+            self._store(name, confidence)
+        return found
+
+    def remember(self, name, confidence):
+        """
+        Cache a confidence that MongoDB already has.
+        """
+        self._store(name, confidence)
+
+    def set(self, name, confidence):
+        """
+        Change a confidence, to be written to MongoDB by a later flush.
+        """
+        self._store(name, confidence)
+        self.dirty.add(name)
+        if len(self.dirty) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every dirty confidence to the document it belongs to, or to
+        its ConfidenceValue.
+        """
+        from conceptdb.justify import ConfidenceValue, counter_location
+        from conceptdb.bulk import bulk_update, bulk_upsert
+        dirty, self.dirty = self.dirty, set()
+        groups = {}
+        for name in dirty:
+            location = counter_location(name)
+            if location is None: continue
+            collection, field, key, upsert = location
+            spec = {field: key}
+            if field == 'object_id':
+                spec = dict(ConfidenceValue.objects._query, **spec)
+            group = groups.setdefault(collection.name,
+                                      (collection, upsert, []))
+            group[2].append((spec,
+                             {'$set': {'confidence': self._lookup(name)}}))
+        for collection, upsert, operations in groups.values():
+            if upsert:
+                bulk_upsert(collection, operations)
+            else:
+                bulk_update(collection, operations)
+        if self.shared is not None:
+            self.shared.flush()
+
+    def invalidate(self, names=None):
+        """
+        Forget the cached confidences of some names, or of everything.
+        Dirty entries are written first.
+        """
+        self.flush()
+        if names is None:
+            self.values.clear()
+            if self.shared is not None:
+                self.shared.array[:] = np.nan
+            return
+        for name in names:
+            self.values.pop(name, None)
+            if self.shared is not None:
+                slot = self.shared.slot(name)
+                if slot is not None:
+                    self.shared.array[slot] = np.nan
+
+    def _shrink(self):
+        if len(self.values) >= self.max_size:
+            self.flush()
+            self.values.clear()
+
+    def clear(self):
+        """
+        Forget everything, including changes that haven't been flushed.
+        keycache.reset_all flushes them first.
+        """
+        self.dirty.clear()
+        self.values.clear()
+        self.shared = None
+
+CONFIDENCES = ConfidenceCache()
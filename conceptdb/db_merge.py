@@ -1,7 +1,12 @@
 import conceptdb
+from conceptdb import raw
 from conceptdb.metadata import Dataset
 from conceptdb.assertion import Assertion
-from conceptdb.justify import ReasonConjunction
+from conceptdb import assertion as assertion_module
+from conceptdb.justify import ReasonConjunction, count_reasons, \
+  reason_weight
+from conceptdb.confidence import CONFIDENCES
+from conceptdb import factor_index
 from mongoengine.queryset import QuerySet
 
 '''
@@ -19,146 +24,109 @@ TODO:
 - Fix db_merge tests ... tests can't take arguments! (nosetests)
 
 '''
-def merge(db1, db2, dataset=None):
+def merge(db1, db2, dataset=None, batch_size=1000):
     ''' 
-    Loop over both of the DBs to find assertions that are not present in each, and 
-    reasons that point to those assertions
+    Copy the assertions that are in only one of the DBs into the other, along
+    with the reasons that point to them, and add reasons that the other DB is
+    missing to assertions that are in both.
+
+    db1 and db2 are connection aliases (see conceptdb.register_connection);
+    an unregistered alias is taken to be a database name with the default
+    settings. Nothing here changes the global connection, so both DBs are
+    read and written without reconnecting.
     '''
-    db1_tobeadded = []
-    db2_tobeadded = []
-    
-    if dataset == None:
-        conceptdb.connect_to_mongodb(db1)
-        db1_assertions = Assertion.objects
-        conceptdb.connect_to_mongodb(db2)
-        db2_assertions = Assertion.objects
-    else:
-        conceptdb.connect_to_mongodb(db1)
-        db1_assertions = Assertion.objects.filter(dataset=dataset)
-        conceptdb.connect_to_mongodb(db2)
-        db2_assertions = Assertion.objects.filter(dataset=dataset)
-        
-    # Looping to find assertions in DB1 that are not in DB2
-    for db1_a in [a1 for a1 in list(db1_assertions) if a1 not in list(db2_assertions)]:
-        conceptdb.connect_to_mongodb(db1)
-        # New assertions, along with the reasons
-        db2_tobeadded.append((db1_a, ReasonConjunction.objects.filter(target=db1_a.name)))
-        # Check that each assertion does not exist in the DB with a different Assertion ID
-        for db2_check in list(db2_assertions):
-            if assertion_check(db1_a, db2_check):
-                # Do not add multiple assertions
-                db2_tobeadded.pop()
-                # But DO add new reasons that point to existing assertions
-                if ReasonConjunction.objects.filter(target=db1_a.name) is not None:
-                    db2_tobeadded.append((None, (ReasonConjunction.objects.filter(target=db1_a.name), db2_check)))
-                break         
-    # Looping to find assertions in DB2 that are not in DB1
-    for db2_a in [a2 for a2 in list(db2_assertions) if a2 not in list(db1_assertions)]:
-        conceptdb.connect_to_mongodb(db2)
-        # New assertions, along with the reasons
-        db1_tobeadded.append((db2_a, ReasonConjunction.objects.filter(target=db2_a.name)))
-        # Check that each assertion does not exist in the DB with a different Assertion ID
-        for db1_check in list(db1_assertions):
-            if assertion_check(db2_a, db1_check):
-                # Do not add multiple assertions
-                db1_tobeadded.pop()
-                # But DO add new reasons that point to existing assertions
-                if ReasonConjunction.objects.filter(target=db2_a.name) is not None:
-                    db1_tobeadded.append((None, (ReasonConjunction.objects.filter(target=db2_a.name), db1_check)))
-                break
-   
+    conceptdb.get_database(db1)
+    conceptdb.get_database(db2)
+    query = {}
+    if dataset is not None:
+        query['dataset'] = dataset
+
+    copy_missing(db1, db2, query, batch_size)
+    copy_missing(db2, db1, query, batch_size)
+
+    return (Assertion.using(db1).filter(**query),
+            Assertion.using(db2).filter(**query))
+
+def content_id(key):
+    # Keep ids content-addressed in databases that use them.
+    if assertion_module.CONTENT_IDS:
+        return Assertion.content_id(key)
+    return None
+
+def natural_key(record):
+    return (record.dataset, record.relation, record.polarity, record.argstr,
+            record.context)
+
+def copy_missing(source, dest, query, batch_size=1000):
     '''
-    Step through db1_tobeadded and db2_tobeadded, lists of elements that have to be added
-    from each DB to the other, and add all of the assertions and corresponding reasons to the 
-    DBs
+    Copy into `dest` the assertions matching `query` that are in `source` but
+    not in `dest`, and the reasons for them that `dest` doesn't have. Reasons
+    are read for `batch_size` assertions at a time.
     '''
-    # Adding to DB1
-    conceptdb.connect_to_mongodb(db1)       
-    for (add1,rel1) in db1_tobeadded:
-        if add1 == None:
-            for r1 in list(rel1[0]):
-                factors_db1 = []
-                for factor in r1.factors:
-                    if type(factor) == Assertion:
-                        factors_db1.append(db1_assertions.create(
-                                              dataset=factor.dataset,
-                                              relation=factor.relation,
-                                              polarity=factor.polarity,
-                                              argstr=factor.argstr,
-                                              context=factor.context,
-                                              complete=1))
-                    else:
-                        factors_db1.append(factor)
-                if ReasonConjunction.objects.filter(target=rel1[1],factors=factors_db1,weight=r1.weight) ==None:
-                    rel1[1].add_support(factors_db1)
-            continue
-        ass1 = db1_assertions.create(
-                              dataset=add1.dataset,
-                              relation=add1.relation,
-                              polarity=add1.polarity,
-                              argstr=add1.argstr,
-                              context=add1.context,
-                              complete=1
-                              )
-        for r1 in list(rel1):
-            factors_db1 = []
-            for factor in r1.factors:
-                if type(factor) == Assertion:
-                    factors_db1.append(db1_assertions.create(
-                                              dataset=factor.dataset,
-                                              relation=factor.relation,
-                                              polarity=factor.polarity,
-                                              argstr=factor.argstr,
-                                              context=factor.context,
-                                              complete=1))
-                else:
-                    factors_db1.append(factor)
-            ass1.add_support(factors_db1)
-    # Adding to DB2
-    conceptdb.connect_to_mongodb(db2)
-    for (add2,rel2) in db2_tobeadded:
-        if add2 == None:
-            for r2 in list(rel2[0]):
-                factors_db2 = []
-                for factor in r2.factors:
-                    if type(factor) == Assertion:
-                        factors_db2.append(db2_assertions.create(
-                                              dataset=factor.dataset,
-                                              relation=factor.relation,
-                                              polarity=factor.polarity,
-                                              argstr=factor.argstr,
-                                              context=factor.context,
-                                              complete=1))
-                    else:
-                        factors_db2.append(factor)
-                if ReasonConjunction.objects.filter(target=rel2[1],factors=factors_db2,weight=r2.weight) ==None:
-                    rel2[1].add_support(factors_db2)
-            continue
-        ass2 = db2_assertions.create(
-                              dataset=add2.dataset,
-                              relation=add2.relation,
-                              polarity=add2.polarity,
-                              argstr=add2.argstr,
-                              context=add2.context,
-                              complete=1
-                              )
-        for r2 in list(rel2):
-            factors_db2 = []
-            for factor in r2.factors:
-                if type(factor) == Assertion:
-                    factors_db2.append(db2_assertions.create(
-                                              dataset=factor.dataset,
-                                              relation=factor.relation,
-                                              polarity=factor.polarity,
-                                              argstr=factor.argstr,
-                                              context=factor.context,
-                                              complete=1))
-                else:
-                    factors_db2.append(factor)
-            ass2.add_support(factors_db2)
-        
-    return (db1_assertions, db2_assertions)
+    dest_names = {}
+    for record in raw.assertions(using=dest, **query):
+        dest_names[natural_key(record)] = record.name
+
+    # Map the name of each source assertion to the name of the same
+    # assertion in dest, copying it over if it isn't there.
+    renamed = {}
+    for record in raw.assertions(using=source, **query):
+        key = natural_key(record)
+        if key not in dest_names:
+            new_assertion = Assertion(
+                id=content_id(key),
+                dataset=record.dataset,
+                relation=record.relation,
+                arguments=record.arguments,
+                argstr=record.argstr,
+                complete=record.complete,
+                context=record.context,
+                polarity=record.polarity,
+                **Assertion.positions(record.arguments)
+            )
+            new_assertion.save_to(dest)
+            dest_names[key] = new_assertion.name
+        renamed[record.name] = dest_names[key]
+
+    if not renamed:
+        return
+    # Look reasons up by batches of targets, to keep each query well under
+    # MongoDB's limit on the size of a document.
+    dest_targets = list(set(renamed.values()))
+    existing = set()
+    for start in xrange(0, len(dest_targets), batch_size):
+        batch = dest_targets[start:start+batch_size]
+        for reason in raw.reasons(using=dest, spec={'target': {'$in': batch}}):
+            existing.add((reason.target, frozenset(reason.factors or [])))
 
+    source_targets = list(renamed.keys())
+    for start in xrange(0, len(source_targets), batch_size):
+        batch = source_targets[start:start+batch_size]
+        # Count the copied reasons toward their targets' running sums and
+        # add them to the factor index in dest, as ReasonConjunction.make
+        # would.
+        increments = {}
+        uses = []
+        for reason in raw.reasons(using=source, spec={'target': {'$in': batch}}):
+            target = renamed[reason.target]
+            factors = [renamed.get(factor, factor)
+                       for factor in reason.factors or []]
+            if (target, frozenset(factors)) in existing:
+                continue
+            ReasonConjunction(target=target, factors=factors, vote=reason.vote,
+                              weight=reason.weight,
+                              factor_key=ReasonConjunction.make_factor_key(factors)
+                              ).save_to(dest)
+            existing.add((target, frozenset(factors)))
+            vote_sum, weight_sum = increments.get(target, (0.0, 0.0))
+            increments[target] = (vote_sum + (reason.vote or 0.0),
+                                  weight_sum + reason_weight(reason.weight))
+            uses.append((target, factors))
+        count_reasons(increments, using=dest)
+        factor_index.add_uses(uses, using=dest)
+        # dest may be the default database, whose cached confidences are
+        # now out of date.
+        CONFIDENCES.invalidate(increments.keys())
 
         
 '''
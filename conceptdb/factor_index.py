@@ -0,0 +1,154 @@
+"""
+A reverse index from each reason factor to the targets it is used to justify.
+
+Finding what a factor justifies would otherwise mean scanning every
+ReasonConjunction that has it, which for a dataset's root reason or a
+prolific contributor is millions of rows. Instead, whenever a reason is made
+or deleted, its factors' entries here are updated:
+
+- a FactorUse per factor counts its targets by kind ('assertion',
+  'expression', 'sentence' or 'other')
+- FactorPages hold the targets themselves, in pages of at most PAGE_SIZE
+  per factor and kind
+
+so that `used_for` can answer with the counts and one page of targets in two
+indexed queries.
+"""
+import mongoengine as mon
+from conceptdb import ConceptDBDocument
+
+PAGE_SIZE = 1000
+KINDS = ('assertion', 'expression', 'sentence', 'other')
+
+def target_kind(target):
+    parts = target.split('/', 2)
+    if len(parts) == 3 and parts[1] in KINDS:
+        return parts[1]
+    return 'other'
+
+class FactorUse(ConceptDBDocument, mon.Document):
+    """
+    How many targets of each kind a factor is used to justify.
+    """
+    factor = mon.StringField(primary_key=True)
+    counts = mon.DictField()
+    # how many targets of each kind have ever been added, which says which
+    # page the next one goes on
+    added = mon.DictField()
+
+    def check_consistency(self):
+        pass
+
+class FactorPage(ConceptDBDocument, mon.Document):
+    """
+    One page of the targets of a given kind that a factor justifies.
+    """
+    factor = mon.StringField()
+    kind = mon.StringField()
+    page = mon.IntField()
+    targets = mon.ListField(mon.StringField())
+
+    meta = {'indexes': [('factor', 'kind', 'page')]}
+
+    def check_consistency(self):
+        pass
+
+def add_uses(reasons, using=None):
+    """
+    Index a batch of new reasons, given as (target, factors) pairs. Takes
+    one round trip per factor and kind, and one batch of page updates.
+    With `using`, the index in the database registered under that alias
+    (see conceptdb.register_connection) is updated instead of the default
+    one.
+    """
+    from conceptdb.bulk import bulk_upsert
+    groups = {}
+    for target, factors in reasons:
+        kind = target_kind(target)
+        for factor in set(factors):
+            groups.setdefault((factor, kind), []).append(target)
+    if not groups:
+        return
+
+    if using is None:
+        uses = FactorUse.objects._collection
+        pages = FactorPage.objects._collection
+    else:
+        uses = FactorUse.using(using)._collection
+        pages = FactorPage.using(using)._collection
+    use_spec = FactorUse.objects._query
+    page_spec = FactorPage.objects._query
+    operations = []
+    for (factor, kind), targets in groups.iteritems():
+        # Reserve positions for the new targets.
+        inc = {'counts.' + kind: len(targets), 'added.' + kind: len(targets)}
+        before = uses.find_and_modify(query=dict(use_spec, _id=factor),
+                                      update={'$inc': inc},
+                                      upsert=True, new=False)
+        start = ((before or {}).get('added') or {}).get(kind, 0)
+        positions = {}
+        for position, target in enumerate(targets, start):
+            positions.setdefault(position // PAGE_SIZE, []).append(target)
+        for page, page_targets in positions.iteritems():
+            operations.append((dict(page_spec, factor=factor, kind=kind,
+                                    page=page),
+                               {'$push': {'targets': {'$each': page_targets}}}))
+    bulk_upsert(pages, operations)
+
+def add_use(target, factors):
+    add_uses([(target, factors)])
+
+def remove_use(target, factors, using=None):
+    """
+    Take a deleted reason out of the index, in the database registered as
+    `using` if it is given, as in add_uses.
+    """
+    kind = target_kind(target)
+    if using is None:
+        uses = FactorUse.objects._collection
+        pages = FactorPage.objects._collection
+    else:
+        uses = FactorUse.using(using)._collection
+        pages = FactorPage.using(using)._collection
+    for factor in set(factors):
+        uses.update({'_id': factor}, {'$inc': {'counts.' + kind: -1}})
+        pages.update({'factor': factor, 'kind': kind},
+                     {'$pull': {'targets': target}}, multi=True)
+
+def used_for(factor, page=0, kinds=KINDS):
+    """
+    Get what a factor is used to justify: a dictionary of counts by kind,
+    and a dictionary from each kind to its targets on the given page.
+    """
+    use = FactorUse.objects._collection.find_one({'_id': factor},
+                                                 fields=['counts'])
+    counts = dict((kind, 0) for kind in kinds)
+    if use is not None:
+        for kind, count in (use.get('counts') or {}).items():
+            if kind in counts:
+                counts[kind] = count
+    targets = dict((kind, []) for kind in kinds)
+    cursor = FactorPage.objects._collection.find(
+      {'factor': factor, 'kind': {'$in': list(kinds)}, 'page': page},
+      fields=['kind', 'targets'])
+    for doc in cursor:
+        targets[doc['kind']] = doc['targets']
+    return counts, targets
+
+def rebuild(batch_size=10000):
+    """
+    Build the index from scratch out of every ReasonConjunction, for
+    databases made before it existed, or after ids have been migrated.
+    """
+    from conceptdb import raw
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+    batch = []
+    for reason in raw.reasons(fields=['target', 'factors'],
+                              batch_size=batch_size):
+        if reason.target is None: continue
+        batch.append((reason.target, reason.factors or []))
+        if len(batch) >= batch_size:
+            add_uses(batch)
+            batch = []
+    add_uses(batch)
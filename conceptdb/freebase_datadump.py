@@ -30,7 +30,9 @@ if __name__ ==  "__main__":
     
     print len(Assertion.objects)
     prev_len = len(Assertion.objects)
-    fb_datadumpread("freebase-simple-topic-dump.tsv")
+    with conceptdb.bulk_import_mode() as mode:
+        fb_datadumpread("freebase-simple-topic-dump.tsv")
+    print mode.report()
 
     
     print '%d assertions made.'%(len(Assertion.objects)-prev_len)
@@ -1,5 +1,6 @@
 import mongoengine as mon
 from conceptdb.assertion import Assertion
+from conceptdb.bulk import AssertionWriter
 from conceptdb.metadata import Dataset
 from mongoengine.queryset import DoesNotExist
 from freebase.api.session import MetawebError, HTTPMetawebSession
@@ -55,42 +56,43 @@ class MQLQuery():
         if type(results)==list:
             results = results[0]
         
-        for key in self.query_args.keys():
-            initial_assertion = Assertion.make(dataset.name, '/rel/freebase/has%s'%key.capitalize(), [self.query_args['id'],self.query_args[key]])
-            initial_assertion.add_support(dataset.name + '/contributor/' + user)
-            assertionscreated.append(initial_assertion)
-        #print 'MADE INITIAL ASSERTION'
-        # Go through all properties, excluding properties in the skip_props list and properties whose results are not of type list  
-        for property in [r for r in results if r not in self.skip_props and r not in self.query_args.keys()]:
-            # Use properties to index concepts, and only use concepts with an explicit 'mmid' field
-            if type(results[property])==list:
-                for value in results[property]:
-                    try:
-                        #print self.query_args['id']
-                        #print value['id']
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],value['id']])
-                    except:
-                        #print self.query_args['id']
-                        #print value['id']
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],value['value']])
+        with AssertionWriter() as writer:
+            for key in self.query_args.keys():
+                initial_assertion = writer.make(dataset.name, '/rel/freebase/has%s'%key.capitalize(), [self.query_args['id'],self.query_args[key]])
+                initial_assertion.add_support(dataset.name + '/contributor/' + user)
+                assertionscreated.append(initial_assertion)
+            #print 'MADE INITIAL ASSERTION'
+            # Go through all properties, excluding properties in the skip_props list and properties whose results are not of type list  
+            for property in [r for r in results if r not in self.skip_props and r not in self.query_args.keys()]:
+                # Use properties to index concepts, and only use concepts with an explicit 'mmid' field
+                if type(results[property])==list:
+                    for value in results[property]:
+                        try:
+                            #print self.query_args['id']
+                            #print value['id']
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],value['id']])
+                        except:
+                            #print self.query_args['id']
+                            #print value['id']
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],value['value']])
                 
-                    a.add_support(dataset.name + '/contributor/' + user)
-                    assertionscreated.append(a)
-            else:
-                #print results[property]
-                try:
-                    a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],results[property]['value']])
-                    a.add_support(dataset.name + '/contributor/' + 'nholm')
-                    assertionscreated.append(a)
-                except:
-                    #print 'second exception'
-                    #a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mmid'],results[property]['mmid']])
+                        a.add_support(dataset.name + '/contributor/' + user)
+                        assertionscreated.append(a)
+                else:
+                    #print results[property]
                     try:
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],results[property]['id']])
+                        a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],results[property]['value']])
                         a.add_support(dataset.name + '/contributor/' + 'nholm')
                         assertionscreated.append(a)
                     except:
-                        pass
+                        #print 'second exception'
+                        #a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mmid'],results[property]['mmid']])
+                        try:
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['id'],results[property]['id']])
+                            a.add_support(dataset.name + '/contributor/' + 'nholm')
+                            assertionscreated.append(a)
+                        except:
+                            pass
             
         return assertionscreated
     
@@ -114,32 +116,33 @@ class MQLQuery():
         # start importing from freebase
         mss = HTTPMetawebSession("http://api.freebase.com")
         
-        for searchterm in self.result_args:
-            query[0][searchterm]={}
-            try:    
-                results = mss.mqlread(query)
-                a = Assertion.make(dataset.name, '/rel/freebase/has%s'%searchterm.capitalize(), [self.query_args['id'],results[0][searchterm]['id']])
-                a.add_support(dataset.name + '/contributor/' + user)           
-                assertionscreated.append(a)
-        
-            except MetawebError as me1:
-                if str(me1.args).rfind('/api/status/error/mql/result') is not -1:
-                    query[0][searchterm]=[{}]
+        with AssertionWriter() as writer:
+            for searchterm in self.result_args:
+                query[0][searchterm]={}
+                try:    
                     results = mss.mqlread(query)
-                    for result in results[0][searchterm]:
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%searchterm.capitalize(), [self.query_args['id'],result['id']])
-                        a.add_support(dataset.name + '/contributor/' + user)
-                        assertionscreated.append(a)
+                    a = writer.make(dataset.name, '/rel/freebase/has%s'%searchterm.capitalize(), [self.query_args['id'],results[0][searchterm]['id']])
+                    a.add_support(dataset.name + '/contributor/' + user)           
+                    assertionscreated.append(a)
+        
+                except MetawebError as me1:
+                    if str(me1.args).rfind('/api/status/error/mql/result') is not -1:
+                        query[0][searchterm]=[{}]
+                        results = mss.mqlread(query)
+                        for result in results[0][searchterm]:
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%searchterm.capitalize(), [self.query_args['id'],result['id']])
+                            a.add_support(dataset.name + '/contributor/' + user)
+                            assertionscreated.append(a)
                 
-                elif str(me1.args).rfind('/api/status/error/mql/type') is not -1:
-                    print 'The property %s is not recognized.' % searchterm
-                    return
+                    elif str(me1.args).rfind('/api/status/error/mql/type') is not -1:
+                        print 'The property %s is not recognized.' % searchterm
+                        return
             
-                else:
-                    print str(me1.args)
-                    return
+                    else:
+                        print str(me1.args)
+                        return
         
-            del query[0][searchterm]
+                del query[0][searchterm]
         return assertionscreated
     
     def fb_all_from_id(self, dset, user, polarity=1, context=None):
@@ -211,37 +214,38 @@ class MQLQuery():
         #    initial_assertion.add_support(dataset.name + '/contributor/' + user)
         #    assertionscreated.append(initial_assertion)
         
-        for property in [r for r in results if r not in self.skip_props and r not in self.query_args.keys()]:
-            #print property
+        with AssertionWriter() as writer:
+            for property in [r for r in results if r not in self.skip_props and r not in self.query_args.keys()]:
+                #print property
             
-            if type(results[property])==list:
-                for value in results[property]:
-                    try:
-                        #print self.query_args['id']
-                        #print value['id']
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],value['id']])
-                    except:
-                        #print self.query_args['id']
-                        #print value['id']
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],value['value']])
+                if type(results[property])==list:
+                    for value in results[property]:
+                        try:
+                            #print self.query_args['id']
+                            #print value['id']
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],value['id']])
+                        except:
+                            #print self.query_args['id']
+                            #print value['id']
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],value['value']])
                 
-                    a.add_support(dataset.name + '/contributor/' + user)
-                    assertionscreated.append(a)
-            else:
-                #print results[property]
-                try:
-                    a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],results[property]['value']])
-                    a.add_support(dataset.name + '/contributor/' + 'nholm')
-                    assertionscreated.append(a)
-                except:
-                    #print 'second exception'
-                    #a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mmid'],results[property]['mmid']])
+                        a.add_support(dataset.name + '/contributor/' + user)
+                        assertionscreated.append(a)
+                else:
+                    #print results[property]
                     try:
-                        a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],results[property]['id']])
+                        a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],results[property]['value']])
                         a.add_support(dataset.name + '/contributor/' + 'nholm')
                         assertionscreated.append(a)
                     except:
-                        pass
+                        #print 'second exception'
+                        #a = Assertion.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mmid'],results[property]['mmid']])
+                        try:
+                            a = writer.make(dataset.name, '/rel/freebase/has%s'%property.capitalize(), [self.query_args['mid'],results[property]['id']])
+                            a.add_support(dataset.name + '/contributor/' + 'nholm')
+                            assertionscreated.append(a)
+                        except:
+                            pass
         return assertionscreated
     
     def fb_all_from_mid(self, dset, user, polarity=1, context=None):
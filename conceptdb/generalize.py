@@ -0,0 +1,196 @@
+"""
+Makes the generalizations of many assertions at once.
+
+An assertion with n specific arguments has 2^n - 1 generalizations, in which
+some of those arguments are replaced by BLANK, and each of its expressions
+has a generalized expression to go with each one. Making them one pattern at
+a time would take several queries per pattern. Instead, the generalized
+assertions and expressions for a whole batch of sources are worked out in
+memory and deduplicated, then written with a few bulk upserts, along with
+the ReasonConjunctions that justify them. Assertion.make_generalizations
+does this for a single assertion.
+"""
+from pymongo.objectid import ObjectId
+from pymongo.dbref import DBRef
+from conceptdb.assertion import Assertion, Expression, BLANK
+from conceptdb import assertion as assertion_module
+from conceptdb.bulk import AssertionWriter, bulk_upsert
+from conceptdb.justify import ReasonConjunction, count_reasons, \
+  reason_weight
+from conceptdb.util import ensure_reference, outer_iter
+from conceptdb import factor_index
+from log import Log
+
+def patterns(arguments):
+    """
+    Yield the generalization patterns for a list of arguments: tuples saying
+    which arguments to replace with BLANK. Arguments that are already blank
+    stay blank, and the pattern that replaces nothing is skipped.
+    """
+    pattern_pieces = []
+    for arg in arguments:
+        if arg == BLANK:
+            pattern_pieces.append((False,))
+        else:
+            pattern_pieces.append((True, False))
+    for pattern in outer_iter(pattern_pieces):
+        if True in pattern:
+            yield pattern
+
+def apply_pattern(arguments, pattern):
+    return [BLANK if drop else arg for arg, drop in zip(arguments, pattern)]
+
+def generalize_all(assertions, reason, batch_size=1000):
+    """
+    Make every generalization of the given assertions and of their
+    expressions. Each one is supported by `reason` together with the
+    assertion or expression it generalizes. The sources must already be in
+    the database.
+
+    Returns the generalized Assertions, in no particular order. With
+    virtual generalizations on (see conceptdb.virtual), there is nothing to
+    store, and this returns an empty list.
+    """
+    if assertion_module.VIRTUAL_GENERALIZATIONS:
+        return []
+    reason = ensure_reference(reason)
+    sources = []
+    seen = set()
+    for source in assertions:
+        if source.id not in seen:
+            seen.add(source.id)
+            sources.append(source)
+    if not sources:
+        return []
+
+    # natural key -> (PendingAssertion, names of the sources it generalizes)
+    generalized = {}
+    # (source, [(pattern, natural key of the generalization)])
+    source_patterns = []
+    with AssertionWriter(batch_size) as writer:
+        for source in sources:
+            made = []
+            for pattern in patterns(source.arguments):
+                args = apply_pattern(source.arguments, pattern)
+                key = Assertion.make_key(source.dataset, source.relation,
+                                         args, source.polarity,
+                                         source.context)
+                if key not in generalized:
+                    pending = writer.make(source.dataset, source.relation,
+                                          args, source.polarity,
+                                          source.context)
+                    generalized[key] = (pending, [])
+                generalized[key][1].append(source.name)
+                made.append((pattern, key))
+            source_patterns.append((source, made))
+
+    results = {}
+    reasons = []
+    for key, (pending, source_names) in generalized.iteritems():
+        results[key] = pending.resolve()
+        for name in source_names:
+            reasons.append((results[key].name, [reason, name]))
+    reasons.extend(generalize_expressions(source_patterns, results, reason))
+    support_all(reasons)
+    return results.values()
+
+def generalize_expressions(source_patterns, results, reason):
+    """
+    Make the generalized expressions for generalize_all, and return the
+    (target, factors) pairs of the reasons that support them.
+    """
+    collection = Expression.objects._collection
+    assertion_collection = Assertion.objects._collection.name
+    def ref(id):
+        return DBRef(assertion_collection, id)
+
+    # Get the expressions of every source in one query.
+    by_assertion = {}
+    spec = {'assertion': {'$in': [ref(source.id)
+                                  for source, _ in source_patterns]}}
+    fields = ['assertion', 'frame', 'arguments', 'language']
+    for son in collection.find(spec, fields=fields):
+        by_assertion.setdefault(son['assertion'].id, []).append(son)
+
+    # (assertion id, language, frame, text) -> (Expression, source names)
+    wanted = {}
+    for source, made in source_patterns:
+        for son in by_assertion.get(source.id, []):
+            for pattern, key in made:
+                assertion = results[key]
+                args = apply_pattern(son['arguments'], pattern)
+                text = Expression.replace_args(son['frame'], args)
+                ekey = (assertion.id, son['language'], son['frame'], text)
+                if ekey not in wanted:
+                    expr = Expression.make(assertion, son['frame'], args,
+                                           son['language'])
+                    wanted[ekey] = (expr, [])
+                wanted[ekey][1].append('/expression/%s' % son['_id'])
+    if not wanted:
+        return []
+
+    items = wanted.items()
+    operations = []
+    for (assertion_id, language, frame, text), (expr, _) in items:
+        expr.id = ObjectId()
+        expr.check_consistency()
+        expr.validate()
+        spec = {'assertion': ref(assertion_id), 'language': language,
+                'frame': frame, 'text': text}
+        operations.append((spec, {'$setOnInsert': expr.to_mongo()}))
+    inserted = bulk_upsert(collection, operations)
+
+    names = {}
+    existing = []
+    for index, (ekey, (expr, _)) in enumerate(items):
+        if index in inserted:
+            expr._persisted = True
+            Log.record_new(expr)
+            names[ekey] = expr.name
+        else:
+            existing.append(ekey)
+    if existing:
+        # These were made before; find out what their ids are.
+        spec = {'assertion': {'$in': list(set(ref(ekey[0])
+                                              for ekey in existing))}}
+        fields = ['assertion', 'language', 'frame', 'text']
+        for son in collection.find(spec, fields=fields):
+            ekey = (son['assertion'].id, son['language'], son['frame'],
+                    son['text'])
+            names[ekey] = '/expression/%s' % son['_id']
+
+    reasons = []
+    for ekey, (expr, source_names) in items:
+        for name in source_names:
+            reasons.append((names[ekey], [reason, name]))
+    return reasons
+
+def support_all(reasons, vote=1.0):
+    """
+    Make a ReasonConjunction for each (target, factors) pair, as
+    ReasonConjunction.make would, using one batch of upserts. Reasons that
+    exist already are left as they are.
+    """
+    collection = ReasonConjunction.objects._collection
+    operations = []
+    made = []
+    for target, factors in reasons:
+        target = ensure_reference(target)
+        factors = [ensure_reference(f) for f in factors]
+        factor_key = ReasonConjunction.make_factor_key(factors)
+        r = ReasonConjunction(id=ObjectId(), target=target, factors=factors,
+                              factor_key=factor_key, vote=vote)
+        operations.append(({'target': target, 'factor_key': factor_key},
+                           {'$setOnInsert': r.to_mongo()}))
+        made.append(r)
+    inserted = bulk_upsert(collection, operations)
+    increments = {}
+    factor_index.add_uses([(made[index].target, made[index].factors)
+                           for index in inserted])
+    for index in inserted:
+        made[index]._persisted = True
+        Log.record_new(made[index])
+        vote_sum, weight_sum = increments.get(made[index].target, (0.0, 0.0))
+        increments[made[index].target] = (vote_sum + vote,
+                                          weight_sum + reason_weight(None))
+    count_reasons(increments)
@@ -0,0 +1,86 @@
+"""
+An identity map for ConceptDB documents.
+
+Within a session, looking up the same document by its id more than once
+returns the same object, and only the first lookup goes to MongoDB. Sessions
+are meant to be short-lived, covering one import step or one API request:
+
+    with conceptdb.session():
+        a = Assertion.get(id)
+        ...
+"""
+from collections import OrderedDict
+import threading
+
+_local = threading.local()
+
+def current_session():
+    """
+    Get the innermost active session in this thread, or None.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+def document_key(cls, key):
+    return (cls, unicode(key))
+
+class Session(object):
+    """
+    A size-limited identity map from (document class, id) to document. When
+    it grows past `max_size`, the least recently used documents are evicted.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._documents = OrderedDict()
+
+    def __enter__(self):
+        if getattr(_local, 'stack', None) is None:
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.stack.remove(self)
+        self.clear()
+        return False
+
+    def __len__(self):
+        return len(self._documents)
+
+    def get(self, cls, key):
+        """
+        Get the document of class `cls` with id `key`, or None if this
+        session doesn't have it.
+        """
+        dkey = document_key(cls, key)
+        doc = self._documents.pop(dkey, None)
+        if doc is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._documents[dkey] = doc
+        return doc
+
+    def put(self, doc):
+        """
+        Remember a document, replacing whatever this session had with the
+        same id.
+        """
+        dkey = document_key(doc.__class__, doc[doc._meta['id_field']])
+        self._documents.pop(dkey, None)
+        self._documents[dkey] = doc
+        while len(self._documents) > self.max_size:
+            self._documents.popitem(last=False)
+
+    def discard(self, cls, key):
+        """
+        Forget the document of class `cls` with id `key`, if there is one.
+        """
+        self._documents.pop(document_key(cls, key), None)
+
+    def clear(self):
+        self._documents.clear()
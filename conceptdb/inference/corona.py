@@ -0,0 +1,147 @@
+"""
+CORONA: Computation of Reliability of Networked Agents, in the revised form
+described in doc/corona2.tex.
+
+Every node has a confidence (its "node weight") between 0 and 1. Each reason
+is an edge from its factors to its target, whose strength is the Hamacher
+product of its factors' confidences and whose "edge weight" is its vote. A
+node's confidence is a weighted average of:
+
+- a prior: one vote at DEFAULT_CONFIDENCE, with DEFAULT_WEIGHT
+- the votes of the reasons for it, weighted by their strength and weight
+- the confidence of the targets it votes on, weighted by the vote, so that
+  agreeing with reliable nodes makes a node reliable, and a vote of 0 has no
+  effect back on the voter. A reason's factors share this message equally.
+
+Corona iterates this from the stored confidences until no node changes by
+more than a tolerance, then writes back the nodes that changed.
+
+    from conceptdb.inference import corona
+    engine = corona.refresh()
+
+Targets that get a new vote afterward have their confidence recomputed from
+their running sums (see justify.count_reasons), until the next refresh.
+"""
+import time
+import numpy as np
+from conceptdb.justify import ConfidenceValue, DIRTY, write_confidences
+from conceptdb.confidence import CONFIDENCES
+from conceptdb.inference.graph import JustificationGraph
+import logging
+log = logging.getLogger('conceptdb.inference.corona')
+
+DEFAULT_TOLERANCE = 1e-6
+DEFAULT_MAX_ITERATIONS = 100
+
+class Corona(object):
+    """
+    The CORONA update for a JustificationGraph, with its operators worked
+    out once so that each iteration is a few NumPy reductions.
+    """
+    def __init__(self, graph, tnorm='hamacher',
+                 prior=ConfidenceValue.DEFAULT_CONFIDENCE,
+                 prior_weight=ConfidenceValue.DEFAULT_WEIGHT):
+        self.graph = graph
+        self.tnorm = tnorm
+        self.prior = prior
+        self.prior_weight = prior_weight
+        self.iterations = 0
+        self.change = None
+        self.written = None
+
+        fan = np.diff(graph.indptr)
+        # the reason that each entry of graph.factors belongs to
+        self.owner = np.repeat(np.arange(graph.num_reasons), fan)
+        # how much each factor entry hears about its reason's target
+        shares = graph.votes * graph.weights / np.maximum(fan, 1)
+        self.dual_weights = shares[self.owner]
+        self.dual_totals = np.bincount(graph.factors,
+                                       weights=self.dual_weights,
+                                       minlength=len(graph))
+
+    def step(self, confidences):
+        """
+        Compute every node's new confidence from the current ones.
+        """
+        graph = self.graph
+        strengths = graph.evaluate(confidences, self.tnorm)
+        vote_sums, weight_sums = graph.sums(strengths)
+        dual = self.dual_weights * confidences[graph.targets[self.owner]]
+        dual_sums = np.bincount(graph.factors, weights=dual,
+                                minlength=len(graph))
+        return ((self.prior * self.prior_weight + vote_sums + dual_sums)
+                / (self.prior_weight + weight_sums + self.dual_totals))
+
+    def run(self, confidences=None, tolerance=DEFAULT_TOLERANCE,
+            max_iterations=DEFAULT_MAX_ITERATIONS):
+        """
+        Iterate until no confidence changes by more than `tolerance`, or for
+        at most `max_iterations` steps. Starts from the given array of
+        confidences, or from the stored ones. Returns the final array.
+        """
+        if confidences is None:
+            confidences = self.graph.current_confidences()
+        self.iterations = 0
+        self.change = None
+        while self.iterations < max_iterations:
+            updated = self.step(confidences)
+            self.iterations += 1
+            if len(updated):
+                self.change = float(np.max(np.abs(updated - confidences)))
+            else:
+                self.change = 0.0
+            confidences = updated
+            log.debug('iteration %d: change %g'
+                      % (self.iterations, self.change))
+            if self.change <= tolerance:
+                break
+        if self.change is not None and self.change > tolerance:
+            log.warning('stopped after %d iterations with change %g'
+                        % (self.iterations, self.change))
+        return confidences
+
+    def save(self, confidences, previous=None, tolerance=DEFAULT_TOLERANCE,
+             batch_size=1000):
+        """
+        Write confidences to the database in batches (see
+        justify.write_confidences). Given the `previous` confidences, only
+        the nodes that changed by more than `tolerance` are written. Returns
+        the number of nodes written.
+        """
+        if previous is None:
+            changed = np.arange(len(self.graph))
+        else:
+            changed = np.flatnonzero(np.abs(confidences - previous)
+                                     > tolerance)
+        nodes = self.graph.nodes
+        updates = ((nodes[i], {'confidence': float(confidences[i])})
+                   for i in changed)
+        count = write_confidences(updates, batch_size)
+        CONFIDENCES.invalidate()
+        return count
+
+def refresh(dataset=None, tnorm='hamacher', tolerance=DEFAULT_TOLERANCE,
+            max_iterations=DEFAULT_MAX_ITERATIONS, batch_size=1000):
+    """
+    Run CORONA over every reason in the database, or in a dataset (see
+    JustificationGraph.from_conceptdb), starting from the stored
+    confidences, and write back the ones that changed. The nodes it covers
+    are no longer stale (see justify.DirtyTargets). Returns the Corona, whose
+    `iterations`, `change` and `written` say how it went.
+    """
+    start = time.time()
+    # Don't let cached changes overwrite the results later.
+    CONFIDENCES.flush()
+    graph = JustificationGraph.from_conceptdb(dataset)
+    log.info('compiled %d reasons over %d nodes in %.1fs'
+             % (graph.num_reasons, len(graph), time.time() - start))
+    engine = Corona(graph, tnorm)
+    previous = graph.current_confidences()
+    confidences = engine.run(previous, tolerance, max_iterations)
+    engine.written = engine.save(confidences, previous, tolerance,
+                                 batch_size)
+    # Everything in the graph is up to date now.
+    DIRTY.stale.difference_update(graph.nodes)
+    log.info('%d iterations, %d confidences written, %.1fs in all'
+             % (engine.iterations, engine.written, time.time() - start))
+    return engine
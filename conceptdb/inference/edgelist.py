@@ -0,0 +1,194 @@
+"""
+Loads the tab-separated edge lists that conceptdb.inference.export writes
+and the experiments in experiments/inference read. Each line is
+
+    source\ttarget\t{props}
+
+where props is a Python dict literal with a 'weight', and possibly the
+'dependencies' of a conjunction. The props are parsed with ast.literal_eval,
+which accepts only literals, so a graph file can't run code.
+
+Large files are split into byte ranges that are parsed in parallel by a pool
+of processes. Each process numbers the nodes it sees, and the results are
+merged so that nodes are numbered in the order they first appear in the file.
+
+    edges = load_edges('conceptdb.graph')
+    for source, target, weight, dependencies in edges:
+        ...
+"""
+import ast
+import multiprocessing
+import os
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+# the weight of an edge that doesn't give one, as in justify.reason_weight
+DEFAULT_WEIGHT = 1.0
+
+def parse_props(text):
+    """
+    Parse the props of an edge, which must be a dict literal.
+    """
+    props = ast.literal_eval(text)
+    if not isinstance(props, dict):
+        raise ValueError("Edge properties should be a dict: %r" % text)
+    return props
+
+class EdgeList(object):
+    """
+    The edges of a graph file, as arrays of node numbers:
+
+    - nodes: the name of each node
+    - sources, targets, weights: one entry per edge
+    - has_dependencies: whether each edge gave 'dependencies'
+    - dependency_indptr, dependencies: the dependencies of each edge, in
+      CSR form
+    """
+    def __init__(self, nodes, sources, targets, weights, has_dependencies,
+                 dependency_indptr, dependencies):
+        self.nodes = nodes
+        self.sources = sources
+        self.targets = targets
+        self.weights = weights
+        self.has_dependencies = has_dependencies
+        self.dependency_indptr = dependency_indptr
+        self.dependencies = dependencies
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __iter__(self):
+        """
+        Yield (source, target, weight, dependencies) for each edge, by
+        name. dependencies is None for edges that didn't give any.
+        """
+        nodes = self.nodes
+        indptr = self.dependency_indptr
+        for i in xrange(len(self.sources)):
+            dependencies = None
+            if self.has_dependencies[i]:
+                dependencies = [nodes[j] for j in
+                                self.dependencies[indptr[i]:indptr[i+1]]]
+            yield (nodes[self.sources[i]], nodes[self.targets[i]],
+                   float(self.weights[i]), dependencies)
+
+def chunk_ranges(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split a file into (start, end) byte ranges of about chunk_size bytes.
+    A range holds the lines that start inside it.
+    """
+    size = os.path.getsize(filename)
+    starts = range(0, size, chunk_size) or [0]
+    return [(start, min(start + chunk_size, size)) for start in starts]
+
+def parse_chunk(args):
+    """
+    Parse the lines that start in a byte range of a file, numbering the
+    nodes from 0. Returns an EdgeList of plain lists.
+    """
+    filename, start, end = args
+    index = {}
+    nodes = []
+    def intern(name):
+        i = index.get(name)
+        if i is None:
+            i = index[name] = len(nodes)
+            nodes.append(name)
+        return i
+
+    sources = []
+    targets = []
+    weights = []
+    has_dependencies = []
+    dependency_indptr = [0]
+    dependencies = []
+    file = open(filename, 'rb')
+    position = start
+    if start > 0:
+        # Skip the line that started in the range before this one.
+        file.seek(start - 1)
+        position = start - 1 + len(file.readline())
+    while position < end:
+        line = file.readline()
+        if not line:
+            break
+        line_start = position
+        position += len(line)
+        line = line.decode('utf-8').strip()
+        if not line:
+            continue
+        try:
+            source, target, prop_str = line.split('\t')
+            props = parse_props(prop_str)
+        except (ValueError, SyntaxError), e:
+            raise ValueError("%s, byte %d: %s" % (filename, line_start, e))
+        sources.append(intern(source))
+        targets.append(intern(target))
+        weight = props.get('weight')
+        if weight is None:
+            weight = DEFAULT_WEIGHT
+        weights.append(weight)
+        edge_dependencies = props.get('dependencies')
+        has_dependencies.append(edge_dependencies is not None)
+        for dependency in edge_dependencies or []:
+            dependencies.append(intern(dependency))
+        dependency_indptr.append(len(dependencies))
+    file.close()
+    return EdgeList(nodes, sources, targets, weights, has_dependencies,
+                    dependency_indptr, dependencies)
+
+def merge(chunks):
+    """
+    Combine the EdgeLists of consecutive chunks, renumbering their nodes.
+    """
+    index = {}
+    nodes = []
+    sources = []
+    targets = []
+    weights = []
+    has_dependencies = []
+    dependency_indptr = [np.zeros(1, dtype=np.int64)]
+    dependencies = []
+    offset = 0
+    for chunk in chunks:
+        mapping = np.empty(len(chunk.nodes), dtype=np.int64)
+        for local, name in enumerate(chunk.nodes):
+            i = index.get(name)
+            if i is None:
+                i = index[name] = len(nodes)
+                nodes.append(name)
+            mapping[local] = i
+        sources.append(mapping[np.asarray(chunk.sources, dtype=np.int64)])
+        targets.append(mapping[np.asarray(chunk.targets, dtype=np.int64)])
+        weights.append(np.asarray(chunk.weights, dtype=np.float64))
+        has_dependencies.append(np.asarray(chunk.has_dependencies,
+                                           dtype=bool))
+        dependencies.append(mapping[np.asarray(chunk.dependencies,
+                                               dtype=np.int64)])
+        indptr = np.asarray(chunk.dependency_indptr, dtype=np.int64)
+        dependency_indptr.append(indptr[1:] + offset)
+        offset += indptr[-1]
+    return EdgeList(nodes, np.concatenate(sources or [[]]).astype(np.int64),
+                    np.concatenate(targets or [[]]).astype(np.int64),
+                    np.concatenate(weights or [[]]),
+                    np.concatenate(has_dependencies or [[]]).astype(bool),
+                    np.concatenate(dependency_indptr),
+                    np.concatenate(dependencies or [[]]).astype(np.int64))
+
+def load_edges(filename, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Parse a graph file into an EdgeList, using a pool of `processes`
+    processes (by default, one per core) when the file is bigger than one
+    chunk.
+    """
+    tasks = [(filename, start, end)
+             for start, end in chunk_ranges(filename, chunk_size)]
+    if len(tasks) == 1 or processes == 1:
+        return merge(parse_chunk(task) for task in tasks)
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunks = pool.map(parse_chunk, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return merge(chunks)
@@ -0,0 +1,173 @@
+"""
+Exports the justification graph from MongoDB in one streaming pass.
+
+Two formats are written:
+
+- the tab-separated edge list used by the experiments in
+  experiments/inference, with a line `source\\ttarget\\t{props}` for each
+  edge. Each reason becomes a node named '/c/<id>', with an edge from each
+  of its factors (carrying its weight and its list of factors as
+  'dependencies') and an edge to its target.
+- a JustificationGraph snapshot (see conceptdb.inference.graph).
+
+Reasons are read with a raw cursor, fetching only the fields that are used,
+in large batches. Optionally, reasons that touch a node with `min_degree` or
+fewer reasons are left out; the degrees are counted on the server with an
+aggregation, so that only the set of well-connected nodes is held in memory.
+"""
+import codecs
+import time
+from pymongo.errors import OperationFailure
+from conceptdb import raw
+from conceptdb.justify import ReasonConjunction, reason_weight
+from conceptdb.inference.graph import JustificationGraph
+import logging
+log = logging.getLogger('conceptdb.inference.export')
+
+DEFAULT_BATCH_SIZE = 10000
+# targets that were saved before their assertion had an id
+BROKEN_TARGETS = ('/sentence/None', '/assertion/None', '/expression/None')
+
+class Progress(object):
+    """
+    Counts items, and logs the count at most every `interval` seconds.
+    """
+    def __init__(self, description, interval=10.0):
+        self.description = description
+        self.interval = interval
+        self.count = 0
+        self.start = self.last = time.time()
+
+    def add(self, n=1):
+        self.count += n
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            log.info('%s: %d (%.1fs)' % (self.description, self.count,
+                                         now - self.start))
+
+    def done(self):
+        log.info('%s: %d in all (%.1fs)' % (self.description, self.count,
+                                             time.time() - self.start))
+
+class AggregationUnavailable(Exception):
+    pass
+
+def _aggregate(collection, pipeline):
+    """
+    Run an aggregation pipeline, reading its results from a cursor and
+    letting the server spill to disk, so that the results aren't limited to
+    what fits in one reply. Older servers and drivers, which can't do that,
+    raise AggregationUnavailable.
+    """
+    try:
+        result = collection.aggregate(pipeline, allowDiskUse=True, cursor={})
+    except (TypeError, OperationFailure), e:
+        raise AggregationUnavailable(str(e))
+    if isinstance(result, dict):
+        return result['result']
+    return result
+
+def _count_locally(spec):
+    counts = {}
+    for reason in raw.reasons(fields=['target', 'factors'], spec=spec,
+                              batch_size=DEFAULT_BATCH_SIZE):
+        for node in set(reason.factors or []) | set([reason.target]):
+            counts[node] = counts.get(node, 0) + 1
+    return counts
+
+def well_connected(min_degree):
+    """
+    Get the set of nodes that appear in more than `min_degree` reasons,
+    as a factor or as the target.
+    """
+    collection = ReasonConjunction.objects._collection
+    base_spec = ReasonConjunction.objects._query
+    # A reason whose target is also one of its factors counts twice here,
+    # which doesn't happen in practice.
+    pipelines = [
+        [{'$match': base_spec},
+         {'$project': {'factors': 1}},
+         {'$unwind': '$factors'},
+         {'$group': {'_id': '$factors', 'count': {'$sum': 1}}}],
+        [{'$match': base_spec},
+         {'$group': {'_id': '$target', 'count': {'$sum': 1}}}],
+    ]
+    counts = {}
+    try:
+        if not hasattr(collection, 'aggregate'):
+            raise AggregationUnavailable('no aggregate method')
+        for pipeline in pipelines:
+            for row in _aggregate(collection, pipeline):
+                counts[row['_id']] = counts.get(row['_id'], 0) + row['count']
+    except AggregationUnavailable, e:
+        # Count on this side instead, which takes one more scan.
+        log.info("can't aggregate with a cursor (%s); counting degrees "
+                 "locally" % e)
+        counts = _count_locally(base_spec)
+    return set(node for node, count in counts.iteritems()
+               if count > min_degree)
+
+def reasons(min_degree=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yield a raw ReasonRecord for every usable reason, leaving out those
+    that touch a node with `min_degree` or fewer reasons, if it is given.
+    """
+    keep = None
+    if min_degree is not None:
+        keep = well_connected(min_degree)
+    for reason in raw.reasons(batch_size=batch_size):
+        if reason.target is None or reason.target in BROKEN_TARGETS:
+            continue
+        if keep is not None:
+            if reason.target not in keep:
+                continue
+            if not all(factor in keep for factor in reason.factors or []):
+                continue
+        yield reason
+
+def edge_line(source, target, **props):
+    return u"%s\t%s\t%r\n" % (source, target, props)
+
+def export_edges(filename, min_degree=3, target_weight=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write the edge list to a file. `target_weight` gives the weight of the
+    edge from a reason to its target, given the ReasonRecord; by default it
+    is the reason's vote. Returns the number of edges written.
+    """
+    out = codecs.open(filename, 'w', encoding='utf-8')
+    progress = Progress('exported reasons')
+    edges = 0
+    for reason in reasons(min_degree, batch_size):
+        reason_name = '/c/%s' % reason.id
+        factors = reason.factors or []
+        weight = reason_weight(reason.weight)
+        for factor in factors:
+            out.write(edge_line(factor, reason_name, weight=weight,
+                                dependencies=factors))
+        if target_weight is None:
+            vote = reason.vote or 0.0
+        else:
+            vote = target_weight(reason)
+        out.write(edge_line(reason_name, reason.target, weight=vote))
+        edges += len(factors) + 1
+        progress.add()
+    out.close()
+    progress.done()
+    return edges
+
+def export_snapshot(path, min_degree=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Compile the reasons into a JustificationGraph in one pass, and save it
+    as a snapshot at `path`. Returns the graph.
+    """
+    progress = Progress('compiled reasons')
+    def records():
+        for reason in reasons(min_degree, batch_size):
+            progress.add()
+            yield reason.target, reason.factors, reason.vote, reason.weight
+    graph = JustificationGraph.build(records())
+    progress.done()
+    graph.save(path)
+    return graph
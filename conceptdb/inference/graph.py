@@ -0,0 +1,342 @@
+"""
+The justification graph, compiled into NumPy arrays.
+
+Every ReasonConjunction is a row of a compressed sparse row (CSR) structure:
+the factors of reason i are the node numbers factors[indptr[i]:indptr[i+1]],
+and its target is targets[i]. Nodes are numbered in the order they are first
+seen, and their names are kept in `nodes`.
+
+With the graph in this form, the conjunction of every reason's factors can be
+evaluated at once, and the reasons for every target aggregated at once,
+without asking MongoDB for anything or looping over reasons in Python.
+
+    graph = JustificationGraph.from_conceptdb()
+    confidence = graph.current_confidences()
+    strength = graph.evaluate(confidence, tnorm='hamacher')
+    confidence = graph.aggregate(strength, confidence)
+
+A graph can be saved as a snapshot: a directory holding a manifest, the
+arrays as .npy files, and the node names as one UTF-8 byte array with an
+array of offsets into it. Loading a snapshot maps those files instead of
+reading them, so processes that load the same snapshot share its memory.
+
+    graph.save('/var/conceptdb/graph')
+    graph = JustificationGraph.load('/var/conceptdb/graph')
+"""
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from conceptdb.justify import ConfidenceValue, reason_weight
+
+TNORMS = ('hamacher', 'product', 'min')
+SNAPSHOT_FORMAT = 'conceptdb-justification-graph'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ARRAYS = ('indptr', 'factors', 'targets', 'votes', 'weights',
+                   'names', 'name_offsets')
+
+def _segments(indptr, values, ufunc, empty):
+    """
+    Reduce each segment values[indptr[i]:indptr[i+1]] with a ufunc.
+    Empty segments get the value `empty`.
+    """
+    lengths = np.diff(indptr)
+    result = np.empty(len(lengths), dtype=np.float64)
+    result.fill(empty)
+    nonempty = lengths > 0
+    if nonempty.any():
+        # With the empty segments left out, each segment starts where the
+        # one before it ends, which is what reduceat expects.
+        result[nonempty] = ufunc.reduceat(values, indptr[:-1][nonempty])
+    return result
+
+def conjoin(indptr, values, tnorm='hamacher'):
+    """
+    Combine each segment of `values` (see _segments) with a t-norm:
+
+    - 'hamacher': the Hamacher product, as in justify.hamacher. Because
+      1/H(a, b) - 1 = (1/a - 1) + (1/b - 1), this is a sum of reciprocals.
+    - 'product': the ordinary product.
+    - 'min': the minimum.
+
+    An empty conjunction is 1.0, which is true.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if tnorm == 'hamacher':
+        with np.errstate(divide='ignore'):
+            excess = _segments(indptr, 1.0 / values - 1.0, np.add, 0.0)
+        return 1.0 / (1.0 + excess)
+    elif tnorm == 'product':
+        return _segments(indptr, values, np.multiply, 1.0)
+    elif tnorm == 'min':
+        return _segments(indptr, values, np.minimum, 1.0)
+    else:
+        raise ValueError("Unknown t-norm: %r (expected one of %s)"
+                         % (tnorm, ', '.join(TNORMS)))
+
+class NodeTable(object):
+    """
+    A read-only list of node names, kept as their UTF-8 encodings joined
+    into one byte array, where name i is data[offsets[i]:offsets[i+1]].
+    Names are only decoded when they are asked for.
+    """
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def from_names(names):
+        encoded = [name.encode('utf-8') for name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        if encoded:
+            data = np.frombuffer(''.join(encoded), dtype=np.uint8)
+        else:
+            data = np.zeros(0, dtype=np.uint8)
+        return NodeTable(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = self.offsets[i], self.offsets[i+1]
+        return self.data[start:end].tostring().decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+class JustificationGraph(object):
+    """
+    All the reasons in the database (or in a dataset), as arrays:
+
+    - nodes: the name of each node
+    - indptr, factors: the factors of each reason, in CSR form
+    - targets: the node each reason is a reason for
+    - votes, weights: each reason's vote, and its weight as counted by
+      ConfidenceValue.calculate
+    """
+    def __init__(self, nodes, indptr, factors, targets, votes, weights,
+                 index=None):
+        self.nodes = nodes
+        self._index = index
+        self.indptr = indptr
+        self.factors = factors
+        self.targets = targets
+        self.votes = votes
+        self.weights = weights
+
+    @staticmethod
+    def build(reasons):
+        """
+        Compile a graph from (target, factors, vote, weight) tuples.
+        """
+        index = {}
+        nodes = []
+        def intern(name):
+            i = index.get(name)
+            if i is None:
+                i = index[name] = len(nodes)
+                nodes.append(name)
+            return i
+
+        indptr = [0]
+        factors = []
+        targets = []
+        votes = []
+        weights = []
+        for target, reason_factors, vote, weight in reasons:
+            targets.append(intern(target))
+            for factor in reason_factors or []:
+                factors.append(intern(factor))
+            indptr.append(len(factors))
+            votes.append(vote or 0.0)
+            weights.append(reason_weight(weight))
+        return JustificationGraph(nodes,
+                                  np.array(indptr, dtype=np.int64),
+                                  np.array(factors, dtype=np.int64),
+                                  np.array(targets, dtype=np.int64),
+                                  np.array(votes, dtype=np.float64),
+                                  np.array(weights, dtype=np.float64),
+                                  index)
+
+    @staticmethod
+    def from_conceptdb(dataset=None, batch_size=10000):
+        """
+        Compile the graph of every ReasonConjunction in one scan. With a
+        dataset name, only the reasons for objects in that dataset and for
+        the reason nodes under it are included, as in recompute_confidences.
+        """
+        from conceptdb import raw
+        from conceptdb.justify import dataset_targets
+        if dataset is not None:
+            names = dataset_targets(dataset)
+            prefix = dataset + '/'
+        def reasons():
+            for reason in raw.reasons(batch_size=batch_size):
+                target = reason.target
+                if target is None: continue
+                if dataset is not None and target not in names \
+                   and not target.startswith(prefix):
+                    continue
+                yield target, reason.factors, reason.vote, reason.weight
+        return JustificationGraph.build(reasons())
+
+    def save(self, path):
+        """
+        Write the graph to a snapshot directory. The snapshot is written
+        into a new directory next to `path`, which is then renamed into
+        place, so that an interrupted save leaves any old snapshot alone,
+        and processes that have the old one loaded can keep using it.
+        """
+        path = os.path.abspath(path)
+        parent, base = os.path.split(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        staging = tempfile.mkdtemp(prefix=base + '.new-', dir=parent)
+        try:
+            self._write_snapshot(staging)
+            old = None
+            if os.path.exists(path):
+                old = tempfile.mkdtemp(prefix=base + '.old-', dir=parent)
+                os.rename(path, os.path.join(old, base))
+            os.rename(staging, path)
+        except:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if old is not None:
+            # Unlinked files stay readable by whoever has them mapped.
+            shutil.rmtree(old, ignore_errors=True)
+
+    def _write_snapshot(self, path):
+        if isinstance(self.nodes, NodeTable):
+            table = self.nodes
+        else:
+            table = NodeTable.from_names(self.nodes)
+        arrays = {'indptr': self.indptr, 'factors': self.factors,
+                  'targets': self.targets, 'votes': self.votes,
+                  'weights': self.weights, 'names': table.data,
+                  'name_offsets': table.offsets}
+        for name in SNAPSHOT_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), arrays[name])
+        manifest = {'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+                    'nodes': len(self.nodes), 'reasons': self.num_reasons,
+                    'arrays': list(SNAPSHOT_ARRAYS)}
+        out = open(os.path.join(path, 'manifest.json'), 'w')
+        json.dump(manifest, out)
+        out.close()
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        """
+        Open a snapshot written by `save`. The arrays are memory-mapped,
+        and read-only unless another `mmap_mode` is given.
+        """
+        manifest_file = open(os.path.join(path, 'manifest.json'))
+        manifest = json.load(manifest_file)
+        manifest_file.close()
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError("%s is not a justification graph snapshot"
+                             % path)
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("%s is a version %s snapshot; this is version %s"
+                             % (path, manifest.get('version'),
+                                SNAPSHOT_VERSION))
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                     mmap_mode=mmap_mode))
+                      for name in SNAPSHOT_ARRAYS)
+        nodes = NodeTable(arrays['names'], arrays['name_offsets'])
+        return JustificationGraph(nodes, arrays['indptr'], arrays['factors'],
+                                  arrays['targets'], arrays['votes'],
+                                  arrays['weights'])
+
+    @property
+    def index(self):
+        """
+        A dictionary from each node's name to its number, built the first
+        time it is needed.
+        """
+        if self._index is None:
+            self._index = dict((name, i) for i, name in enumerate(self.nodes))
+        return self._index
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def num_reasons(self):
+        return len(self.targets)
+
+    def current_confidences(self, batch_size=10000):
+        """
+        Get the stored confidence of every node, as an array. Nodes that
+        have none get the default confidence.
+        """
+        from conceptdb.confidence import CONFIDENCES
+        result = np.empty(len(self.nodes), dtype=np.float64)
+        for start in xrange(0, len(self.nodes), batch_size):
+            batch = self.nodes[start:start+batch_size]
+            result[start:start+len(batch)] = CONFIDENCES.get_many(batch)
+        return result
+
+    def evaluate(self, confidences, tnorm='hamacher'):
+        """
+        Get the strength of every reason: the conjunction of its factors'
+        confidences under the given t-norm (see conjoin).
+        """
+        return conjoin(self.indptr, confidences[self.factors], tnorm)
+
+    def sums(self, strengths=None):
+        """
+        Sum the votes and weights of the reasons for each node, as
+        ConfidenceValue.calculate does, with each reason's vote and weight
+        scaled by its strength if strengths are given. Returns the arrays
+        (vote_sums, weight_sums).
+        """
+        votes, weights = self.votes, self.weights
+        if strengths is not None:
+            votes = votes * strengths
+            weights = weights * strengths
+        n = len(self.nodes)
+        vote_sums = np.bincount(self.targets, weights=votes, minlength=n)
+        weight_sums = np.bincount(self.targets, weights=weights, minlength=n)
+        return vote_sums, weight_sums
+
+    def aggregate(self, strengths=None, confidences=None):
+        """
+        Get the confidence of every node from its reasons, as
+        ConfidenceValue.from_sums does. If reason strengths are given, each
+        reason counts in proportion to its strength, making each node's
+        confidence the weighted average of its votes described in
+        doc/corona2.tex.
+
+        Nodes without reasons keep their value from `confidences`, or get
+        the default confidence.
+        """
+        vote_sums, weight_sums = self.sums(strengths)
+        result = ConfidenceValue.from_sums(vote_sums, weight_sums)
+        if confidences is not None:
+            justified = np.zeros(len(self.nodes), dtype=bool)
+            justified[self.targets] = True
+            result = np.where(justified, result, confidences)
+        return result
+
+    def step(self, confidences, tnorm='hamacher'):
+        """
+        Evaluate every reason and aggregate the results: one pass of
+        confidence propagation over the whole graph.
+        """
+        return self.aggregate(self.evaluate(confidences, tnorm), confidences)
+
+    def items(self, values):
+        """
+        Pair each node's name with its entry in an array of values.
+        """
+        return zip(self.nodes, values.tolist())
@@ -0,0 +1,181 @@
+"""
+Incremental propagation of confidence after a few votes.
+
+A vote only changes the confidence of the nodes near it. Instead of running
+CORONA over the whole graph (see conceptdb.inference.corona), a Propagator
+recomputes the CORONA update for one node at a time, loading just the
+reasons for it and the reasons it is a factor of. Every node that changes by
+more than `epsilon` adds a residual to its neighbors: an estimate of how much
+the change can move them. Neighbors are recomputed, largest residual first,
+only once their residual passes `epsilon`, in the style of push-based
+personalized PageRank.
+
+Reasons made with ReasonConjunction.make mark their targets dirty (see
+justify.DIRTY), so after a vote,
+
+    from conceptdb.inference import incremental
+    incremental.propagate_dirty()
+
+brings the confidences around it up to date. With justify.propagate_votes()
+on (in the API, when the CONCEPTDB_PROPAGATE_VOTES setting is true),
+add_reason does this after every vote. DIRTY only sees the votes made in its
+own process. Nodes with more than `max_degree` reasons, such as a dataset's
+root, and nodes still queued after `max_updates` updates are left for the
+next full refresh, and are kept in DIRTY.stale until then.
+"""
+import heapq
+import numpy as np
+from conceptdb import raw
+from conceptdb.justify import ConfidenceValue, DIRTY, reason_weight
+from conceptdb.confidence import CONFIDENCES
+from conceptdb.inference.graph import conjoin
+import logging
+log = logging.getLogger('conceptdb.inference.incremental')
+
+DEFAULT_EPSILON = 1e-4
+
+class Propagator(object):
+    """
+    Pushes confidence changes outward from a set of nodes, making at most
+    `max_updates` node updates per call to `propagate`.
+    """
+    def __init__(self, epsilon=DEFAULT_EPSILON, max_updates=10000,
+                 max_degree=10000, tnorm='hamacher',
+                 prior=ConfidenceValue.DEFAULT_CONFIDENCE,
+                 prior_weight=ConfidenceValue.DEFAULT_WEIGHT):
+        self.epsilon = epsilon
+        self.max_updates = max_updates
+        self.max_degree = max_degree
+        self.tnorm = tnorm
+        self.prior = prior
+        self.prior_weight = prior_weight
+        self.updates = 0
+        self.skipped = set()
+        self._neighborhoods = {}
+
+    def neighborhood(self, name):
+        """
+        Get the reasons for a node and the reasons it is a factor of, as
+        lists of raw ReasonRecords, or None if there are more than
+        max_degree of them.
+        """
+        if name in self._neighborhoods:
+            return self._neighborhoods[name]
+        found = []
+        for query in ({'target': name}, {'factors': name}):
+            reasons = []
+            for reason in raw.reasons(**query):
+                reasons.append(reason)
+                if len(reasons) > self.max_degree:
+                    self._neighborhoods[name] = None
+                    return None
+            found.append(reasons)
+        self._neighborhoods[name] = tuple(found)
+        return self._neighborhoods[name]
+
+    def local_update(self, name, reasons_for, reasons_from):
+        """
+        Compute the CORONA update (see corona.Corona.step) for one node from
+        its neighborhood and the cached confidences of its neighbors.
+        """
+        needed = [factor for reason in reasons_for
+                  for factor in reason.factors or []]
+        needed.extend(reason.target for reason in reasons_from)
+        confidences = dict(zip(needed, CONFIDENCES.get_many(needed)))
+
+        numerator = self.prior * self.prior_weight
+        denominator = self.prior_weight
+        if reasons_for:
+            indptr = np.cumsum([0] + [len(reason.factors or [])
+                                      for reason in reasons_for])
+            values = [confidences[factor] for factor in needed[:indptr[-1]]]
+            strengths = conjoin(indptr, values, self.tnorm)
+            for reason, strength in zip(reasons_for, strengths):
+                numerator += strength * (reason.vote or 0.0)
+                denominator += strength * reason_weight(reason.weight)
+        for reason in reasons_from:
+            share = self._share(reason) * reason.factors.count(name)
+            numerator += share * confidences[reason.target]
+            denominator += share
+        return numerator / denominator
+
+    def _share(self, reason):
+        # how much each factor hears back about the reason's target
+        return ((reason.vote or 0.0) * reason_weight(reason.weight)
+                / max(len(reason.factors or []), 1))
+
+    def propagate(self, names):
+        """
+        Recompute the given nodes and the factors of their reasons, and push
+        any changes outward until they fall under epsilon. Changed
+        confidences are written in batches through CONFIDENCES. Returns a
+        dictionary of the nodes that changed and their new confidences.
+        """
+        residuals = {}
+        heap = []
+        def push(name, amount):
+            residual = residuals.get(name, 0.0) + amount
+            residuals[name] = residual
+            if residual > self.epsilon:
+                heapq.heappush(heap, (-residual, name))
+
+        for name in names:
+            push(name, float('inf'))
+            hood = self.neighborhood(name)
+            if hood is None: continue
+            # A new reason changes what its factors hear back, too.
+            for reason in hood[0]:
+                for factor in reason.factors or []:
+                    push(factor, float('inf'))
+
+        changed = {}
+        self.updates = 0
+        while heap and self.updates < self.max_updates:
+            negative, name = heapq.heappop(heap)
+            if residuals.get(name) != -negative:
+                # superseded by a larger residual
+                continue
+            del residuals[name]
+            hood = self.neighborhood(name)
+            if hood is None:
+                self.skipped.add(name)
+                continue
+            reasons_for, reasons_from = hood
+            old = CONFIDENCES.get(name)
+            new = self.local_update(name, reasons_for, reasons_from)
+            self.updates += 1
+            delta = abs(new - old)
+            if delta <= self.epsilon:
+                continue
+            CONFIDENCES.set(name, new)
+            changed[name] = new
+
+            for reason in reasons_from:
+                weight = reason_weight(reason.weight)
+                push(reason.target, delta * weight
+                                    / (self.prior_weight + weight))
+            for reason in reasons_for:
+                share = self._share(reason)
+                for factor in set(reason.factors or []):
+                    push(factor, delta * share / (self.prior_weight + share))
+        if heap:
+            log.warning('stopped after %d updates with %d nodes queued'
+                        % (self.updates, len(heap)))
+            self.skipped.update(name for _, name in heap)
+        DIRTY.mark_stale(self.skipped)
+        CONFIDENCES.flush()
+        return changed
+
+def propagate_dirty(**options):
+    """
+    Propagate the changes from every reason made since the last call (see
+    justify.DIRTY). Takes the same options as Propagator, and returns the
+    Propagator that did it.
+    """
+    targets, overflowed = DIRTY.take()
+    if overflowed:
+        log.warning('too many targets changed to propagate them '
+                    'incrementally; run corona.refresh instead')
+    propagator = Propagator(**options)
+    propagator.propagate(targets)
+    return propagator
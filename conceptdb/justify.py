@@ -1,8 +1,31 @@
 import mongoengine as mon
 from conceptdb import ConceptDBDocument
 from conceptdb.util import ensure_reference, dereference
+from conceptdb.confidence import CONFIDENCES
+from conceptdb import factor_index, keycache
 from log import Log
 import numpy as np
+import hashlib
+import logging
+log = logging.getLogger('conceptdb.justify')
+
+# The unique index that keeps one reason per target and set of factors. It
+# isn't declared with unique_with, because mongoengine would try to build it
+# on the first query, and that fails on databases whose reasons were stored
+# before factor_key existed (see ReasonConjunction.fill_factor_keys).
+KEY_INDEX = [('target', 1), ('factor_key', 1)]
+# names of the databases whose key index has been checked in this process
+_key_indexed = set()
+
+# If this is true, a vote made through add_reason (or add_support or
+# add_oppose) is propagated to the confidences around it right away, with
+# conceptdb.inference.incremental.propagate_dirty. Turn it on with
+# propagate_votes().
+PROPAGATE_VOTES = False
+
+def propagate_votes(enabled=True):
+    global PROPAGATE_VOTES
+    PROPAGATE_VOTES = enabled
 
 def hamacher(values):
     """
@@ -33,6 +56,8 @@ class ReasonConjunction(ConceptDBDocument, mon.Document):
     """
     # target: What is this a reason for?
     # (Expressed as a URL that may or may not refer to a DB object.)
+    # There is at most one reason for a target with each set of factors,
+    # which the index built by ensure_key_index enforces.
     target = mon.StringField()
 
     # factors: What things must be true for this reason to be true?
@@ -47,31 +72,140 @@ class ReasonConjunction(ConceptDBDocument, mon.Document):
     # its factors?
     weight = mon.FloatField()
 
+    # factor_key: identifies the set of factors (see make_factor_key).
+    factor_key = mon.StringField()
+
     meta = {'indexes': ['target', 'weight', 'factors']}
 
+    @staticmethod
+    def make_factor_key(factors):
+        """
+        Get a string that identifies a set of factors, whatever their order:
+        the SHA-1 of the sorted factors.
+        """
+        factors = sorted(set(ensure_reference(f) for f in factors))
+        text = u'\x1f'.join(unicode(f) for f in factors)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def raw_collection():
+        """
+        Get the pymongo collection of reasons without going through
+        mongoengine, which builds the declared indexes first.
+        """
+        import conceptdb
+        return conceptdb.get_database()[ReasonConjunction._meta['collection']]
+
+    @staticmethod
+    def ensure_key_index():
+        """
+        Build the unique index on (target, factor_key), once per database
+        and process. If the database still has reasons without a factor_key,
+        this logs a warning instead; run fill_factor_keys, which builds the
+        index when it is done.
+        """
+        from pymongo.errors import OperationFailure
+        collection = ReasonConjunction.raw_collection()
+        name = collection.database.name
+        if name in _key_indexed:
+            return
+        _key_indexed.add(name)
+        try:
+            collection.create_index(KEY_INDEX, unique=True)
+        except OperationFailure, e:
+            log.warning("Can't build the unique index on reasons (%s); run "
+                        "ReasonConjunction.fill_factor_keys()" % e)
+
+    @classmethod
+    def drop_collection(cls):
+        # The key index goes with the collection.
+        super(ReasonConjunction, cls).drop_collection()
+        _key_indexed.discard(ReasonConjunction.raw_collection().database.name)
+
     @staticmethod
     def make(target, factors, vote):
         # updated to corona2 form.
+        ReasonConjunction.ensure_key_index()
+        target_obj = target
+        if not isinstance(target_obj, ConceptDBDocument):
+            target_obj = None
         target = ensure_reference(target)
         factors = [ensure_reference(f) for f in factors]
-        r, _ = ReasonConjunction.objects.get_or_create(
-            target=target,
-            factors__all=factors,
-            defaults={'factors': factors, 'vote': vote}
+        factor_key = ReasonConjunction.make_factor_key(factors)
+        r, created = ReasonConjunction.upsert(
+            {'target': target, 'factor_key': factor_key},
+            dict(target=target, factors=factors, factor_key=factor_key,
+                 vote=vote)
         )
-        if r.id is not None:
-            # FIXME: this minimizes the number of factors at all costs.
-            # This may not be the correct rule, but it's hard to think of
-            # cases where it goes wrong.
-            r.factors = factors
+        if created:
+            count_reason(target, vote, reason_weight(r.weight), target_obj)
+            factor_index.add_use(target, factors)
+        else:
+            old_vote = r.vote
             r.vote = vote
+            if old_vote != vote:
+                ReasonConjunction.objects(id=r.id).update_one(set__vote=vote)
+                count_reason(target, vote - (old_vote or 0.0), 0.0,
+                             target_obj)
         return r
+
+    def delete(self):
+        """
+        Delete this reason, take its vote back from its target, and take it
+        out of the factor index. (Deleting reasons through a QuerySet doesn't,
+        so recompute_confidences and factor_index.rebuild should be run
+        afterward.)
+        """
+        mon.Document.delete(self)
+        count_reason(self.target, -(self.vote or 0.0),
+                     -reason_weight(self.weight))
+        factor_index.remove_use(self.target, self.factors)
     
+    @staticmethod
+    def fill_factor_keys(batch_size=1000):
+        """
+        Set the factor_key of reasons that were stored before it existed,
+        and then build the unique index on (target, factor_key), which
+        can't be built until this is done. Reasons that turn out to
+        duplicate another one with the same target and factors are removed.
+        Returns the number of reasons updated and the number removed.
+
+        The running sums and the factor index still count the removed
+        reasons, so if any were removed, run recompute_confidences and
+        factor_index.rebuild afterward.
+        """
+        # Not ReasonConjunction.objects._collection, which would try to
+        # build the declared indexes before the keys are filled in.
+        collection = ReasonConjunction.raw_collection()
+        updated = removed = 0
+        # Collect the ids first: updated documents grow, and can be moved
+        # and seen again by a cursor that is still running.
+        ids = [doc['_id'] for doc in
+               collection.find({'factor_key': None}, fields=['_id'])]
+        for start in xrange(0, len(ids), batch_size):
+            batch = ids[start:start+batch_size]
+            cursor = collection.find({'_id': {'$in': batch},
+                                      'factor_key': None},
+                                     fields=['target', 'factors'])
+            for doc in cursor:
+                factor_key = ReasonConjunction.make_factor_key(doc['factors'])
+                duplicate = collection.find_one({'_id': {'$ne': doc['_id']},
+                                                 'target': doc['target'],
+                                                 'factor_key': factor_key},
+                                                fields=['_id'])
+                if duplicate is not None:
+                    collection.remove({'_id': doc['_id']})
+                    removed += 1
+                else:
+                    collection.update({'_id': doc['_id']},
+                                      {'$set': {'factor_key': factor_key}})
+                    updated += 1
+        collection.create_index(KEY_INDEX, unique=True)
+        _key_indexed.add(collection.database.name)
+        return updated, removed
+
     def update_node(self):
-        prod = 1.0
-        for factor_ref in self.factors:
-            prod = hamacher(prod, ConfidenceValue.get(factor_ref))
-        return prod
+        return hamacher(CONFIDENCES.get_many(self.factors))
 
     def check_consistency(self):
         # TODO
@@ -86,7 +220,11 @@ class ConceptDBJustified(ConceptDBDocument):
     their Justifications.
     """
     def add_reason(self, factors, vote):
-        return ReasonConjunction.make(self, factors, vote)
+        reason = ReasonConjunction.make(self, factors, vote)
+        if PROPAGATE_VOTES:
+            from conceptdb.inference.incremental import propagate_dirty
+            propagate_dirty()
+        return reason
     
     def add_support(self, factors):
         """
@@ -107,6 +245,16 @@ class ConceptDBJustified(ConceptDBDocument):
         self.confidence = ConfidenceValue.calculate(self.name)
         return self.confidence
 
+    def check_confidence(self):
+        """
+        Check the running sums of votes and weights that this object's
+        confidence comes from against a full calculation over its reasons.
+        Returns True if they agree.
+        """
+        return abs(ConfidenceValue.calculate(self.name)
+                   - ConfidenceValue.from_sums(self.vote_sum,
+                                               self.weight_sum)) < 1e-9
+
     def get_reasons(self):
         return ReasonConjunction.objects(target=self.name)
 
@@ -126,6 +274,9 @@ class ConfidenceValue(ConceptDBDocument, mon.Document):
     
     object_id = mon.StringField()
     confidence = mon.FloatField()
+    # running sums over the reasons for this object (see count_reasons)
+    vote_sum = mon.FloatField(default=0.0)
+    weight_sum = mon.FloatField(default=0.0)
 
     meta = {'indexes': ['object_id', 'confidence']}
     DEFAULT_CONFIDENCE = 0.5
@@ -134,11 +285,12 @@ class ConfidenceValue(ConceptDBDocument, mon.Document):
     @staticmethod
     def set(object_id, confidence):
         """
-        Store the confidence value for a given ID.
+        Store the confidence value for a given ID where get will find it:
+        in the assertion, expression or sentence it names, or otherwise in
+        its ConfidenceValue (see counter_location).
         """
-        query = ConfidenceValue.objects(object_id=object_id)
-        query.update_one(upsert=True, safe_update=False,
-                         set__confidence=confidence)
+        CONFIDENCES.set(object_id, confidence)
+        CONFIDENCES.flush()
         obj = dereference(object_id)
         if obj is not None:
             obj.confidence = confidence
@@ -146,20 +298,315 @@ class ConfidenceValue(ConceptDBDocument, mon.Document):
     @staticmethod
     def get(object_id):
         """
-        Get the confidence value for a given ID.
+        Get the confidence value for a given ID, from the cache if possible
+        (see conceptdb.confidence).
         """
-        entry = ConfidenceValue.objects.with_id(object_id)
-        if entry is None:
-            return ConfidenceValue.DEFAULT_CONFIDENCE
-        else:
-            return entry.confidence
+        return CONFIDENCES.get(object_id)
     get_for_object = get
 
+    @staticmethod
+    def from_sums(vote_sum, weight_sum):
+        """
+        Get the confidence that ConfidenceValue.calculate would give an
+        object whose reasons have these sums of votes and weights.
+        """
+        return ((ConfidenceValue.DEFAULT_CONFIDENCE + vote_sum)
+                / (ConfidenceValue.DEFAULT_WEIGHT + weight_sum))
+
     @staticmethod
     def calculate(object_id):
         confidence = ConfidenceValue.DEFAULT_CONFIDENCE
         total_weight = ConfidenceValue.DEFAULT_WEIGHT
         for r in ReasonConjunction.objects(target=object_id):
             confidence += r.vote
-            total_weight += r.weight
+            total_weight += reason_weight(r.weight)
         return confidence / total_weight
+
+def reason_weight(weight):
+    """
+    ReasonConjunction.make doesn't set a weight, so a reason without one
+    counts with the default weight.
+    """
+    if weight is None:
+        return ConfidenceValue.DEFAULT_WEIGHT
+    return weight
+
+def justified_documents():
+    """
+    Get the classes of document a reason's target can name, by the kind
+    that starts the name. Other targets are plain reason nodes, such as
+    '/data/conceptnet/4/en/root'.
+    """
+    from conceptdb.assertion import Assertion, Expression, Sentence
+    return {'assertion': Assertion, 'expression': Expression,
+            'sentence': Sentence}
+
+def counter_location(target, using=None):
+    """
+    Find where the running sums for a reason target are kept. Returns a
+    (collection, key field, key, upsert) tuple: assertions, expressions and
+    sentences keep them in their own documents, and anything else keeps them
+    in a ConfidenceValue, which is made if necessary. Returns None for
+    targets that name a document without a valid id.
+
+    The collections are in the database registered as `using` (see
+    conceptdb.register_connection), or in the default database.
+    """
+    from pymongo.objectid import ObjectId
+    from pymongo.errors import InvalidId
+    def collection(document):
+        if using is None:
+            return document.objects._collection
+        return document.using(using)._collection
+    parts = target.split('/', 2)
+    documents = justified_documents()
+    if len(parts) == 3 and parts[1] in documents:
+        try:
+            id = ObjectId(parts[2])
+        except InvalidId:
+            return None
+        return (collection(documents[parts[1]]), '_id', id, False)
+    return (collection(ConfidenceValue), 'object_id', target, True)
+
+class DirtyTargets(object):
+    """
+    The reason targets whose votes have changed in this process, for
+    conceptdb.inference.incremental to propagate. It holds at most
+    `max_size` of them; past that, it overflows and stops collecting, as
+    during a bulk import, and only a full refresh (see
+    conceptdb.inference.corona) will bring everything up to date.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.targets = set()
+        self.overflowed = False
+        # nodes that incremental propagation left for the next full refresh
+        self.stale = set()
+        keycache.register(self)
+
+    def add_all(self, targets):
+        if self.overflowed:
+            return
+        self.targets.update(targets)
+        if len(self.targets) > self.max_size:
+            self.targets = set()
+            self.overflowed = True
+
+    def take(self):
+        """
+        Get the set of dirty targets and whether it overflowed, and start
+        over.
+        """
+        targets, overflowed = self.targets, self.overflowed
+        self.targets = set()
+        self.overflowed = False
+        return targets, overflowed
+
+    def mark_stale(self, targets):
+        """
+        Remember nodes whose confidence is out of date, but which were too
+        expensive to propagate incrementally.
+        """
+        self.stale.update(targets)
+
+    def clear(self):
+        self.targets = set()
+        self.overflowed = False
+        self.stale = set()
+
+DIRTY = DirtyTargets()
+
+def count_reasons(increments, using=None):
+    """
+    Add votes and weights to the running sums of many reason targets at
+    once, and bring their confidence up to date. `increments` maps each
+    target's name to a (vote, weight) pair to add; negative values take
+    reasons away.
+
+    The sums change atomically with $inc. Each confidence is then set only
+    if the sums it was computed from are still current, because otherwise a
+    later call will set it. The targets that were found are added to
+    DIRTY. Returns a dictionary from each of them to its new (vote_sum,
+    weight_sum, confidence).
+
+    With `using`, the sums are kept in the database registered under that
+    alias instead, and CONFIDENCES and DIRTY, which belong to the default
+    database, are left alone.
+    """
+    from conceptdb.bulk import bulk_update, bulk_upsert
+    groups = {}
+    for target, (vote, weight) in increments.items():
+        location = counter_location(target, using)
+        if location is None: continue
+        collection, field, key, upsert = location
+        group = groups.setdefault(collection.name,
+                                  (collection, field, upsert, {}))
+        group[3][key] = (target, vote, weight)
+
+    results = {}
+    for collection, field, upsert, keys in groups.values():
+        base_spec = {}
+        if field == 'object_id':
+            # Match ConfidenceValues the way ConfidenceCache.flush does.
+            base_spec = ConfidenceValue.objects._query
+        operations = []
+        for key, (target, vote, weight) in keys.items():
+            operations.append((dict(base_spec, **{field: key}),
+                               {'$inc': {'vote_sum': vote,
+                                         'weight_sum': weight}}))
+        if upsert:
+            bulk_upsert(collection, operations)
+        else:
+            bulk_update(collection, operations)
+
+        operations = []
+        spec = dict(base_spec, **{field: {'$in': keys.keys()}})
+        cursor = collection.find(spec,
+                                 fields=[field, 'vote_sum', 'weight_sum'])
+        for doc in cursor:
+            vote_sum, weight_sum = doc['vote_sum'], doc['weight_sum']
+            confidence = ConfidenceValue.from_sums(vote_sum, weight_sum)
+            results[keys[doc[field]][0]] = (vote_sum, weight_sum, confidence)
+            if using is None:
+                CONFIDENCES.remember(keys[doc[field]][0], confidence)
+            operations.append(({'_id': doc['_id'], 'vote_sum': vote_sum,
+                                'weight_sum': weight_sum},
+                               {'$set': {'confidence': confidence}}))
+        bulk_update(collection, operations)
+    if using is None:
+        DIRTY.add_all(results)
+    return results
+
+def count_reason(target, vote, weight, obj=None):
+    """
+    Add one vote and weight to a target's running sums, as count_reasons
+    does. If `obj` is the target's loaded document, it is updated too.
+    Returns the target's new confidence, or None if it wasn't found.
+    """
+    result = count_reasons({target: (vote, weight)}).get(target)
+    if result is None:
+        return None
+    if obj is not None:
+        obj.vote_sum, obj.weight_sum, obj.confidence = result
+    return result[2]
+
+def dataset_targets(dataset):
+    """
+    Get the names of the assertions, expressions and sentences in a dataset.
+    """
+    from conceptdb import raw
+    names = set()
+    assertion_ids = set()
+    for record in raw.assertions(fields=['_id'], dataset=dataset):
+        assertion_ids.add(record.id)
+        names.add(record.name)
+    for record in raw.expressions(fields=['assertion']):
+        if record.assertion in assertion_ids:
+            names.add(record.name)
+    for record in raw.sentences(fields=['_id'], dataset=dataset):
+        names.add(record.name)
+    return names
+
+def recompute_confidences(dataset=None, batch_size=1000):
+    """
+    Recalculate the confidence of everything that has reasons, as
+    ConfidenceValue.calculate would, but reading each reason only once.
+    Votes and weights are summed per target with NumPy, and the sums and
+    confidence are written in batches to ConfidenceValue and to the
+    assertion, expression or sentence that the target names. This also
+    repairs running sums that have drifted (see count_reasons).
+
+    With a dataset name, only the objects in that dataset and the reason
+    nodes under it are recalculated. Returns the number of targets updated.
+
+    Documents that are already loaded, for example in a session, keep their
+    old confidence.
+    """
+    from conceptdb import raw
+
+    # Don't let cached changes overwrite the results later.
+    CONFIDENCES.flush()
+    if dataset is not None:
+        names = dataset_targets(dataset)
+        prefix = dataset + '/'
+    index = {}
+    positions = []
+    votes = []
+    weights = []
+    for reason in raw.reasons(fields=['target', 'vote', 'weight']):
+        target = reason.target
+        if target is None: continue
+        if dataset is not None and target not in names \
+           and not target.startswith(prefix):
+            continue
+        position = index.get(target)
+        if position is None:
+            position = index[target] = len(index)
+        positions.append(position)
+        votes.append(reason.vote or 0.0)
+        weights.append(reason_weight(reason.weight))
+    if not index:
+        return 0
+
+    positions = np.array(positions, dtype=np.int64)
+    vote_sums = np.bincount(positions, weights=np.array(votes),
+                            minlength=len(index))
+    weight_sums = np.bincount(positions, weights=np.array(weights),
+                              minlength=len(index))
+    confidences = ConfidenceValue.from_sums(vote_sums, weight_sums)
+
+    updates = ((target, {'confidence': float(confidences[position]),
+                         'vote_sum': float(vote_sums[position]),
+                         'weight_sum': float(weight_sums[position])})
+               for target, position in index.iteritems())
+    write_confidences(updates, batch_size)
+    CONFIDENCES.invalidate()
+    return len(index)
+
+def write_confidences(updates, batch_size=1000):
+    """
+    Set fields such as the confidence of many reason targets, given as
+    (target, fields) pairs, in batches. The fields are set on the target's
+    ConfidenceValue, which is made if necessary, and on the assertion,
+    expression or sentence that the target names. Returns the number of
+    targets written.
+
+    The cache isn't updated; call CONFIDENCES.invalidate afterward.
+    """
+    from conceptdb.bulk import bulk_upsert, bulk_update
+    from pymongo.objectid import ObjectId
+    from pymongo.errors import InvalidId
+
+    documents = justified_documents()
+    collections = dict((kind, document.objects._collection)
+                       for kind, document in documents.items())
+    values = ConfidenceValue.objects._collection
+    # Match ConfidenceValues the way ConfidenceCache.flush does.
+    base_spec = ConfidenceValue.objects._query
+    pending = dict((kind, []) for kind in documents)
+    pending_values = []
+    count = 0
+    for target, fields in updates:
+        count += 1
+        update = {'$set': fields}
+        pending_values.append((dict(base_spec, object_id=target), update))
+        if len(pending_values) >= batch_size:
+            bulk_upsert(values, pending_values)
+            pending_values = []
+
+        parts = target.split('/', 2)
+        if len(parts) < 3 or parts[1] not in documents: continue
+        try:
+            id = ObjectId(parts[2])
+        except InvalidId:
+            continue
+        operations = pending[parts[1]]
+        operations.append(({'_id': id}, update))
+        if len(operations) >= batch_size:
+            bulk_update(collections[parts[1]], operations)
+            del operations[:]
+
+    bulk_upsert(values, pending_values)
+    for kind, operations in pending.items():
+        bulk_update(collections[kind], operations)
+    return count
@@ -0,0 +1,189 @@
+"""
+Caches for looking documents up by their natural keys.
+
+Assertions are deduplicated by the key (dataset, relation, polarity, argstr,
+context). Looking that key up in MongoDB is a round trip whether or not the
+assertion exists, and during a fresh import it almost never does. A
+NaturalKeyCache remembers the ids of keys it has seen, and can hold a Bloom
+filter of every key in the collection, so that lookups which are certain to
+miss never reach the database.
+
+The Bloom filter is only trustworthy while this process sees every write to
+the collection, as it does during an import. It is empty until you call
+`preload`, and until then nothing is treated as a known miss.
+"""
+from collections import OrderedDict
+import hashlib
+import math
+import struct
+
+_caches = []
+
+def register(cache):
+    """
+    Have reset_all empty a cache, which must have a clear() method. If it
+    also has a flush() method, for changes it hasn't written yet, reset_all
+    calls that first. Returns the cache.
+    """
+    _caches.append(cache)
+    return cache
+
+def reset_all():
+    """
+    Empty every registered cache, as we must when switching databases.
+    Caches are flushed before any of them is emptied, so call this while
+    still connected to the database their changes belong to.
+    """
+    for cache in _caches:
+        flush = getattr(cache, 'flush', None)
+        if flush is not None:
+            flush()
+    for cache in _caches:
+        cache.clear()
+
+def encode_key(key):
+    """
+    Turn a natural key tuple into a byte string, so that equal keys always
+    encode the same way.
+    """
+    parts = []
+    for part in key:
+        if part is None:
+            parts.append(u'\x00')
+        elif isinstance(part, (int, long, float)):
+            parts.append(unicode(int(part)))
+        else:
+            parts.append(unicode(part))
+    return u'\x1f'.join(parts).encode('utf-8')
+
+class BloomFilter(object):
+    """
+    A set that can have false positives, but no false negatives, and takes
+    a small fixed amount of memory for the number of items it is sized for.
+    """
+    def __init__(self, capacity=10000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        nbits = int(math.ceil(-capacity * math.log(error_rate)
+                              / (math.log(2) ** 2)))
+        self.nbits = max(8, nbits)
+        self.nhashes = max(1, int(round(float(self.nbits) / capacity
+                                        * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: derive all the bit positions from two hashes.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        for i in xrange(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= (1 << (pos & 7))
+        self.count += 1
+
+    def __contains__(self, item):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class NaturalKeyCache(object):
+    """
+    Maps natural key tuples to document ids, keeping at most `max_size` of
+    them, and optionally keeps a Bloom filter of every key that exists.
+
+    The counters tell you how well it's working:
+
+    - hits: lookups answered from the id cache
+    - negatives: lookups the Bloom filter proved would miss
+    - misses: lookups that had to go to the database
+    - false_positives: database lookups that the Bloom filter let through,
+      but that found nothing
+    """
+    def __init__(self, fields, max_size=100000, capacity=10000000,
+                 error_rate=0.001):
+        self.fields = fields
+        self.max_size = max_size
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ids = OrderedDict()
+        self.bloom = None
+        self.reset_counters()
+        register(self)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.negatives = 0
+        self.misses = 0
+        self.false_positives = 0
+
+    def clear(self):
+        self.ids.clear()
+        self.bloom = None
+
+    def preload(self, collection, spec=None, batch_size=10000):
+        """
+        Fill the Bloom filter with the key of every document in `collection`
+        (or every document matching `spec`). After this, keys that aren't in
+        the filter are known not to exist.
+        """
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        cursor = collection.find(spec or {}, fields=self.fields)
+        for doc in cursor.batch_size(batch_size):
+            bloom.add(encode_key([doc.get(field) for field in self.fields]))
+        self.bloom = bloom
+        return bloom.count
+
+    def get(self, key):
+        """
+        Get the cached id for `key`, or None if it isn't cached.
+        """
+        id = self.ids.pop(key, None)
+        if id is not None:
+            self.hits += 1
+            self.ids[key] = id
+        return id
+
+    def known_missing(self, key):
+        """
+        True if the Bloom filter proves that no document has this key.
+        """
+        if self.bloom is not None and encode_key(key) not in self.bloom:
+            self.negatives += 1
+            return True
+        return False
+
+    def record_miss(self, found):
+        """
+        Count a lookup that went to the database, and whether it found
+        anything.
+        """
+        self.misses += 1
+        if not found and self.bloom is not None:
+            self.false_positives += 1
+
+    def add(self, key, id):
+        """
+        Remember that the document with this key has this id.
+        """
+        self.ids.pop(key, None)
+        self.ids[key] = id
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+        if self.bloom is not None:
+            self.bloom.add(encode_key(key))
+
+    def discard(self, key):
+        self.ids.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self.ids),
+            'bloom_keys': self.bloom.count if self.bloom is not None else None,
+            'hits': self.hits,
+            'negatives': self.negatives,
+            'misses': self.misses,
+            'false_positives': self.false_positives,
+        }
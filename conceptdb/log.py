@@ -1,18 +1,30 @@
 import mongoengine as mon
 from datetime import datetime
+from Queue import Queue, Full, Empty
+import threading
+import atexit
+import logging
 
 class Log(mon.Document):
     object = mon.GenericReferenceField()
     action = mon.StringField()
     data = mon.DictField()
     timestamp = mon.DateTimeField(default=datetime.utcnow)
-    
+
     meta = {'indexes': [('object', 'timestamp')]}
-    
+
     @staticmethod
     def add_entry(object, action, data):
-        return Log.create(object=object, action=action, data=data)
-    
+        """
+        Make a log entry and hand it to the log sink, which will write it to
+        the database soon. Returns the (unsaved) Log object.
+        """
+        entry = Log(object=object, action=action, data=data)
+        if _suspended:
+            return entry
+        get_sink().put(entry)
+        return entry
+
     @staticmethod
     def record_new(object):
         return Log.add_entry(object, 'create', {})
@@ -20,13 +32,180 @@ class Log(mon.Document):
     @staticmethod
     def record_update(object):
         return Log.add_entry(object, 'update', {})
-    
+
     @staticmethod
     def record_error(object, errtype, value):
         return Log.add_entry(object, 'error', {'type': errtype,
                                                'value': value})
-    
+
+    @staticmethod
+    def flush():
+        """
+        Block until every log entry made so far is in the database.
+        """
+        get_sink().flush()
+
+    @staticmethod
+    def suspend():
+        """
+        Stop writing log entries until a matching call to resume().
+        """
+        global _suspended
+        _suspended += 1
+
+    @staticmethod
+    def resume():
+        global _suspended
+        _suspended = max(0, _suspended - 1)
+
+    @staticmethod
+    def configure(**options):
+        """
+        Replace the log sink with one that has the given options (see
+        LogSink). The old sink writes the entries it has queued, and its
+        worker thread is stopped.
+        """
+        global _sink
+        old_sink = _sink
+        _sink = LogSink(**options)
+        if old_sink is not None:
+            old_sink.close()
+        return _sink
+
     @classmethod
     def create(cls, **fields):
         object = cls(**fields)
         object.save()
+        return object
+
+class LogSink(object):
+    """
+    Writes Log entries to the database in batches from a background thread,
+    so that logging doesn't add a round trip to every write.
+
+    Entries wait in a buffer that holds at most `max_size` of them. When the
+    buffer is full, `policy` says what to do with a new entry:
+
+    - 'block': wait until the worker thread makes room.
+    - 'drop': throw the entry away, and count it in `self.dropped`.
+    - 'sync': write the entry right away, from the caller's thread.
+    """
+    POLICIES = ('block', 'drop', 'sync')
+
+    def __init__(self, max_size=10000, batch_size=500, interval=1.0,
+                 policy='block'):
+        if policy not in LogSink.POLICIES:
+            raise ValueError("Unknown log backpressure policy: %r" % policy)
+        self.queue = Queue(max_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.dropped = 0
+        self.errors = 0
+        self._worker = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def put(self, entry):
+        """
+        Queue a Log entry to be written. A closed sink writes it right
+        away instead.
+        """
+        son = entry.to_mongo()
+        if self._closed.is_set():
+            self._write([son])
+            return
+        self._start_worker()
+        if self.policy == 'block':
+            self.queue.put(son)
+            return
+        try:
+            self.queue.put_nowait(son)
+        except Full:
+            if self.policy == 'drop':
+                self.dropped += 1
+            else:
+                self._write([son])
+
+    def flush(self):
+        """
+        Write everything in the buffer, and wait for the worker to finish
+        whatever batch it is writing.
+        """
+        while True:
+            batch = self._take(block=False)
+            if not batch: break
+            self._write(batch)
+            self._done(batch)
+        self.queue.join()
+
+    def close(self):
+        """
+        Stop the worker thread, and write whatever is left in the buffer.
+        """
+        self._closed.set()
+        worker = self._worker
+        if worker is not None:
+            worker.join()
+        self.flush()
+
+    def _start_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run,
+                                                name='conceptdb-log-sink')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run(self):
+        while not self._closed.is_set():
+            batch = self._take(block=True)
+            if batch:
+                self._write(batch)
+                self._done(batch)
+
+    def _take(self, block):
+        """
+        Take up to batch_size entries out of the queue. If `block` is true,
+        wait up to `interval` seconds for the first one.
+        """
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get(timeout=self.interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def _done(self, batch):
+        for son in batch:
+            self.queue.task_done()
+
+    def _write(self, batch):
+        try:
+            Log.objects._collection.insert(batch)
+        except Exception:
+            self.errors += 1
+            logging.getLogger('conceptdb.log').exception(
+              "Failed to write %d log entries" % len(batch))
+
+_suspended = 0
+_sink = None
+def get_sink():
+    """
+    Get the LogSink that Log entries go to, creating one with the default
+    options if necessary.
+    """
+    global _sink
+    if _sink is None:
+        _sink = LogSink()
+    return _sink
+
+def _flush_at_exit():
+    if _sink is not None:
+        _sink.flush()
+atexit.register(_flush_at_exit)
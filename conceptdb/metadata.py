@@ -1,4 +1,3 @@
-from csc.nl import get_nl
 from conceptdb import ConceptDBDocument
 from conceptdb.justify import ConceptDBJustified
 from mongoengine.queryset import DoesNotExist
@@ -12,6 +11,8 @@ class Dataset(ConceptDBDocument, mon.Document):
     def nl(self):
         if self.language is None:
             raise ValueError("This Dataset is not associated with a natural language")
+        # The NL tools are slow to import, so wait until they're needed.
+        from csc.nl import get_nl
         return get_nl(self.language)
     
     @staticmethod
@@ -0,0 +1,156 @@
+"""
+Rewrite the ids of existing assertions to content-addressed ids (see
+Assertion.content_id), and update everything that refers to them:
+
+- ReasonConjunction targets and factors ('/assertion/<id>')
+- Expression.assertion and Sentence.derived_assertions references
+- ConfidenceValue.object_id
+- the factor index (see conceptdb.factor_index), which is rebuilt
+
+Assertions that turn out to have the same key are merged into one, along
+with any reasons and ConfidenceValues that then collide, and the running
+sums of every target whose reasons changed are recounted.
+
+Run this once on a database before turning on
+conceptdb.assertion.use_content_ids(). It is safe to run it again if it gets
+interrupted.
+"""
+import conceptdb
+from conceptdb.assertion import Assertion, Expression, Sentence, \
+  ASSERTION_KEYS
+from conceptdb.justify import ReasonConjunction, ConfidenceValue, \
+  reason_weight, write_confidences
+from conceptdb.confidence import CONFIDENCES
+from conceptdb import factor_index, raw
+from pymongo.dbref import DBRef
+
+import logging
+log = logging.getLogger('conceptdb.migrate_ids')
+
+KEY_FIELDS = ['dataset', 'relation', 'polarity', 'argstr', 'context']
+
+def migrate_assertion(doc, new_id):
+    assertions = Assertion.objects._collection
+    old_id = doc['_id']
+    old_name = '/assertion/%s' % old_id
+    new_name = '/assertion/%s' % new_id
+
+    if assertions.find_one({'_id': new_id}, fields=['_id']) is None:
+        doc['_id'] = new_id
+        assertions.insert(doc, safe=True)
+    # else: a copy with the new id exists already, either from an interrupted
+    # run or because this assertion was a duplicate. Merge into it.
+
+    # Reasons are unique by target and set of factors, so a reason that
+    # collides with one that is already there once it refers to the new id
+    # is merged into it: it is removed, and its target is recounted.
+    recount = set([new_name])
+    reasons = ReasonConjunction.objects._collection
+    for reason in list(reasons.find({'target': old_name},
+                                    fields=['factors'])):
+        factor_key = ReasonConjunction.make_factor_key(reason['factors'])
+        if reasons.find_one({'target': new_name, 'factor_key': factor_key},
+                            fields=['_id']) is not None:
+            reasons.remove({'_id': reason['_id']}, safe=True)
+        else:
+            reasons.update({'_id': reason['_id']},
+                           {'$set': {'target': new_name,
+                                     'factor_key': factor_key}},
+                           safe=True)
+    for reason in list(reasons.find({'factors': old_name},
+                                    fields=['target', 'factors'])):
+        factors = [new_name if factor == old_name else factor
+                   for factor in reason['factors']]
+        factor_key = ReasonConjunction.make_factor_key(factors)
+        if reasons.find_one({'_id': {'$ne': reason['_id']},
+                             'target': reason['target'],
+                             'factor_key': factor_key},
+                            fields=['_id']) is not None:
+            reasons.remove({'_id': reason['_id']}, safe=True)
+            recount.add(reason['target'])
+        else:
+            reasons.update({'_id': reason['_id']},
+                           {'$set': {'factors': factors,
+                                     'factor_key': factor_key}},
+                           safe=True)
+
+    collection_name = assertions.name
+    old_ref = DBRef(collection_name, old_id)
+    new_ref = DBRef(collection_name, new_id)
+    Expression.objects._collection.update(
+      {'assertion': old_ref}, {'$set': {'assertion': new_ref}},
+      multi=True, safe=True)
+    Sentence.objects._collection.update(
+      {'derived_assertions': old_ref},
+      {'$set': {'derived_assertions.$': new_ref}},
+      multi=True, safe=True)
+    # Keep one ConfidenceValue for the new name. Its sums are recounted.
+    values = ConfidenceValue.objects._collection
+    if values.find_one({'object_id': new_name}, fields=['_id']) is None:
+        values.update({'object_id': old_name},
+                      {'$set': {'object_id': new_name}}, safe=True)
+    values.remove({'object_id': old_name}, safe=True)
+
+    assertions.remove({'_id': old_id}, safe=True)
+    return recount
+
+def recount_targets(targets, batch_size=1000):
+    """
+    Recompute the running sums and confidence of the given reason targets
+    from their reasons, as ConfidenceValue.calculate would. Targets that no
+    longer have any reasons are skipped. Returns the number written.
+    """
+    updates = []
+    for target in targets:
+        vote_sum = weight_sum = 0.0
+        found = False
+        for reason in raw.reasons(fields=['vote', 'weight'], target=target):
+            found = True
+            vote_sum += reason.vote or 0.0
+            weight_sum += reason_weight(reason.weight)
+        if found:
+            updates.append((target, {
+                'confidence': ConfidenceValue.from_sums(vote_sum, weight_sum),
+                'vote_sum': vote_sum, 'weight_sum': weight_sum}))
+    count = write_confidences(updates, batch_size)
+    CONFIDENCES.invalidate()
+    return count
+
+def migrate_ids(batch_size=1000):
+    """
+    Give every assertion its content-addressed id. Returns the number of
+    assertions whose ids changed.
+    """
+    assertions = Assertion.objects._collection
+    # Collect the work first, so that we don't iterate over documents we are
+    # inserting.
+    todo = []
+    for doc in assertions.find({}, fields=['_id']+KEY_FIELDS)\
+                         .batch_size(batch_size):
+        key = tuple(doc.get(field) for field in KEY_FIELDS)
+        new_id = Assertion.content_id(key)
+        if doc['_id'] != new_id:
+            todo.append((doc['_id'], new_id))
+
+    recount = set()
+    for count, (old_id, new_id) in enumerate(todo):
+        doc = assertions.find_one({'_id': old_id})
+        if doc is not None:
+            recount |= migrate_assertion(doc, new_id)
+        if count % 1000 == 0:
+            log.info('migrated %d/%d assertions' % (count, len(todo)))
+
+    ASSERTION_KEYS.clear()
+    if todo:
+        recount_targets(recount, batch_size)
+        factor_index.rebuild()
+    return len(todo)
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    dbname = 'conceptdb'
+    if len(sys.argv) > 1:
+        dbname = sys.argv[1]
+    conceptdb.connect_to_mongodb(dbname)
+    print '%d assertion ids changed.' % migrate_ids()
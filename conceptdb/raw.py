@@ -0,0 +1,124 @@
+"""
+A fast, read-only path to ConceptDB's collections.
+
+Building a mongoengine Document for every row is slow and takes a lot of
+memory, which matters when you scan a whole collection. The functions here
+run pymongo cursors directly, fetching only the fields you ask for in large
+batches, and yield compact records that use __slots__.
+
+    from conceptdb import raw
+    for reason in raw.reasons(fields=['target', 'factors']):
+        ...
+
+Records are plain data. Fields you didn't ask for are None. To change
+anything, use the Document classes.
+"""
+from conceptdb.assertion import Assertion, Expression, Sentence
+from conceptdb.justify import ReasonConjunction
+
+DEFAULT_BATCH_SIZE = 5000
+
+class Record(object):
+    """
+    Base class for records. Subclasses list their fields in __slots__, with
+    'id' first; the other slots are named after the fields they hold.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_son(cls, son):
+        record = cls.__new__(cls)
+        record.id = son.get('_id')
+        for field in cls.__slots__[1:]:
+            setattr(record, field, son.get(field))
+        return record
+
+    def __repr__(self):
+        values = ', '.join('%s=%r' % (field, getattr(self, field))
+                           for field in self.__slots__)
+        return '%s(%s)' % (self.__class__.__name__, values)
+
+class AssertionRecord(Record):
+    __slots__ = ('id', 'dataset', 'relation', 'arguments', 'argstr',
+                 'complete', 'context', 'polarity', 'confidence')
+
+    @property
+    def name(self):
+        return '/assertion/%s' % self.id
+
+class ExpressionRecord(Record):
+    __slots__ = ('id', 'assertion', 'text', 'frame', 'language', 'arguments',
+                 'confidence')
+
+    @classmethod
+    def from_son(cls, son):
+        record = super(ExpressionRecord, cls).from_son(son)
+        # Keep just the id of the assertion, not the whole DBRef.
+        if record.assertion is not None:
+            record.assertion = getattr(record.assertion, 'id',
+                                       record.assertion)
+        return record
+
+    @property
+    def name(self):
+        return '/expression/%s' % self.id
+
+class SentenceRecord(Record):
+    __slots__ = ('id', 'text', 'dataset', 'confidence')
+
+    @property
+    def name(self):
+        return '/sentence/%s' % self.id
+
+class ReasonRecord(Record):
+    __slots__ = ('id', 'target', 'factors', 'vote', 'weight')
+
+def scan(document_class, record_class, fields=None, spec=None,
+         batch_size=DEFAULT_BATCH_SIZE, using=None, skip=0, limit=0,
+         **query):
+    """
+    Yield a record_class for each document of document_class matching a
+    query. The query is either a raw MongoDB `spec` or mongoengine-style
+    keyword arguments. `fields` limits which fields are fetched, and `using`
+    names a database alias (see conceptdb.register_connection) to read from
+    instead of the default database. `skip` and `limit` page through the
+    results on the server; a limit of 0 means no limit.
+    """
+    if spec is None:
+        spec = document_class.objects(**query)._query
+    if fields is None:
+        fields = list(record_class.__slots__[1:])
+    if using is None:
+        collection = document_class.objects._collection
+    else:
+        collection = document_class.using(using)._collection
+    if limit:
+        batch_size = min(batch_size, limit)
+    cursor = collection.find(spec, fields=fields).batch_size(batch_size)
+    if skip:
+        cursor = cursor.skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    from_son = record_class.from_son
+    for son in cursor:
+        yield from_son(son)
+
+def assertions(fields=None, spec=None, batch_size=DEFAULT_BATCH_SIZE,
+               using=None, skip=0, limit=0, **query):
+    return scan(Assertion, AssertionRecord, fields, spec, batch_size, using,
+                skip, limit, **query)
+
+def expressions(fields=None, spec=None, batch_size=DEFAULT_BATCH_SIZE,
+                using=None, skip=0, limit=0, **query):
+    return scan(Expression, ExpressionRecord, fields, spec, batch_size, using,
+                skip, limit, **query)
+
+def sentences(fields=None, spec=None, batch_size=DEFAULT_BATCH_SIZE,
+              using=None, skip=0, limit=0, **query):
+    return scan(Sentence, SentenceRecord, fields, spec, batch_size, using,
+                skip, limit, **query)
+
+def reasons(fields=None, spec=None, batch_size=DEFAULT_BATCH_SIZE, using=None,
+            skip=0, limit=0, **query):
+    return scan(ReasonConjunction, ReasonRecord, fields, spec, batch_size,
+                using, skip, limit, **query)
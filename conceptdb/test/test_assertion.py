@@ -62,3 +62,38 @@ def test_assertion():
     Assertion.drop_collection() 
     
  
+
+def test_match():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    dog = Assertion.make('/data/test', '/rel/IsA',
+                         ['/concept/test/dog', '/concept/test/animal'])
+    dog.confidence = 0.5
+    dog.save()
+    pet = Assertion.make('/data/test', '/rel/IsA',
+                         ['/concept/test/dog', '/concept/test/pet'])
+    pet.confidence = 0.9
+    pet.save()
+    cat = Assertion.make('/data/test', '/rel/IsA',
+                         ['/concept/test/cat', '/concept/test/animal'])
+    Assertion.make('/data/test', '/rel/IsA', ['/concept/test/dog', '*'])
+
+    #the positional fields are filled in
+    assert dog.arg0 == '/concept/test/dog'
+    assert dog.arg1 == '/concept/test/animal'
+    assert dog.arg2 is None
+
+    #matches come back best first, without the generalization
+    found = Assertion.match('/rel/IsA', ['/concept/test/dog', '*'])
+    assert [a.id for a in found] == [pet.id, dog.id]
+    found = Assertion.match('/rel/IsA', ['*', '/concept/test/animal'])
+    assert set(a.id for a in found) == set([dog.id, cat.id])
+    assert len(Assertion.match('/rel/IsA', ['/concept/test/dog', '*'],
+                               complete=False)) == 3
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
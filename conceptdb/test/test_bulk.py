@@ -0,0 +1,146 @@
+from conceptdb.assertion import Assertion, Expression
+from conceptdb.bulk import AssertionWriter
+from conceptdb.justify import ReasonConjunction
+from conceptdb.metadata import Dataset
+from conceptdb.log import Log
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_assertion_writer():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+
+    #one assertion already exists before the writer runs
+    a0 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test0'])
+
+    with AssertionWriter(batch_size=4) as writer:
+        pending = []
+        for i in xrange(10):
+            p = writer.make('/data/test', '/rel/IsA',
+                            ['/concept/test/assertion', '/concept/test/test%d' % i])
+            p.add_support(['/data/test/contributor/nholm'])
+            pending.append(p)
+        #making the same assertion twice in a batch gives the same object
+        again = writer.make('/data/test', '/rel/IsA',
+                            ['/concept/test/assertion', '/concept/test/test9'])
+        assert again is pending[9]
+
+    #everything is resolved once the writer is done
+    assert len(Assertion.objects) == 10
+    for p in pending:
+        assert p.resolved
+        assert p.id is not None
+    assert pending[0].id == a0.id
+
+    #queued votes were applied to the real assertions
+    for p in pending:
+        assert len(ReasonConjunction.objects(target=p.name)) == 1
+
+    #a later writer finds the existing assertions instead of duplicating them
+    with AssertionWriter() as writer:
+        p = writer.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test3'])
+        resolved = writer.flush()
+    assert resolved[0].id == pending[3].id
+    assert len(Assertion.objects) == 10
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+
+def test_deferred_expressions():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    with AssertionWriter(batch_size=4) as writer:
+        pending = []
+        for i in xrange(3):
+            p = writer.make('/data/test', '/rel/IsA',
+                            ['/concept/test/dog%d' % i, '/concept/test/animal'])
+            expr = p.make_expression('{0} is an {1}',
+                                     ['dog%d' % i, 'animal'], 'en')
+            expr.add_support(['/data/test/contributor/nholm'])
+            expr.save()
+            pending.append((i, p, expr))
+        #making expressions doesn't make the writer flush
+        assert not [p for i, p, expr in pending if p.resolved]
+        assert len(Expression.objects) == 0
+
+    #the expressions and their votes were made when the writer flushed
+    assert len(Expression.objects) == 3
+    for i, p, expr in pending:
+        assert expr.assertion.id == p.id
+        assert expr.text == 'dog%d is an animal' % i
+        assert len(ReasonConjunction.objects(target=expr.name)) == 1
+
+    #an error in the with block discards the pending batch
+    writer = AssertionWriter(batch_size=4)
+    try:
+        with writer:
+            p = writer.make('/data/test', '/rel/IsA',
+                            ['/concept/test/cat', '/concept/test/animal'])
+            p.make_expression('{0} is an {1}', ['cat', 'animal'], 'en')
+            raise KeyError
+    except KeyError:
+        pass
+    assert writer.pending == []
+    assert len(Assertion.objects(argstr='/concept/test/cat,/concept/test/animal')) == 0
+    assert len(Expression.objects) == 3
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
+
+def test_bulk_import_mode():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    Log.flush()
+    Log.drop_collection()
+    collection = Assertion.objects._collection
+    indexes = set(collection.index_information())
+    assert len(indexes) > 1
+
+    with conceptdb.bulk_import_mode() as mode:
+        #only the _id index and the natural-key index that imports look
+        #assertions up by are left while importing
+        keys = [tuple(field for field, _ in info['key'])
+                for info in collection.index_information().values()]
+        assert sorted(keys) == [('_id',), ('dataset', 'relation', 'polarity',
+                                           'argstr', 'context')]
+        for i in xrange(10):
+            Assertion.make('/data/test', '/rel/IsA',
+                           ['/concept/test/assertion', '/concept/test/test%d' % i])
+
+    #the indexes are back, writes are safe again, and nothing was logged
+    assert set(collection.index_information()) == indexes
+    assert conceptdb.SAFE_WRITES
+    Log.flush()
+    assert len(Log.objects) == 0
+    assert mode.counts['Assertion'] == 10
+
+    #logging resumes afterward
+    Assertion.make('/data/test', '/rel/IsA',
+                   ['/concept/test/assertion', '/concept/test/test10'])
+    Log.flush()
+    assert len(Log.objects) == 1
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Log.drop_collection()
@@ -0,0 +1,79 @@
+from conceptdb.assertion import Assertion
+from conceptdb.confidence import ConfidenceCache, SharedConfidences, \
+  CONFIDENCES
+from conceptdb.justify import ReasonConjunction, ConfidenceValue
+from conceptdb.metadata import Dataset
+import conceptdb
+import os
+import tempfile
+
+conceptdb.connect_to_mongodb('test')
+
+def test_confidence_cache():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ConfidenceValue.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    Assertion.objects(id=a1.id).update_one(set__confidence=0.25)
+    ConfidenceValue.set('/data/test/root', 0.75)
+
+    #the first lookup loads everything it's asked for, and later ones hit
+    cache = ConfidenceCache()
+    assert cache.get_many([a1.name, '/data/test/root', '/data/test/new']) \
+      == [0.25, 0.75, ConfidenceValue.DEFAULT_CONFIDENCE]
+    assert cache.misses == 3
+    assert cache.get(a1.name) == 0.25
+    assert cache.hits == 1
+
+    #changes are written back when flushed
+    cache.set(a1.name, 0.5)
+    cache.set('/data/test/new', 0.125)
+    assert Assertion.objects.get(id=a1.id).confidence == 0.25
+    cache.flush()
+    assert Assertion.objects.get(id=a1.id).confidence == 0.5
+    assert ConfidenceValue.objects.get(object_id='/data/test/new').confidence \
+      == 0.125
+
+    #invalidating makes the cache load the value again
+    Assertion.objects(id=a1.id).update_one(set__confidence=0.0)
+    assert cache.get(a1.name) == 0.5
+    cache.invalidate([a1.name])
+    assert cache.get(a1.name) == 0.0
+
+    #setting a document's confidence stores it in the document
+    ConfidenceValue.set(a1.name, 0.625)
+    CONFIDENCES.clear()
+    assert ConfidenceValue.get(a1.name) == 0.625
+    assert Assertion.objects.get(id=a1.id).confidence == 0.625
+
+    #reconnecting writes out unflushed changes before emptying the cache
+    cache.set(a1.name, 0.875)
+    conceptdb.connect_to_mongodb('test')
+    assert not cache.values
+    assert Assertion.objects.get(id=a1.id).confidence == 0.875
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ConfidenceValue.drop_collection()
+
+def test_shared_confidences():
+    ConfidenceValue.drop_collection()
+    path = os.path.join(tempfile.mkdtemp(), 'confidences')
+    names = ['/data/test/root', '/data/test/other']
+    SharedConfidences.create(path, names)
+
+    #what one cache learns, another process's cache can read
+    writer = ConfidenceCache(SharedConfidences.open(path))
+    writer.remember('/data/test/root', 0.75)
+    writer.flush()
+    reader = ConfidenceCache(SharedConfidences.open(path))
+    assert reader.get('/data/test/root') == 0.75
+    assert reader.hits == 1
+
+    #clean up
+    ConfidenceValue.drop_collection()
@@ -0,0 +1,41 @@
+from conceptdb.assertion import Assertion
+from conceptdb.metadata import Dataset
+from conceptdb import raw
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_named_connections():
+    conceptdb.register_connection('first', 'test1')
+    conceptdb.register_connection('second', 'test2')
+    Assertion.using('first').delete()
+    Assertion.using('second').delete()
+    Assertion.drop_collection()
+
+    #save the same kind of document to each database
+    for i in xrange(3):
+        a = Assertion(dataset='/data/test', relation='/rel/IsA',
+                      arguments=['/test/assertion', '/test/test%d' % i],
+                      argstr='/test/assertion,/test/test%d' % i,
+                      complete=1, polarity=1)
+        a.save_to('first')
+    a = Assertion(dataset='/data/test', relation='/rel/IsA',
+                  arguments=['/test/assertion', '/test/other'],
+                  argstr='/test/assertion,/test/other',
+                  complete=1, polarity=1)
+    a.save_to('second')
+    assert a.id is not None
+
+    #querysets read from the database they're bound to
+    assert len(Assertion.using('first')) == 3
+    assert len(Assertion.using('second')) == 1
+    assert Assertion.using('second').with_id(a.id).argstr == a.argstr
+    assert len(list(raw.assertions(using='first', dataset='/data/test'))) == 3
+
+    #and the default connection was never touched
+    assert len(Assertion.objects) == 0
+    assert conceptdb.get_database('default').name == 'test'
+
+    #clean up
+    Assertion.using('first').delete()
+    Assertion.using('second').delete()
@@ -0,0 +1,126 @@
+from conceptdb.assertion import Assertion, Expression, use_content_ids
+from conceptdb.justify import ReasonConjunction, ConfidenceValue
+from conceptdb.metadata import Dataset
+from conceptdb.migrate_ids import migrate_ids
+from pymongo.objectid import ObjectId
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_content_ids():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+
+    use_content_ids(True)
+    try:
+        a1 = Assertion.make('/data/test', '/rel/IsA',
+                            ['/concept/test/assertion', '/concept/test/test'])
+        key = Assertion.make_key('/data/test', '/rel/IsA',
+                                 ['/concept/test/assertion', '/concept/test/test'])
+        assert a1.id == Assertion.content_id(key)
+
+        #making it again is idempotent
+        a2 = Assertion.make('/data/test', '/rel/IsA',
+                            ['/concept/test/assertion', '/concept/test/test'])
+        assert a2.id == a1.id
+        assert len(Assertion.objects) == 1
+
+        #reasons given to make are added with their weight as the vote
+        a3 = Assertion.make('/data/test', '/rel/IsA',
+                            ['/concept/test/assertion', '/concept/test/test'],
+                            reasons=['/data/test/contributor/nholm'],
+                            weight=0.0)
+        assert a3.id == a1.id
+        reasons = ReasonConjunction.objects(target=a1.name)
+        assert len(reasons) == 1
+        assert reasons[0].factors == ['/data/test/contributor/nholm']
+        assert reasons[0].vote == 0.0
+    finally:
+        use_content_ids(False)
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+
+def test_migrate_ids():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+
+    #build some assertions with random ids, and things that refer to them
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/database', '/concept/test/test'])
+    a1.add_support(['/data/test/contributor/nholm'])
+    a2.add_support([a1.name])
+    e1 = a1.make_expression('{0} is a {1}', a1.arguments, 'en')
+
+    assert migrate_ids() == 2
+    assert migrate_ids() == 0
+
+    new_a1 = Assertion.objects.get(argstr=a1.argstr)
+    new_a2 = Assertion.objects.get(argstr=a2.argstr)
+    assert new_a1.id == Assertion.content_id(
+        (a1.dataset, a1.relation, a1.polarity, a1.argstr, a1.context))
+    assert len(Assertion.objects) == 2
+
+    #references were rewritten
+    assert len(ReasonConjunction.objects(target=new_a1.name)) == 1
+    assert len(ReasonConjunction.objects(factors=new_a1.name)) == 1
+    assert len(ReasonConjunction.objects(target=a1.name)) == 0
+    assert Expression.objects.get(id=e1.id).assertion.id == new_a1.id
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
+
+def test_migrate_duplicates():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+
+    #two copies of the same assertion, with overlapping reasons
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    doc = Assertion.objects._collection.find_one({'_id': a1.id})
+    doc['_id'] = ObjectId()
+    Assertion.objects._collection.insert(doc, safe=True)
+    a2 = Assertion.objects.get(id=doc['_id'])
+    a1.add_support(['/data/test/contributor/nholm'])
+    a2.add_support(['/data/test/contributor/nholm'])
+    a2.add_support(['/data/test/contributor/rspeer'])
+    ReasonConjunction.make('/data/test/root', [a1.name], 1.0)
+    ReasonConjunction.make('/data/test/root', [a2.name], 1.0)
+
+    assert migrate_ids() == 2
+    new_a = Assertion.objects.get(argstr=a1.argstr)
+    assert len(Assertion.objects) == 1
+
+    #colliding reasons were merged, and the sums recounted
+    assert len(ReasonConjunction.objects(target=new_a.name)) == 2
+    assert new_a.vote_sum == 2.0
+    assert new_a.weight_sum == 2.0
+    assert new_a.check_confidence()
+    assert len(ReasonConjunction.objects(target='/data/test/root')) == 1
+    root = ConfidenceValue.objects.get(object_id='/data/test/root')
+    assert root.vote_sum == 1.0
+    assert root.weight_sum == 1.0
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
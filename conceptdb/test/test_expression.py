@@ -40,3 +40,31 @@ def test_expression():
     #clean up
     Assertion.drop_collection() 
     Expression.drop_collection()
+
+def test_make_expression():
+
+    #start clean
+    Expression.drop_collection()
+    Assertion.drop_collection()
+
+    a1 = Assertion.make('/data/test','/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+
+    #the first call makes the expression, and later ones find it
+    e1 = a1.make_expression('{0} is a {1}', ['this assertion', 'test'], 'en')
+    assert e1.id is not None
+    assert e1.text == 'this assertion is a test'
+    e2 = a1.make_expression('{0} is a {1}', ['this assertion', 'test'], 'en')
+    assert e2.id == e1.id
+    assert e2 == e1
+    assert len(a1.get_expressions()) == 1
+
+    #a different frame is a different expression
+    e3 = a1.make_expression('{0} is one kind of {1}',
+                            ['this assertion', 'test'], 'en')
+    assert e3.id != e1.id
+    assert len(a1.get_expressions()) == 2
+
+    #clean up
+    Assertion.drop_collection()
+    Expression.drop_collection()
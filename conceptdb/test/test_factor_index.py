@@ -0,0 +1,88 @@
+from conceptdb.justify import ReasonConjunction, ConfidenceValue
+from conceptdb.factor_index import FactorUse, FactorPage, used_for, rebuild
+from conceptdb import factor_index
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_factor_index():
+    # fresh start
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+    old_page_size = factor_index.PAGE_SIZE
+    factor_index.PAGE_SIZE = 2
+
+    try:
+        root = '/data/test/root'
+        for i in xrange(3):
+            ReasonConjunction.make('/assertion/%024x' % i, [root], 1.0)
+        ReasonConjunction.make('/sentence/%024x' % 0, [root], 1.0)
+        ReasonConjunction.make('/data/test/contributor/alice', [root], 1.0)
+
+        #the counts cover everything, and the targets come in pages
+        counts, targets = used_for(root)
+        assert counts == {'assertion': 3, 'expression': 0, 'sentence': 1,
+                          'other': 1}
+        assert len(targets['assertion']) == 2
+        assert targets['other'] == ['/data/test/contributor/alice']
+        counts, targets = used_for(root, page=1)
+        assert targets['assertion'] == ['/assertion/%024x' % 2]
+
+        #deleting a reason takes it out
+        ReasonConjunction.objects.get(target='/sentence/%024x' % 0).delete()
+        counts, targets = used_for(root)
+        assert counts['sentence'] == 0
+        assert targets['sentence'] == []
+
+        #rebuilding from the reasons gives the same counts
+        rebuild()
+        assert used_for(root)[0] == {'assertion': 3, 'expression': 0,
+                                     'sentence': 0, 'other': 1}
+    finally:
+        factor_index.PAGE_SIZE = old_page_size
+
+    #clean up
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+
+def test_new_reason_is_indexed():
+    # fresh start
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+    conceptdb.register_connection('other', 'test2')
+    FactorUse.using('other').delete()
+    FactorPage.using('other').delete()
+
+    #a reason can be made, and its factors say what they are used for
+    ReasonConjunction.make('/assertion/%024x' % 0, ['/data/test/root'], 1.0)
+    counts, targets = used_for('/data/test/root')
+    assert counts['assertion'] == 1
+    assert targets['assertion'] == ['/assertion/%024x' % 0]
+
+    #indexing in another database leaves the default one alone
+    factor_index.add_uses([('/sentence/%024x' % 0, ['/data/test/root'])],
+                          using='other')
+    assert used_for('/data/test/root')[0]['sentence'] == 0
+    page = FactorPage.using('other').get(factor='/data/test/root',
+                                         kind='sentence')
+    assert page.targets == ['/sentence/%024x' % 0]
+    factor_index.remove_use('/sentence/%024x' % 0, ['/data/test/root'],
+                            using='other')
+    page = FactorPage.using('other').get(factor='/data/test/root',
+                                         kind='sentence')
+    assert page.targets == []
+    assert used_for('/data/test/root')[0]['assertion'] == 1
+
+    #clean up
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+    FactorUse.using('other').delete()
+    FactorPage.using('other').delete()
@@ -1,4 +1,6 @@
 from conceptdb.assertion import Assertion, Expression
+from conceptdb.generalize import generalize_all
+from conceptdb.justify import ReasonConjunction
 from conceptdb.metadata import Dataset
 import conceptdb
 
@@ -53,3 +55,46 @@ def test_assertion():
     Dataset.drop_collection()
     Assertion.drop_collection()
  
+
+def test_generalize_all():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/cat', '/concept/test/animal'])
+    a1.make_expression('{0} is an {1}', ['dog', 'animal'], 'en')
+    a2.make_expression('{0} is an {1}', ['cat', 'animal'], 'en')
+
+    #each source has 3 generalizations, and two of them are shared
+    made = generalize_all([a1, a2], '/data/test/rule/generalize')
+    assert len(made) == 4
+    assert len(Assertion.objects) == 6
+    assert len(Expression.objects) == 6
+
+    #a shared generalization is supported by both sources
+    shared = Assertion.objects.get(
+        dataset='/data/test',
+        relation='/rel/IsA',
+        argstr="*,/concept/test/animal"
+    )
+    assert len(shared.get_reasons()) == 2
+    assert [e.text for e in shared.get_expressions()] == ['{0} is an animal']
+    assert len(ReasonConjunction.objects) == 12
+
+    #doing it again doesn't make anything new
+    generalize_all([a1, a2], '/data/test/rule/generalize')
+    assert len(Assertion.objects) == 6
+    assert len(Expression.objects) == 6
+    assert len(ReasonConjunction.objects) == 12
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
@@ -0,0 +1,45 @@
+from conceptdb.assertion import Assertion
+from conceptdb.metadata import Dataset
+from conceptdb.util import dereference
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_session():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/database', '/concept/test/test'])
+
+    with conceptdb.session(max_size=2) as session:
+        #repeated lookups give the same object, and only query once
+        first = Assertion.get(a1.id)
+        second = Assertion.get(str(a1.id))
+        assert first is second
+        assert session.hits == 1
+        assert dereference(a1.name) is first
+
+        #the dataset comes from the session too
+        assert first.get_dataset() is first.get_dataset()
+
+        #the least recently used document is evicted past max_size
+        Assertion.get(a2.id)
+        assert len(session) == 2
+        assert session.get(Assertion, a1.id) is None
+
+        #saving through the session replaces what it remembered
+        a2.confidence = 0.75
+        a2.save()
+        assert Assertion.get(a2.id) is a2
+
+    #outside a session, every lookup is a fresh object
+    assert Assertion.get(a1.id) is not Assertion.get(a1.id)
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
@@ -0,0 +1,367 @@
+from conceptdb.assertion import Assertion
+from conceptdb.justify import ReasonConjunction, ConfidenceValue, hamacher, \
+  DIRTY, DirtyTargets, propagate_votes
+from conceptdb.inference.graph import JustificationGraph, NodeTable
+from conceptdb.inference.corona import Corona, refresh
+from conceptdb.inference.incremental import propagate_dirty
+from conceptdb.inference.export import export_edges, export_snapshot, \
+  well_connected, _count_locally
+from conceptdb.inference.edgelist import load_edges
+from conceptdb.metadata import Dataset
+from conceptdb.confidence import CONFIDENCES
+import conceptdb
+import numpy as np
+import json
+import os
+import shutil
+import tempfile
+
+conceptdb.connect_to_mongodb('test')
+
+def test_evaluate():
+    graph = JustificationGraph.build([
+        ('/a', ['/x', '/y'], 1.0, None),
+        ('/a', [], 0.0, None),
+        ('/b', ['/x', '/y', '/z'], 1.0, 2.0),
+        ('/b', ['/z'], 0.0, None),
+    ])
+    assert graph.nodes == ['/a', '/x', '/y', '/b', '/z']
+    assert graph.num_reasons == 4
+    confidences = np.array([0.5, 0.8, 0.4, 0.5, 0.0])
+
+    #the vectorized t-norms agree with evaluating each reason by itself
+    strengths = graph.evaluate(confidences, 'hamacher')
+    assert abs(strengths[0] - hamacher([0.8, 0.4])) < 1e-9
+    assert strengths[1] == 1.0
+    assert strengths[2] == 0.0
+    assert strengths[3] == 0.0
+    assert abs(graph.evaluate(confidences, 'product')[0] - 0.32) < 1e-9
+    assert list(graph.evaluate(confidences, 'min')) == [0.4, 1.0, 0.0, 0.0]
+    try:
+        graph.evaluate(confidences, 'max')
+        assert False, "Unknown t-norms should be rejected"
+    except ValueError:
+        pass
+
+    #without strengths, votes are counted as ConfidenceValue.calculate does
+    result = graph.aggregate(confidences=confidences)
+    #(0.5 + 1 vote) / (1.0 + 2 weights)
+    assert abs(result[0] - 0.5) < 1e-9
+    #(0.5 + 1 vote) / (1.0 + 3 weights)
+    assert abs(result[3] - 0.375) < 1e-9
+    #nodes without reasons keep their confidence
+    assert result[1] == 0.8
+
+    #with them, reasons count in proportion to their strength
+    result = graph.step(confidences)
+    expected = (0.5 + strengths[0]) / (1.0 + strengths[0] + 1.0)
+    assert abs(result[0] - expected) < 1e-9
+    assert abs(result[3] - 0.5) < 1e-9
+
+def test_snapshot():
+    graph = JustificationGraph.build([
+        (u'/a', [u'/x', u'/caf\xe9'], 1.0, None),
+        (u'/b', [], 0.0, 2.0),
+    ])
+    path = tempfile.mkdtemp()
+    try:
+        graph.save(path)
+        loaded = JustificationGraph.load(path)
+
+        #the arrays are mapped, not read
+        assert isinstance(loaded.factors, np.memmap)
+        assert isinstance(loaded.nodes, NodeTable)
+        assert list(loaded.nodes) == graph.nodes
+        assert loaded.nodes[-1] == u'/b'
+        assert loaded.nodes[1:3] == [u'/x', u'/caf\xe9']
+        assert loaded.index[u'/caf\xe9'] == 2
+        assert list(loaded.indptr) == list(graph.indptr)
+        assert list(loaded.weights) == [1.0, 2.0]
+
+        #a loaded graph works like the original
+        confidences = np.array([0.5, 0.8, 0.4, 0.5])
+        assert list(loaded.step(confidences)) == \
+          list(graph.step(confidences))
+
+        #saving over a snapshot replaces it whole, and a copy that is
+        #already loaded stays readable
+        other = JustificationGraph.build([(u'/c', [u'/d'], 1.0, None)])
+        other.save(path)
+        assert list(loaded.nodes) == graph.nodes
+        assert list(loaded.factors) == list(graph.factors)
+        assert list(JustificationGraph.load(path).nodes) == [u'/c', u'/d']
+        parent, base = os.path.split(path)
+        assert not [name for name in os.listdir(parent)
+                    if name.startswith(base + '.')]
+
+        #other versions are refused
+        manifest_path = os.path.join(path, 'manifest.json')
+        manifest = json.load(open(manifest_path))
+        manifest['version'] += 1
+        json.dump(manifest, open(manifest_path, 'w'))
+        try:
+            JustificationGraph.load(path)
+            assert False, "Snapshots of other versions should be refused"
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(path)
+
+def test_from_conceptdb():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    a1.add_support(['/data/test/contributor/alice'])
+    a1.add_oppose(['/data/test/contributor/bob'])
+    ReasonConjunction.make('/data/other/contributor/carol',
+                           ['/data/other/root'], 1.0)
+
+    graph = JustificationGraph.from_conceptdb()
+    assert graph.num_reasons == 3
+    assert len(graph) == 5
+
+    #the aggregated confidences match the stored ones
+    result = graph.aggregate(confidences=graph.current_confidences())
+    for name, confidence in graph.items(result):
+        assert abs(confidence - ConfidenceValue.calculate(name)) < 1e-9
+
+    #a dataset's graph only has the reasons for things in it
+    graph = JustificationGraph.from_conceptdb('/data/test')
+    assert graph.num_reasons == 2
+    assert '/data/other/contributor/carol' not in graph.index
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+
+def test_corona():
+    graph = JustificationGraph.build([
+        ('/t', ['/a'], 1.0, None),
+        ('/u', ['/b'], 0.0, None),
+    ])
+    engine = Corona(graph)
+    confidences = engine.run(np.array([0.5, 0.5, 0.5, 0.5]), tolerance=1e-9)
+    assert engine.change <= 1e-9
+    assert engine.iterations < 100
+    a, t = confidences[graph.index['/a']], confidences[graph.index['/t']]
+    b, u = confidences[graph.index['/b']], confidences[graph.index['/u']]
+
+    #agreement makes both the voter and the target more reliable
+    assert a > 0.5 and t > 0.5
+    #the result is a fixed point
+    assert abs(t - (0.5 + a) / (1.0 + a)) < 1e-6
+    assert abs(a - (0.5 + t) / 2.0) < 1e-6
+    #a vote of 0 lowers its target, but doesn't come back to the voter
+    assert abs(b - 0.5) < 1e-9
+    assert abs(u - 0.5 / 1.5) < 1e-6
+
+def test_refresh():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    a1.add_support(['/data/test/contributor/alice'])
+
+    engine = refresh(tolerance=1e-9)
+    assert engine.written == 2
+    alice = ConfidenceValue.get('/data/test/contributor/alice')
+    assert alice > 0.5
+    assert abs(Assertion.objects.get(id=a1.id).confidence
+               - (0.5 + alice) / (1.0 + alice)) < 1e-6
+
+    #running it again from its own results changes nothing
+    assert refresh(tolerance=1e-6).written == 0
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+
+def test_propagate_dirty():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+    DIRTY.clear()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    a1.add_support(['/data/test/contributor/alice'])
+    a1.add_oppose(['/data/test/contributor/bob'])
+    assert a1.name in DIRTY.targets
+
+    propagate_dirty(epsilon=1e-9)
+    assert not DIRTY.targets
+
+    #the neighborhood ends up where a full CORONA run would put it
+    engine = Corona(JustificationGraph.from_conceptdb())
+    expected = engine.run(tolerance=1e-12)
+    CONFIDENCES.clear()
+    for name, confidence in engine.graph.items(expected):
+        assert abs(ConfidenceValue.get(name) - confidence) < 1e-6
+
+    #nodes too big to propagate are left stale for a full refresh
+    a1.add_support(['/data/test/contributor/carol'])
+    propagate_dirty(max_degree=0)
+    assert a1.name in DIRTY.stale
+    refresh()
+    assert a1.name not in DIRTY.stale
+
+    #too many changes at once overflow
+    dirty = DirtyTargets(max_size=1)
+    dirty.add_all(['/a', '/b'])
+    targets, overflowed = dirty.take()
+    assert overflowed and not targets
+    assert not dirty.overflowed
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+    DIRTY.clear()
+
+def test_propagate_votes():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+    DIRTY.clear()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    a1.add_support(['/data/test/contributor/alice'])
+    root = '/data/test/root'
+    ReasonConjunction.make(root, [a1.name], 1.0)
+    propagate_dirty()
+    before = ConfidenceValue.get(root)
+
+    #a vote on a1 changes what it is a reason for, without anyone calling
+    #propagate_dirty
+    propagate_votes(True)
+    try:
+        a1.add_oppose(['/data/test/contributor/bob'])
+        a1.add_oppose(['/data/test/contributor/carol'])
+    finally:
+        propagate_votes(False)
+    assert not DIRTY.targets
+    CONFIDENCES.clear()
+    assert ConfidenceValue.get(root) < before
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+    CONFIDENCES.clear()
+    DIRTY.clear()
+
+def test_export():
+    # fresh start
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+    root = '/data/test/root'
+    for i in xrange(3):
+        ReasonConjunction.make('/data/test/contributor/%d' % i, [root], 1.0)
+    ReasonConjunction.make('/data/test/contributor/0',
+                           ['/data/test/contributor/1',
+                            '/data/test/contributor/2'], 0.0)
+    ReasonConjunction.make('/data/test/contributor/0', ['/data/test/other'],
+                           1.0)
+
+    #degrees are counted over factors and targets
+    assert well_connected(2) == set([root, '/data/test/contributor/0'])
+    assert well_connected(1) == set([root] + ['/data/test/contributor/%d' % i
+                                              for i in xrange(3)])
+
+    #counting locally agrees with the aggregation
+    counts = _count_locally(ReasonConjunction.objects._query)
+    assert set(node for node, count in counts.iteritems()
+               if count > 2) == well_connected(2)
+
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'conceptdb.graph')
+        assert export_edges(filename, min_degree=None) == 10
+        lines = [line.split('\t') for line in open(filename)]
+        assert len(lines) == 10
+        conjunction = [line for line in lines if "'dependencies'" in line[2]]
+        assert len(conjunction) == 2
+        assert set(line[0] for line in conjunction) == \
+          set(['/data/test/contributor/1', '/data/test/contributor/2'])
+
+        #leaving out poorly connected nodes
+        assert export_edges(filename, min_degree=2) == 2
+
+        graph = export_snapshot(os.path.join(path, 'snapshot'))
+        assert graph.num_reasons == 5
+        loaded = JustificationGraph.load(os.path.join(path, 'snapshot'))
+        assert list(loaded.nodes) == list(graph.nodes)
+    finally:
+        shutil.rmtree(path)
+
+    #clean up
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+def test_load_edges():
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'test.graph')
+        out = open(filename, 'w')
+        out.write("/a\t/c/1\t{'weight': 1.0, 'dependencies': [u'/a', u'/b']}\n")
+        out.write("/b\t/c/1\t{'weight': 1.0, 'dependencies': [u'/a', u'/b']}\n")
+        out.write("\n")
+        out.write("/c/1\t/t\t{'weight': -0.5}\n")
+        out.write("/caf\xc3\xa9\t/t\t{'weight': None}\n")
+        out.close()
+
+        #parsing in small chunks across processes gives the same result
+        edges = load_edges(filename, processes=1)
+        chunked = load_edges(filename, processes=2, chunk_size=16)
+        for loaded in (edges, chunked):
+            assert loaded.nodes == [u'/a', u'/c/1', u'/b', u'/t', u'/caf\xe9']
+            assert list(loaded) == [
+                (u'/a', u'/c/1', 1.0, [u'/a', u'/b']),
+                (u'/b', u'/c/1', 1.0, [u'/a', u'/b']),
+                (u'/c/1', u'/t', -0.5, None),
+                (u'/caf\xe9', u'/t', 1.0, None),
+            ]
+
+        #props are parsed as literals, never run
+        out = open(filename, 'a')
+        out.write("/a\t/b\t__import__('os').getcwd()\n")
+        out.close()
+        try:
+            load_edges(filename)
+            assert False, "Code in a graph file should be refused"
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(path)
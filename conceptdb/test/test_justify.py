@@ -0,0 +1,130 @@
+from conceptdb.assertion import Assertion
+from conceptdb.justify import ReasonConjunction, ConfidenceValue, \
+  recompute_confidences
+from conceptdb.metadata import Dataset
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_recompute_confidences():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+    a1.add_support(['/data/test/contributor/alice'])
+    a1.add_support(['/data/test/contributor/bob'])
+    a1.add_oppose(['/data/test/contributor/carol'])
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/cat', '/concept/test/animal'])
+
+    assert recompute_confidences() == 1
+
+    #(0.5 + 2 votes) / (1.0 + 3 weights)
+    expected = ConfidenceValue.calculate(a1.name)
+    assert abs(expected - 0.625) < 1e-9
+    assert abs(Assertion.objects.get(id=a1.id).confidence - expected) < 1e-9
+    value = ConfidenceValue.objects.get(object_id=a1.name)
+    assert abs(value.confidence - expected) < 1e-9
+
+    #an assertion without reasons keeps its confidence
+    assert Assertion.objects.get(id=a2.id).confidence == 0.0
+
+    #restricting to another dataset leaves everything alone
+    assert recompute_confidences('/data/other') == 0
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+def test_vote_counters():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/dog', '/concept/test/animal'])
+
+    #each vote updates the sums and the confidence right away
+    a1.add_support(['/data/test/contributor/alice'])
+    r = a1.add_oppose(['/data/test/contributor/bob'])
+    assert a1.vote_sum == 1.0
+    assert a1.weight_sum == 2.0
+    stored = Assertion.objects.get(id=a1.id)
+    assert abs(stored.confidence - 0.5) < 1e-9
+    assert stored.check_confidence()
+
+    #changing a vote changes the sum, but not the weight
+    a1.add_support(['/data/test/contributor/bob'])
+    stored = Assertion.objects.get(id=a1.id)
+    assert stored.vote_sum == 2.0
+    assert stored.weight_sum == 2.0
+    assert stored.check_confidence()
+
+    #deleting a reason takes its vote back
+    r = ReasonConjunction.objects.get(target=a1.name,
+                                      factors='/data/test/contributor/bob')
+    r.delete()
+    stored = Assertion.objects.get(id=a1.id)
+    assert stored.vote_sum == 1.0
+    assert stored.weight_sum == 1.0
+    assert stored.check_confidence()
+
+    #reasons for other nodes are counted in ConfidenceValues
+    ReasonConjunction.make('/data/test/contributor/alice',
+                           ['/data/test/root'], 1.0)
+    value = ConfidenceValue.objects.get(object_id='/data/test/contributor/alice')
+    assert value.vote_sum == 1.0
+    assert abs(value.confidence - 0.75) < 1e-9
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+def test_factor_key():
+    # fresh start
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
+
+    #the same factors in any order make the same reason
+    r1 = ReasonConjunction.make('/data/test/x', ['/data/test/a', '/data/test/b'], 1.0)
+    r2 = ReasonConjunction.make('/data/test/x', ['/data/test/b', '/data/test/a'], 1.0)
+    assert r1.id == r2.id
+    assert r1.factor_key == ReasonConjunction.make_factor_key(['/data/test/b', '/data/test/a'])
+
+    #but a subset of them is a different reason
+    r3 = ReasonConjunction.make('/data/test/x', ['/data/test/a'], 1.0)
+    assert r3.id != r1.id
+    assert len(ReasonConjunction.objects(target='/data/test/x')) == 2
+
+    #reasons stored without a key get one, and duplicates are removed
+    collection = conceptdb.get_database()[ReasonConjunction._meta['collection']]
+    collection.drop()
+    for target in ('/data/test/x', '/data/test/y'):
+        for factors in (['/data/test/a', '/data/test/b'],
+                        ['/data/test/b', '/data/test/a'],
+                        ['/data/test/a']):
+            collection.insert({'target': target, 'factors': factors,
+                               'vote': 1.0}, safe=True)
+    assert ReasonConjunction.fill_factor_keys() == (4, 2)
+    assert len(ReasonConjunction.objects(target='/data/test/x')) == 2
+
+    #after which the unique index exists
+    unique = [info['key'] for info in collection.index_information().values()
+              if info.get('unique')]
+    assert [('target', 1), ('factor_key', 1)] in unique
+
+    #clean up
+    ReasonConjunction.drop_collection()
+    ConfidenceValue.drop_collection()
@@ -0,0 +1,76 @@
+from conceptdb.assertion import Assertion, ASSERTION_KEYS
+from conceptdb.keycache import BloomFilter, NaturalKeyCache, encode_key
+from conceptdb.metadata import Dataset
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in xrange(1000):
+        bloom.add('key%d' % i)
+    
+    #no false negatives
+    for i in xrange(1000):
+        assert ('key%d' % i) in bloom
+
+    #a reasonable false positive rate
+    false_positives = sum(1 for i in xrange(10000) if ('other%d' % i) in bloom)
+    assert false_positives < 300
+
+def test_encode_key():
+    #polarity can arrive as an int or a float, and should encode the same
+    assert encode_key(('/data/test', '/rel/IsA', 1, 'a,b', None)) == \
+           encode_key((u'/data/test', u'/rel/IsA', 1.0, u'a,b', None))
+    assert encode_key(('/data/test', '/rel/IsA', 1, 'a,b', None)) != \
+           encode_key(('/data/test', '/rel/IsA', 1, 'a,b', u''))
+
+def test_key_cache():
+    cache = NaturalKeyCache(['a', 'b'], max_size=2)
+    cache.add(('x', 1), 'id1')
+    cache.add(('y', 1), 'id2')
+    cache.add(('z', 1), 'id3')
+    assert cache.get(('x', 1)) is None
+    assert cache.get(('z', 1)) == 'id3'
+    assert cache.hits == 1
+
+    #without a preloaded Bloom filter, nothing is known to be missing
+    assert not cache.known_missing(('w', 1))
+
+def test_assertion_keys():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+
+    ASSERTION_KEYS.clear()
+    ASSERTION_KEYS.reset_counters()
+    assert Assertion.preload_keys(dataset='/data/test') == 1
+
+    #a new assertion is created without looking it up first
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/database', '/concept/test/test'])
+    assert ASSERTION_KEYS.negatives == 1
+    assert ASSERTION_KEYS.misses == 0
+
+    #the existing one is looked up once, and then found by its id
+    a3 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    a4 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    assert a3.id == a4.id == a1.id
+    assert ASSERTION_KEYS.misses == 1
+    assert ASSERTION_KEYS.hits == 1
+
+    #the new assertion was added to the filter
+    a5 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/database', '/concept/test/test'])
+    assert a5.id == a2.id
+    assert len(Assertion.objects) == 2
+
+    #clean up
+    ASSERTION_KEYS.clear()
+    Dataset.drop_collection()
+    Assertion.drop_collection()
@@ -0,0 +1,81 @@
+from conceptdb.assertion import Assertion
+from conceptdb.metadata import Dataset
+from conceptdb.log import Log
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_log_new_documents():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Log.drop_collection()
+
+    #a new dataset gets a 'create' entry, even though it has an _id already
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    Log.flush()
+    assert len(Log.objects(action='create')) == 1
+
+    #saving it again doesn't
+    dataset.save()
+    Log.flush()
+    assert len(Log.objects(action='create')) == 1
+
+    #neither does saving a copy loaded from the database
+    Dataset.get('/data/test').save()
+    Log.flush()
+    assert len(Log.objects(action='create')) == 1
+
+    #a new assertion gets an entry, and remaking it doesn't add another
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    a2.save()
+    Log.flush()
+    assert len(Log.objects(action='create')) == 2
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Log.drop_collection()
+
+def test_log_sink():
+    Dataset.drop_collection()
+    Log.drop_collection()
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    Log.flush()
+    Log.drop_collection()
+
+    #entries are written in batches, and all of them are there after a flush
+    Log.configure(max_size=10, batch_size=3)
+    for i in xrange(25):
+        Log.record_update(dataset)
+    Log.flush()
+    assert len(Log.objects(action='update')) == 25
+
+    #replacing the sink writes out its entries and stops its worker
+    old_sink = Log.configure(max_size=10, batch_size=3)
+    for i in xrange(5):
+        Log.record_update(dataset)
+    sink = Log.configure(max_size=1, policy='drop')
+    assert not old_sink._worker.is_alive()
+    assert len(Log.objects(action='update')) == 30
+
+    #with the 'drop' policy, a full buffer discards entries instead of waiting
+    for i in xrange(100):
+        Log.record_update(dataset)
+    Log.flush()
+    assert len(Log.objects(action='update')) + sink.dropped == 130
+
+    #unknown policies are rejected
+    try:
+        Log.configure(policy='shrug')
+        assert False
+    except ValueError:
+        pass
+
+    #go back to the defaults and clean up
+    Log.configure()
+    Dataset.drop_collection()
+    Log.drop_collection()
@@ -1,7 +1,8 @@
 import conceptdb
 from conceptdb.metadata import Dataset
 from conceptdb.assertion import Assertion
-from conceptdb.justify import ReasonConjunction
+from conceptdb.justify import ReasonConjunction, ConfidenceValue
+from conceptdb.factor_index import FactorUse, FactorPage
 from mongoengine.queryset import QuerySet
 from conceptdb.db_merge import *
 
@@ -252,6 +253,54 @@ def test_merge6(db1='test1', db2='test2'):
     
     print "Finished test 6."
 
+def test_merge_counts(db1='test1', db2='test2'):
+    '''
+    Reasons copied by a merge count toward their targets and are indexed
+    in the database they're copied to.
+    '''
+    conceptdb.connect_to_mongodb(db2)
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+
+    conceptdb.connect_to_mongodb(db1)
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+    a = Assertion.make('/data/test','/rel/IsA',['/test/assertion','test/test'])
+    a.add_support(['/data/test/contributor/nholm'])
+    a.add_oppose(['/data/test/contributor/rspeer'])
+    #a reason stored before factors were required
+    a2 = Assertion.make('/data/test','/rel/IsA',['/test/assertion','test/other'])
+    ReasonConjunction.objects._collection.insert({'target': a2.name,
+                                                  'vote': 1.0}, safe=True)
+
+    #reasons are read a batch of targets at a time
+    merge(db1, db2, batch_size=1)
+
+    copy = Assertion.using(db2).get(argstr=a.argstr)
+    assert copy.vote_sum == 1.0
+    assert copy.weight_sum == 2.0
+    assert copy.confidence == ConfidenceValue.from_sums(1.0, 2.0)
+    use = FactorUse.using(db2).with_id('/data/test/contributor/nholm')
+    assert use.counts == {'assertion': 1}
+    copy2 = Assertion.using(db2).get(argstr=a2.argstr)
+    legacy = ReasonConjunction.using(db2).get(target=copy2.name)
+    assert legacy.factors == []
+
+    #clean up
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+    conceptdb.connect_to_mongodb(db2)
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    FactorUse.drop_collection()
+    FactorPage.drop_collection()
+
 '''
 For use with the API:
 testmerge_make() just populates two test dbs and gives them reasons
@@ -0,0 +1,66 @@
+from conceptdb.assertion import Assertion, Expression
+from conceptdb.justify import ReasonConjunction
+from conceptdb.metadata import Dataset
+from conceptdb import raw
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_raw_records():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
+
+    dataset = Dataset.create(language = 'en', name = '/data/test')
+    a1 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/assertion', '/concept/test/test'])
+    a2 = Assertion.make('/data/test', '/rel/IsA',
+                        ['/concept/test/database', '/concept/test/test'])
+    a1.add_support(['/data/test/contributor/nholm'])
+    e1 = a1.make_expression('{0} is a {1}', a1.arguments, 'en')
+
+    #records have the same values as the documents
+    records = list(raw.assertions(dataset='/data/test'))
+    assert len(records) == 2
+    by_id = dict((record.id, record) for record in records)
+    assert by_id[a1.id].argstr == a1.argstr
+    assert by_id[a1.id].name == a1.name
+    assert by_id[a2.id].arguments == a2.arguments
+
+    #fields that weren't asked for are None
+    record = list(raw.assertions(fields=['relation'], argstr=a1.argstr))[0]
+    assert record.relation == '/rel/IsA'
+    assert record.argstr is None
+
+    #records are compact
+    try:
+        record.something_else = 1
+        assert False
+    except AttributeError:
+        pass
+
+    #skip and limit page through the results
+    all_ids = [record.id for record in raw.assertions(fields=[],
+                                                      dataset='/data/test')]
+    page = list(raw.assertions(fields=[], dataset='/data/test',
+                               skip=1, limit=1))
+    assert [record.id for record in page] == all_ids[1:2]
+    assert len(list(raw.assertions(dataset='/data/test', limit=1))) == 1
+    assert len(list(raw.assertions(dataset='/data/test', skip=2))) == 0
+
+    reasons = list(raw.reasons(target=a1.name))
+    assert len(reasons) == 1
+    assert reasons[0].factors == ['/data/test/contributor/nholm']
+
+    expressions = list(raw.expressions(assertion=a1))
+    assert len(expressions) == 1
+    assert expressions[0].assertion == a1.id
+    assert expressions[0].text == e1.text
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    Expression.drop_collection()
+    ReasonConjunction.drop_collection()
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import time
+
+# Modules that are slow to import, and that `import conceptdb` must not pull
+# in until something actually needs them.
+HEAVY_MODULES = ['mongoengine', 'pymongo', 'django', 'csc.nl', 'db_config',
+                 'numpy']
+
+# How much longer than a bare interpreter `import conceptdb` may take.
+IMPORT_BUDGET = 0.25
+
+# the directory that holds the conceptdb package
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+def run_python(code):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+                               env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    elapsed = time.time() - start
+    assert process.returncode == 0, errors
+    return output, elapsed
+
+def test_import_is_light():
+    output, _ = run_python(
+      "import sys, conceptdb\n"
+      "print ' '.join(m for m in %r if m in sys.modules)" % HEAVY_MODULES)
+    assert output.strip() == ''
+
+def test_import_time():
+    _, baseline = run_python("pass")
+    _, elapsed = run_python("import conceptdb")
+    assert elapsed - baseline < IMPORT_BUDGET
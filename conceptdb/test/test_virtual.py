@@ -0,0 +1,76 @@
+from conceptdb.assertion import Assertion, use_virtual_generalizations
+from conceptdb.metadata import Dataset
+from conceptdb.justify import ReasonConjunction
+from conceptdb import virtual
+from mongoengine.queryset import DoesNotExist
+import conceptdb
+
+conceptdb.connect_to_mongodb('test')
+
+def test_virtual_generalizations():
+    # fresh start
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
+    use_virtual_generalizations()
+
+    try:
+        dataset = Dataset.create(language = 'en', name = '/data/test')
+        a1 = Assertion.make('/data/test', '/rel/IsA',
+                            ['/concept/test/dog', '/concept/test/animal'])
+        a1.confidence = 0.8
+        a1.save()
+        a1.make_generalizations('/data/test/rule/generalize')
+
+        #nothing was stored for the generalizations
+        assert len(Assertion.objects) == 1
+
+        #but they can be looked up anyway
+        key = Assertion.make_key('/data/test', '/rel/IsA',
+                                 ['/concept/test/dog', '*'])
+        a2 = Assertion.find_by_key(key)
+        assert a2.argstr == '/concept/test/dog,*'
+        assert a2.complete == 0
+        assert a2.confidence == 0.8
+        assert a2.id == Assertion.content_id(key)
+
+        #a new member shows up right away, even though the result was cached
+        key = Assertion.make_key('/data/test', '/rel/IsA',
+                                 ['*', '/concept/test/animal'])
+        assert Assertion.find_by_key(key)._members == 1
+        assert virtual.WILDCARDS.get(key)[0]
+        a3 = Assertion.make('/data/test', '/rel/IsA',
+                            ['/concept/test/cat', '/concept/test/animal'])
+        assert not virtual.WILDCARDS.get(key)[0]
+        assert Assertion.find_by_key(key)._members == 2
+
+        #votes on a generalization would be lost, so they are refused
+        try:
+            a2.add_support(['/data/test/contributor/nholm'])
+            assert False
+        except ValueError:
+            pass
+        try:
+            Assertion.make('/data/test', '/rel/IsA',
+                           ['/concept/test/dog', '*'],
+                           reasons=['/data/test/contributor/nholm'])
+            assert False
+        except ValueError:
+            pass
+        assert len(ReasonConjunction.objects(target=a2.name)) == 0
+
+        #a wildcard with no members doesn't exist
+        key = Assertion.make_key('/data/test', '/rel/IsA',
+                                 ['/concept/test/fish', '*'])
+        try:
+            Assertion.find_by_key(key)
+            assert False
+        except DoesNotExist:
+            pass
+    finally:
+        use_virtual_generalizations(False)
+
+    #clean up
+    Dataset.drop_collection()
+    Assertion.drop_collection()
+    ReasonConjunction.drop_collection()
@@ -41,5 +41,5 @@ def dereference(id):
     else:
         return None
     
-    return cls.objects.with_id(id)
+    return cls.lookup(id.split('/', 2)[2])
 
@@ -0,0 +1,144 @@
+"""
+Wildcard assertions that are computed when they are read, instead of stored.
+
+Storing every generalization of every assertion (see conceptdb.generalize)
+roughly triples the size of the assertions collection and its indexes, and
+most of those rows are rarely read. After
+conceptdb.assertion.use_virtual_generalizations(), make_generalizations
+stores nothing. Looking up a wildcard assertion such as IsA(dog, *) then runs
+an aggregation over the complete assertions it generalizes, and builds an
+unsaved Assertion whose confidence is the mean confidence of those members.
+
+Results are cached for `max_age` seconds. Making a new complete assertion
+drops the cached generalizations it belongs to, but changes in the members'
+confidence only show up when the cache entry expires.
+"""
+from collections import OrderedDict
+import time
+from conceptdb import keycache
+from conceptdb.assertion import Assertion, BLANK, POSITIONS
+from conceptdb.generalize import patterns, apply_pattern
+
+class WildcardCache(object):
+    """
+    Maps the natural keys of wildcard assertions to the Assertions built for
+    them (or None if they have no members), keeping at most `max_size` of
+    them for at most `max_age` seconds.
+    """
+    def __init__(self, max_size=10000, max_age=300.0):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        keycache.register(self)
+
+    def get(self, key):
+        """
+        Get a (found, assertion) pair. `found` is False if the key isn't
+        cached, or its entry has expired.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or time.time() - entry[0] > self.max_age:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries[key] = entry
+        return True, entry[1]
+
+    def put(self, key, assertion):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), assertion)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+WILDCARDS = WildcardCache()
+
+def is_wildcard(key):
+    return BLANK in key[3].split(',')
+
+def aggregate(key):
+    """
+    Compute the wildcard assertion with the given natural key from the
+    complete assertions that match it. Returns None if there are none.
+    """
+    dataset, relation, polarity, argstr, context = key
+    arguments = argstr.split(',')
+    spec = {'dataset': dataset, 'relation': relation, 'polarity': polarity,
+            'context': context, 'complete': 1,
+            'arguments': {'$size': len(arguments)}}
+    for index, arg in enumerate(arguments):
+        if arg == BLANK: continue
+        if index < POSITIONS:
+            # These can use the positional indexes (see Assertion.match).
+            spec['arg%d' % index] = arg
+        else:
+            spec['arguments.%d' % index] = arg
+
+    collection = Assertion.objects._collection
+    if hasattr(collection, 'aggregate'):
+        result = collection.aggregate([
+            {'$match': spec},
+            {'$group': {'_id': None, 'count': {'$sum': 1},
+                        'confidence': {'$avg': '$confidence'}}}
+        ])
+        if isinstance(result, dict):
+            rows = result['result']
+        else:
+            rows = list(result)
+        if not rows:
+            return None
+        count, confidence = rows[0]['count'], rows[0]['confidence']
+    else:
+        count, total = 0, 0.0
+        for doc in collection.find(spec, fields=['confidence']):
+            count += 1
+            total += doc.get('confidence') or 0.0
+        if count == 0:
+            return None
+        confidence = total / count
+
+    assertion = Assertion(
+        id=Assertion.content_id(key),
+        dataset=dataset,
+        relation=relation,
+        arguments=arguments,
+        argstr=argstr,
+        complete=0,
+        context=context,
+        polarity=polarity,
+        confidence=confidence or 0.0,
+        **Assertion.positions(arguments)
+    )
+    assertion._virtual = True
+    assertion._members = count
+    return assertion
+
+def find(key):
+    """
+    Get the virtual wildcard assertion with the given natural key, or None
+    if no complete assertion matches it.
+    """
+    found, assertion = WILDCARDS.get(key)
+    if not found:
+        assertion = aggregate(key)
+        WILDCARDS.put(key, assertion)
+    return assertion
+
+def invalidate(key):
+    """
+    Forget the cached generalizations of the complete assertion with this
+    natural key, because it has just been made.
+    """
+    dataset, relation, polarity, argstr, context = key
+    arguments = argstr.split(',')
+    for pattern in patterns(arguments):
+        args = apply_pattern(arguments, pattern)
+        WILDCARDS.discard(Assertion.make_key(dataset, relation, args,
+                                             polarity, context))
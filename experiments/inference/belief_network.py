@@ -216,11 +216,11 @@ class BeliefNetwork(object):
 
 def graph_from_conceptnet(output=None):
     import conceptdb
-    from conceptdb.justify import Reason
+    from conceptdb import raw
     conceptdb.connect('conceptdb')
 
     bn = BeliefNetwork(output=output)
-    for reason in Reason.objects:
+    for reason in raw.reasons(fields=['target', 'factors', 'weight']):
         reason_name = '/c/%s' % reason.id
         if reason.target == '/sentence/None': continue
         print len(bn.graph), reason_name
@@ -229,22 +229,16 @@ def graph_from_conceptnet(output=None):
     return bn
 
 def graph_from_file(filename):
+    from conceptdb.inference.edgelist import load_edges
     bn = BeliefNetwork(output=None)
     found_conjunctions = set()
-    with open(filename) as file:
-        for line in file:
-            line = line.strip()
-            if line:
-                source, target, prop_str = line.split('\t')
-                props = eval(prop_str)
-                weight = props['weight']
-                dependencies = None
-                if 'dependencies' in props:
-                    dependencies = props['dependencies']
-                    if target not in found_conjunctions:
-                        found_conjunctions.add(target)
-                        bn.conjunctions.add((dependencies, target, weight))
-                bn.add_edge(source, target, weight, dependencies)
+    for source, target, weight, dependencies in load_edges(filename):
+        if dependencies is not None:
+            dependencies = tuple(dependencies)
+            if target not in found_conjunctions:
+                found_conjunctions.add(target)
+                bn.conjunctions.add((dependencies, target, weight))
+        bn.add_edge(source, target, weight, dependencies)
     return bn
 
 def demo():
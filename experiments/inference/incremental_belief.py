@@ -3,7 +3,6 @@ from csc import divisi2
 from csc.divisi2.ordered_set import OrderedSet
 from csc.divisi2.reconstructed import ReconstructedMatrix
 import numpy as np
-import codecs
 import random
 
 EPS = 1e-6
@@ -126,11 +125,11 @@ class BeliefNetwork(object):
 
 def graph_from_conceptnet(output='conceptnet'):
     import conceptdb
-    from conceptdb.justify import Reason
+    from conceptdb import raw
     conceptdb.connect('conceptdb')
 
     bn = BeliefNetwork(output=output)
-    for reason in Reason.objects:
+    for reason in raw.reasons(fields=['target', 'factors', 'weight']):
         reason_name = '/c/%s' % reason.id
         if reason.target == '/sentence/None': continue
         print len(bn.nodes), reason_name
@@ -139,34 +138,16 @@ def graph_from_conceptnet(output='conceptnet'):
     return bn
 
 def graph_from_file(filename):
+    from conceptdb.inference.edgelist import load_edges
+    edges = load_edges(filename)
     bn = BeliefNetwork(output=None)
-    found_conjunctions = set()
-    counter = 0
-    with codecs.open(filename, encoding='utf-8') as file:
-        for line in file:
-            print 'scan:', counter
-            counter += 1
-            line = line.strip()
-            if line:
-                source, target, prop_str = line.split('\t')
-                bn.scan_edge(source, target)
+    bn.add_nodes(edges.nodes)
     bn.initialize_matrices()
-    total = counter
-    counter = 0
-    with codecs.open(filename, encoding='utf-8') as file:
-        for line in file:
-            print 'add edge:', counter, '/', total
-            counter += 1
-            line = line.strip()
-            if line:
-                source, target, prop_str = line.split('\t')
-                props = eval(prop_str)
-                weight = props['weight']
-                if 'dependencies' in props and len(props['dependencies']) > 1:
-                    bn.add_conjunction_piece(source, target, weight)
-                else:
-                    bn.add_edge(source, target, weight)
-    file.close()
+    for source, target, weight, dependencies in edges:
+        if dependencies is not None and len(dependencies) > 1:
+            bn.add_conjunction_piece(source, target, weight)
+        else:
+            bn.add_edge(source, target, weight)
     return bn
 
 def demo():
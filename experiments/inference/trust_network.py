@@ -3,7 +3,6 @@ from scipy.sparse.linalg import eigen, svd as sparse_svd
 from csc import divisi2
 from csc.divisi2.ordered_set import OrderedSet
 import numpy as np
-import codecs
 
 EPS = 1e-6
 DOWN, UP = 1, -1
@@ -132,71 +131,30 @@ class TrustNetwork(object):
         authority /= np.max(authority)
         return zip(self.nodes, hub, authority)
 
-def output_edge(file, source, target, **data):
-    line = u"%s\t%s\t%s" % (source, target, data)
-    print line.encode('utf-8')
-    print >> file, line.encode('utf-8')
+def polar_weight(reason):
+    if reason.vote is not None and reason.vote < 0.5:
+        return -0.5
+    return 1.0
 
-from collections import defaultdict
 def graph_from_conceptdb(output='conceptdb.graph'):
     import conceptdb
-    from conceptdb.justify import Reason
-    conceptdb.connect('conceptdb')
-    outfile = open(output, 'w')
-    
-    counts = defaultdict(int)
-    for reason in Reason.objects:
-        reason_name = '/c/%s' % reason.id
-        if reason.target == '/sentence/None': continue
-        for factor in reason.factors:
-            counts[factor] += 1
-        counts[reason.target] += 1
-    print 'counted'
-    for reason in Reason.objects:
-        reason_name = '/c/%s' % reason.id
-        if reason.target == '/sentence/None': continue
-        polar_weight = 1.0
-        if reason.polarity == False: polar_weight = -0.5
-        factor_counts = [counts[factor] for factor in reason.factors]
-        if min(factor_counts) <= 3: continue
-        if counts[reason.target] <= 3: continue
-        for factor in reason.factors:
-            output_edge(outfile, factor, reason_name, weight=reason.weight, dependencies=reason.factors)
-        output_edge(outfile, reason_name, reason.target, weight=polar_weight)
-    outfile.close()
+    from conceptdb.inference.export import export_edges
+    conceptdb.connect_to_mongodb('conceptdb')
+    export_edges(output, min_degree=3, target_weight=polar_weight)
     print "Done building the file."
     return graph_from_file(output)
 
 def graph_from_file(filename):
+    from conceptdb.inference.edgelist import load_edges
+    edges = load_edges(filename)
     bn = TrustNetwork(output=None)
-    found_conjunctions = set()
-    counter = 0
-    with codecs.open(filename, encoding='utf-8') as file:
-        for line in file:
-            print 'scan:', counter
-            counter += 1
-            line = line.strip()
-            if line:
-                source, target, prop_str = line.split('\t')
-                bn.scan_edge(source, target)
+    bn.add_nodes(edges.nodes)
     bn.make_matrices()
-    total = counter
-    counter = 0
-    with codecs.open(filename, encoding='utf-8') as file:
-        for line in file:
-            print 'add edge:', counter, '/', total
-            counter += 1
-            line = line.strip()
-            if line:
-                source, target, prop_str = line.split('\t')
-                props = eval(prop_str)
-                weight = props['weight']
-                dependencies = None
-                if 'dependencies' in props and len(props['dependencies']) > 1:
-                    bn.add_conjunction_piece(source, target, weight)
-                else:
-                    bn.add_edge(source, target, weight)
-    file.close()
+    for source, target, weight, dependencies in edges:
+        if dependencies is not None and len(dependencies) > 1:
+            bn.add_conjunction_piece(source, target, weight)
+        else:
+            bn.add_edge(source, target, weight)
     
     bn.make_fast_matrix()
     bn.make_fast_conjunctions()